@@ -0,0 +1,41 @@
+--
+-- Tables used by parking_socrata.py to pick up where the last run left off
+--
+
+CREATE TABLE api.socrata_batch_sizes (
+  "dataset" text PRIMARY KEY,
+  "batch_size" int NOT NULL,
+  "updated_at" timestamp with time zone DEFAULT now() NOT NULL
+);
+
+CREATE TABLE api.socrata_publish_state (
+  "dataset" text NOT NULL,
+  "row_id" text NOT NULL,
+  "row_hash" text NOT NULL,
+  "updated_at" timestamp with time zone DEFAULT now() NOT NULL,
+  PRIMARY KEY ("dataset", "row_id")
+);
+
+--
+-- Name: published_hashes(text, text[]); Type: FUNCTION; Schema: api; Owner: postgres
+-- Hashes of the given records as they were last published to Socrata
+--
+
+CREATE FUNCTION api.published_hashes(dataset text, ids text[])
+    RETURNS TABLE (row_id text, row_hash text)
+    LANGUAGE sql STABLE
+    AS $$
+    SELECT s.row_id, s.row_hash
+    FROM api.socrata_publish_state s
+    WHERE s.dataset = published_hashes.dataset AND s.row_id = ANY(published_hashes.ids);
+$$;
+
+
+ALTER FUNCTION api.published_hashes(text, text[]) OWNER TO postgres;
+
+CREATE TRIGGER set_updated_at BEFORE INSERT OR UPDATE ON api.socrata_batch_sizes FOR EACH ROW EXECUTE FUNCTION public.trigger_set_updated_at();
+CREATE TRIGGER set_updated_at BEFORE INSERT OR UPDATE ON api.socrata_publish_state FOR EACH ROW EXECUTE FUNCTION public.trigger_set_updated_at();
+
+GRANT ALL ON TABLE api.socrata_batch_sizes TO my_api_user;
+GRANT ALL ON TABLE api.socrata_publish_state TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.published_hashes(text, text[]) TO my_api_user;
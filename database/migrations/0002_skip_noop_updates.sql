@@ -0,0 +1,16 @@
+--
+-- Name: trigger_set_updated_at(); Type: FUNCTION; Schema: public; Owner: postgres
+-- Upserts through PostgREST update every row they match, returning NULL for rows
+-- which are identical to what is stored skips the update so the row isn't rewritten
+-- and keeps its updated_at.
+--
+
+CREATE OR REPLACE FUNCTION public.trigger_set_updated_at() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$ BEGIN
+    IF TG_OP = 'UPDATE' AND NEW IS NOT DISTINCT FROM OLD THEN
+        RETURN NULL;
+    END IF;
+    NEW.updated_at = NOW();
+    RETURN NEW;
+END; $$;
@@ -0,0 +1,20 @@
+--
+-- Indexes for the queries the meters scripts run through PostgREST
+--
+
+-- updated_at ranges: parking_socrata.py publishing and match_field_processing.py get_payments
+CREATE INDEX transactions_updated_at_idx ON api.transactions (updated_at);
+CREATE INDEX flowbird_transactions_raw_updated_at_idx ON api.flowbird_transactions_raw (updated_at);
+CREATE INDEX flowbird_payments_raw_updated_at_idx ON api.flowbird_payments_raw (updated_at);
+CREATE INDEX passport_transactions_raw_updated_at_idx ON api.passport_transactions_raw (updated_at);
+CREATE INDEX fiserv_reports_raw_updated_at_idx ON api.fiserv_reports_raw (updated_at);
+
+-- Fiserv rows which haven't been matched to a Flowbird payment yet (get_fiserv),
+-- this stays the size of the unmatched rows rather than the whole table
+CREATE INDEX fiserv_reports_raw_unmatched_idx ON api.fiserv_reports_raw (id)
+    INCLUDE (invoice_id, transaction_date)
+    WHERE flowbird_id IS NULL;
+
+-- Matching Fiserv and Flowbird payments on invoice_id and the nearest transaction_date
+CREATE INDEX fiserv_reports_raw_invoice_id_idx ON api.fiserv_reports_raw (invoice_id, transaction_date);
+CREATE INDEX flowbird_payments_raw_invoice_id_idx ON api.flowbird_payments_raw (invoice_id, transaction_date);
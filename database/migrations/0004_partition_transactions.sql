@@ -0,0 +1,149 @@
+--
+-- Monthly range partitions on start_time for api.transactions and api.flowbird_transactions_raw
+--
+-- The primary keys become (id, start_time) since a partitioned table's primary key
+-- has to include the partition key, PostgREST upserts use it as the conflict target.
+-- Rows which don't fall in a monthly partition go to the table's default partition
+-- until their month is created.
+--
+
+--
+-- Name: create_monthly_partition(regclass, date); Type: FUNCTION; Schema: public; Owner: postgres
+-- Creates the partition of a table partitioned on start_time for the month of for_month,
+-- moving any of its rows out of the default partition first. Does nothing if it exists.
+--
+
+CREATE FUNCTION public.create_monthly_partition(parent regclass, for_month date) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    parent_schema text;
+    parent_name text;
+    partition_name text;
+    default_partition regclass;
+    month_start timestamp := date_trunc('month', for_month);
+    month_end timestamp := date_trunc('month', for_month) + interval '1 month';
+BEGIN
+    SELECT n.nspname, c.relname INTO parent_schema, parent_name
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.oid = parent;
+
+    partition_name := format('%s_%s', parent_name, to_char(month_start, 'YYYY_MM'));
+    IF to_regclass(format('%I.%I', parent_schema, partition_name)) IS NOT NULL THEN
+        RETURN;
+    END IF;
+
+    EXECUTE format(
+        'CREATE TABLE %I.%I (LIKE %s INCLUDING DEFAULTS)',
+        parent_schema, partition_name, parent
+    );
+
+    -- A partition can't be attached while the default partition holds rows for it
+    SELECT i.inhrelid::regclass INTO default_partition
+    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = parent AND pg_get_expr(c.relpartbound, c.oid) = 'DEFAULT';
+
+    IF default_partition IS NOT NULL THEN
+        EXECUTE format(
+            'WITH moved AS (DELETE FROM %s WHERE start_time >= %L AND start_time < %L RETURNING *)
+            INSERT INTO %I.%I SELECT * FROM moved',
+            default_partition, month_start, month_end, parent_schema, partition_name
+        );
+    END IF;
+
+    EXECUTE format(
+        'ALTER TABLE %s ATTACH PARTITION %I.%I FOR VALUES FROM (%L) TO (%L)',
+        parent, parent_schema, partition_name, month_start, month_end
+    );
+END; $$;
+
+
+ALTER FUNCTION public.create_monthly_partition(regclass, date) OWNER TO postgres;
+
+--
+-- Name: ensure_transaction_partitions(date, int); Type: FUNCTION; Schema: api; Owner: postgres
+-- Called through PostgREST by the loaders to create the partitions for the months
+-- they are about to load.
+--
+
+CREATE FUNCTION api.ensure_transaction_partitions(from_month date, months int DEFAULT 3) RETURNS void
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = public, pg_temp
+    AS $$
+BEGIN
+    -- Loaders running at the same time would otherwise race to create the same partition
+    PERFORM pg_advisory_xact_lock(hashtext('api.ensure_transaction_partitions'));
+    FOR i IN 0..months - 1 LOOP
+        PERFORM public.create_monthly_partition(
+            'api.transactions', (from_month + make_interval(months => i))::date
+        );
+        PERFORM public.create_monthly_partition(
+            'api.flowbird_transactions_raw', (from_month + make_interval(months => i))::date
+        );
+    END LOOP;
+END; $$;
+
+
+ALTER FUNCTION api.ensure_transaction_partitions(date, int) OWNER TO postgres;
+
+REVOKE ALL ON FUNCTION api.ensure_transaction_partitions(date, int) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION api.ensure_transaction_partitions(date, int) TO my_api_user;
+
+
+--
+-- api.transactions
+-- Its row triggers are created on each partition by 0014, after the rows are copied so
+-- they keep their updated_at. This fails (and the migration rolls back) if any row has a null start_time.
+--
+
+ALTER TABLE api.transactions RENAME TO transactions_unpartitioned;
+ALTER TABLE api.transactions_unpartitioned RENAME CONSTRAINT transactions_pkey TO transactions_unpartitioned_pkey;
+
+CREATE TABLE api.transactions (
+    LIKE api.transactions_unpartitioned INCLUDING DEFAULTS,
+    PRIMARY KEY ("id", "start_time")
+) PARTITION BY RANGE ("start_time");
+
+CREATE TABLE api.transactions_default PARTITION OF api.transactions DEFAULT;
+
+SELECT public.create_monthly_partition('api.transactions', m::date)
+FROM generate_series(
+    date_trunc('month', coalesce((SELECT min(start_time) FROM api.transactions_unpartitioned), now())),
+    date_trunc('month', now()) + interval '3 months',
+    interval '1 month'
+) m;
+
+INSERT INTO api.transactions SELECT * FROM api.transactions_unpartitioned;
+DROP TABLE api.transactions_unpartitioned;
+
+CREATE INDEX transactions_updated_at_idx ON api.transactions (updated_at);
+GRANT ALL ON TABLE api.transactions TO my_api_user;
+
+
+--
+-- api.flowbird_transactions_raw
+--
+
+ALTER TABLE api.flowbird_transactions_raw RENAME TO flowbird_transactions_raw_unpartitioned;
+ALTER TABLE api.flowbird_transactions_raw_unpartitioned RENAME CONSTRAINT flowbird_transactions_raw_pkey TO flowbird_transactions_raw_unpartitioned_pkey;
+
+CREATE TABLE api.flowbird_transactions_raw (
+    LIKE api.flowbird_transactions_raw_unpartitioned INCLUDING DEFAULTS,
+    PRIMARY KEY ("id", "start_time")
+) PARTITION BY RANGE ("start_time");
+
+CREATE TABLE api.flowbird_transactions_raw_default PARTITION OF api.flowbird_transactions_raw DEFAULT;
+
+SELECT public.create_monthly_partition('api.flowbird_transactions_raw', m::date)
+FROM generate_series(
+    date_trunc('month', coalesce((SELECT min(start_time) FROM api.flowbird_transactions_raw_unpartitioned), now())),
+    date_trunc('month', now()) + interval '3 months',
+    interval '1 month'
+) m;
+
+INSERT INTO api.flowbird_transactions_raw SELECT * FROM api.flowbird_transactions_raw_unpartitioned;
+DROP TABLE api.flowbird_transactions_raw_unpartitioned;
+
+CREATE INDEX flowbird_transactions_raw_updated_at_idx ON api.flowbird_transactions_raw (updated_at);
+GRANT ALL ON TABLE api.flowbird_transactions_raw TO my_api_user;
@@ -0,0 +1,86 @@
+--
+-- Maintain api.transactions from the raw meter and app tables, so the loaders only
+-- send each row once (to its raw table).
+--
+-- Statement level triggers read the rows each insert/update touched from its
+-- transition table and upsert them into api.transactions in one statement.
+-- A trigger with transition tables can only have one event, so upserts (which can
+-- both insert and update) fire one trigger for each. Rows skipped as unchanged by
+-- set_updated_at aren't in the transition tables.
+--
+
+-- The loaders already send location_name, this makes sure the columns exist
+ALTER TABLE api.transactions ADD COLUMN IF NOT EXISTS "location_name" text;
+ALTER TABLE api.flowbird_transactions_raw ADD COLUMN IF NOT EXISTS "location_name" text;
+ALTER TABLE api.passport_transactions_raw ADD COLUMN IF NOT EXISTS "location_name" text;
+
+
+--
+-- Name: flowbird_to_transactions(); Type: FUNCTION; Schema: public; Owner: postgres
+--
+
+CREATE FUNCTION public.flowbird_to_transactions() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$ BEGIN
+    INSERT INTO api.transactions (
+        id, source, payment_method, meter_id, duration_min, start_time, end_time, amount, location_name
+    )
+    SELECT
+        id, 'Parking Meters', payment_method, meter_id, duration_min, start_time, end_time, amount, location_name
+    FROM changed_rows
+    ON CONFLICT (id, start_time) DO UPDATE SET
+        source = EXCLUDED.source,
+        payment_method = EXCLUDED.payment_method,
+        meter_id = EXCLUDED.meter_id,
+        duration_min = EXCLUDED.duration_min,
+        end_time = EXCLUDED.end_time,
+        amount = EXCLUDED.amount,
+        location_name = EXCLUDED.location_name;
+    RETURN NULL;
+END; $$;
+
+
+ALTER FUNCTION public.flowbird_to_transactions() OWNER TO postgres;
+
+CREATE TRIGGER flowbird_to_transactions_insert AFTER INSERT ON api.flowbird_transactions_raw
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.flowbird_to_transactions();
+CREATE TRIGGER flowbird_to_transactions_update AFTER UPDATE ON api.flowbird_transactions_raw
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.flowbird_to_transactions();
+
+
+--
+-- Name: passport_to_transactions(); Type: FUNCTION; Schema: public; Owner: postgres
+--
+
+CREATE FUNCTION public.passport_to_transactions() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$ BEGIN
+    INSERT INTO api.transactions (
+        id, source, payment_method, zone_id, zone_group, duration_min, start_time, end_time, amount, location_name
+    )
+    SELECT
+        id, source, payment_method, zone_id, zone_group, duration_min, start_time, end_time, amount, location_name
+    FROM changed_rows
+    ON CONFLICT (id, start_time) DO UPDATE SET
+        source = EXCLUDED.source,
+        payment_method = EXCLUDED.payment_method,
+        zone_id = EXCLUDED.zone_id,
+        zone_group = EXCLUDED.zone_group,
+        duration_min = EXCLUDED.duration_min,
+        end_time = EXCLUDED.end_time,
+        amount = EXCLUDED.amount,
+        location_name = EXCLUDED.location_name;
+    RETURN NULL;
+END; $$;
+
+
+ALTER FUNCTION public.passport_to_transactions() OWNER TO postgres;
+
+CREATE TRIGGER passport_to_transactions_insert AFTER INSERT ON api.passport_transactions_raw
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.passport_to_transactions();
+CREATE TRIGGER passport_to_transactions_update AFTER UPDATE ON api.passport_transactions_raw
+    REFERENCING NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.passport_to_transactions();
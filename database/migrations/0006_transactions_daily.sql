@@ -0,0 +1,158 @@
+--
+-- Daily rollup of api.transactions by location, source and payment method
+--
+-- Kept up to date incrementally: api.refresh_transactions_daily() recomputes only
+-- the days of the transactions updated since it last ran, and
+-- api.rebuild_transactions_daily(start_date, end_date) recomputes a range of days.
+--
+
+CREATE TABLE api.transactions_daily (
+  "id" text PRIMARY KEY,
+  "day" date NOT NULL,
+  "location_name" text NOT NULL,
+  "source" text NOT NULL,
+  "payment_method" text NOT NULL,
+  "transaction_count" int NOT NULL,
+  "revenue" double precision NOT NULL,
+  "session_minutes" double precision NOT NULL,
+  "updated_at" timestamp with time zone DEFAULT now() NOT NULL
+);
+
+CREATE INDEX transactions_daily_day_idx ON api.transactions_daily (day);
+CREATE INDEX transactions_daily_updated_at_idx ON api.transactions_daily (updated_at);
+
+CREATE TRIGGER set_updated_at BEFORE INSERT OR UPDATE ON api.transactions_daily FOR EACH ROW EXECUTE FUNCTION public.trigger_set_updated_at();
+
+-- How far through api.transactions.updated_at each rollup has got
+CREATE TABLE public.rollup_watermarks (
+  "name" text PRIMARY KEY,
+  "watermark" timestamp with time zone NOT NULL
+);
+
+
+--
+-- Name: rollup_transactions_days(date[]); Type: FUNCTION; Schema: public; Owner: postgres
+-- Recomputes the rollup rows of the given days. Groups which no longer have any
+-- transactions are zeroed rather than deleted, so the change reaches Socrata.
+--
+
+CREATE FUNCTION public.rollup_transactions_days(days date[]) RETURNS int
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    changed int;
+    zeroed int;
+BEGIN
+    CREATE TEMPORARY TABLE fresh ON COMMIT DROP AS
+    SELECT
+        concat_ws('|', d.day, g.location_name, g.source, g.payment_method) AS id,
+        d.day,
+        g.location_name,
+        g.source,
+        g.payment_method,
+        count(*)::int AS transaction_count,
+        coalesce(sum(t.amount), 0) AS revenue,
+        coalesce(sum(t.duration_min), 0) AS session_minutes
+    FROM unnest(days) AS d(day)
+    -- a range on start_time lets postgres skip the partitions of other months
+    JOIN api.transactions t ON t.start_time >= d.day AND t.start_time < d.day + 1
+    CROSS JOIN LATERAL (
+        SELECT
+            coalesce(t.location_name, 'Unknown Location') AS location_name,
+            coalesce(t.source, 'Unknown') AS source,
+            coalesce(t.payment_method, 'Unknown') AS payment_method
+    ) g
+    GROUP BY d.day, g.location_name, g.source, g.payment_method;
+
+    INSERT INTO api.transactions_daily AS r (
+        id, day, location_name, source, payment_method, transaction_count, revenue, session_minutes
+    )
+    SELECT id, day, location_name, source, payment_method, transaction_count, revenue, session_minutes
+    FROM fresh
+    ON CONFLICT (id) DO UPDATE SET
+        transaction_count = EXCLUDED.transaction_count,
+        revenue = EXCLUDED.revenue,
+        session_minutes = EXCLUDED.session_minutes
+    WHERE (r.transaction_count, r.revenue, r.session_minutes)
+        IS DISTINCT FROM (EXCLUDED.transaction_count, EXCLUDED.revenue, EXCLUDED.session_minutes);
+    GET DIAGNOSTICS changed = ROW_COUNT;
+
+    UPDATE api.transactions_daily r
+    SET transaction_count = 0, revenue = 0, session_minutes = 0
+    WHERE r.day = ANY(days)
+        AND r.transaction_count <> 0
+        AND NOT EXISTS (SELECT 1 FROM fresh f WHERE f.id = r.id);
+    GET DIAGNOSTICS zeroed = ROW_COUNT;
+
+    DROP TABLE fresh;
+    RETURN changed + zeroed;
+END; $$;
+
+
+ALTER FUNCTION public.rollup_transactions_days(date[]) OWNER TO postgres;
+
+
+--
+-- Name: refresh_transactions_daily(); Type: FUNCTION; Schema: api; Owner: postgres
+-- Recomputes the days of every transaction updated since the last refresh.
+-- Returns the number of rollup rows which changed.
+--
+
+CREATE FUNCTION api.refresh_transactions_daily() RETURNS int
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = public, pg_temp
+    AS $$
+DECLARE
+    since timestamp with time zone;
+    days date[];
+    changed int;
+BEGIN
+    -- One refresh at a time, the next one waits and picks up from this watermark
+    PERFORM pg_advisory_xact_lock(hashtext('api.refresh_transactions_daily'));
+
+    SELECT watermark INTO since FROM public.rollup_watermarks WHERE name = 'transactions_daily';
+
+    -- Rows from loads which started before the last refresh but committed after it
+    -- have an updated_at before the watermark, so look back a bit further. Days are
+    -- recomputed from scratch so going over them twice does no harm.
+    SELECT array_agg(DISTINCT start_time::date) INTO days
+    FROM api.transactions
+    WHERE updated_at > coalesce(since - interval '1 hour', '-infinity');
+
+    changed := public.rollup_transactions_days(coalesce(days, '{}'));
+
+    INSERT INTO public.rollup_watermarks (name, watermark)
+    VALUES ('transactions_daily', now())
+    ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark;
+
+    RETURN changed;
+END; $$;
+
+
+ALTER FUNCTION api.refresh_transactions_daily() OWNER TO postgres;
+
+
+--
+-- Name: rebuild_transactions_daily(date, date); Type: FUNCTION; Schema: api; Owner: postgres
+-- Recomputes every day from start_date to end_date (inclusive).
+--
+
+CREATE FUNCTION api.rebuild_transactions_daily(start_date date, end_date date) RETURNS int
+    LANGUAGE sql
+    SECURITY DEFINER
+    SET search_path = public, pg_temp
+    AS $$
+    SELECT public.rollup_transactions_days(
+        ARRAY(SELECT generate_series(start_date, end_date, interval '1 day')::date)
+    );
+$$;
+
+
+ALTER FUNCTION api.rebuild_transactions_daily(date, date) OWNER TO postgres;
+
+GRANT ALL ON TABLE api.transactions_daily TO my_api_user;
+REVOKE ALL ON FUNCTION api.refresh_transactions_daily() FROM PUBLIC;
+REVOKE ALL ON FUNCTION api.rebuild_transactions_daily(date, date) FROM PUBLIC;
+GRANT EXECUTE ON FUNCTION api.refresh_transactions_daily() TO my_api_user;
+GRANT EXECUTE ON FUNCTION api.rebuild_transactions_daily(date, date) TO my_api_user;
@@ -0,0 +1,72 @@
+--
+-- Match Fiserv reports to Flowbird payments inside postgres
+--
+-- Same result as match_field_processing.py's merge_asof: every unmatched Fiserv row
+-- gets the Flowbird payment with the same invoice_id and the nearest transaction_date,
+-- out of the payments updated between start_date and end_date. The payment just
+-- before and just after each Fiserv row are two short seeks on
+-- flowbird_payments_raw_invoice_id_idx (invoice_id, transaction_date), so only the
+-- matched rows are touched and nothing goes over the wire.
+--
+
+--
+-- Name: match_fiserv_payments(timestamp with time zone, timestamp with time zone, interval); Type: FUNCTION; Schema: api; Owner: postgres
+-- Sets flowbird_id on the matched fiserv_reports_raw rows and returns how many there were.
+-- With a tolerance, payments further away in time than it aren't matched.
+--
+
+CREATE FUNCTION api.match_fiserv_payments(
+    start_date timestamp with time zone,
+    end_date timestamp with time zone,
+    tolerance interval DEFAULT NULL
+) RETURNS int
+    LANGUAGE sql
+    AS $$
+    WITH matches AS (
+        SELECT f.id, m.flowbird_id
+        FROM api.fiserv_reports_raw f
+        CROSS JOIN LATERAL (
+            SELECT c.flowbird_id
+            FROM (
+                (
+                    SELECT p.id AS flowbird_id, f.transaction_date - p.transaction_date AS distance, 0 AS side
+                    FROM api.flowbird_payments_raw p
+                    WHERE p.invoice_id = f.invoice_id
+                        AND p.transaction_date <= f.transaction_date
+                        AND p.updated_at BETWEEN start_date AND end_date
+                    ORDER BY p.transaction_date DESC, p.id DESC
+                    LIMIT 1
+                )
+                UNION ALL
+                (
+                    SELECT p.id, p.transaction_date - f.transaction_date, 1
+                    FROM api.flowbird_payments_raw p
+                    WHERE p.invoice_id = f.invoice_id
+                        AND p.transaction_date > f.transaction_date
+                        AND p.updated_at BETWEEN start_date AND end_date
+                    ORDER BY p.transaction_date, p.id
+                    LIMIT 1
+                )
+            ) c
+            WHERE tolerance IS NULL OR c.distance <= tolerance
+            -- like merge_asof, the earlier payment wins a tie
+            ORDER BY c.distance, c.side
+            LIMIT 1
+        ) m
+        WHERE f.flowbird_id IS NULL
+            AND f.invoice_id IS NOT NULL
+            AND f.transaction_date IS NOT NULL
+    ), updated AS (
+        UPDATE api.fiserv_reports_raw f
+        SET flowbird_id = matches.flowbird_id
+        FROM matches
+        WHERE f.id = matches.id
+        RETURNING 1
+    )
+    SELECT count(*)::int FROM updated;
+$$;
+
+
+ALTER FUNCTION api.match_fiserv_payments(timestamp with time zone, timestamp with time zone, interval) OWNER TO postgres;
+
+GRANT EXECUTE ON FUNCTION api.match_fiserv_payments(timestamp with time zone, timestamp with time zone, interval) TO my_api_user;
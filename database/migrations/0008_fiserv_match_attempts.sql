@@ -0,0 +1,37 @@
+--
+-- Track how many times match_field_processing.py has tried to match each Fiserv row
+--
+-- Kept out of fiserv_reports_raw so counting an attempt doesn't bump the row's
+-- updated_at (and republish it to Socrata).
+--
+
+CREATE TABLE api.fiserv_match_attempts (
+  "id" text PRIMARY KEY REFERENCES api.fiserv_reports_raw (id) ON DELETE CASCADE,
+  "attempts" int NOT NULL,
+  "updated_at" timestamp with time zone DEFAULT now() NOT NULL
+);
+
+CREATE TRIGGER set_updated_at BEFORE INSERT OR UPDATE ON api.fiserv_match_attempts FOR EACH ROW EXECUTE FUNCTION public.trigger_set_updated_at();
+
+--
+-- Name: fiserv_unmatched; Type: VIEW; Schema: api; Owner: postgres
+-- Fiserv rows which can still be matched, with the number of attempts so far.
+-- Paging through it by id uses fiserv_reports_raw_unmatched_idx.
+--
+
+CREATE VIEW api.fiserv_unmatched AS
+SELECT
+    f.id,
+    f.invoice_id,
+    f.transaction_date,
+    coalesce(a.attempts, 0) AS match_attempts
+FROM api.fiserv_reports_raw f
+LEFT JOIN api.fiserv_match_attempts a ON a.id = f.id
+WHERE f.flowbird_id IS NULL
+    AND f.invoice_id IS NOT NULL
+    AND f.transaction_date IS NOT NULL;
+
+ALTER VIEW api.fiserv_unmatched OWNER TO postgres;
+
+GRANT ALL ON TABLE api.fiserv_match_attempts TO my_api_user;
+GRANT SELECT ON TABLE api.fiserv_unmatched TO my_api_user;
@@ -0,0 +1,8 @@
+--
+-- Columns the loaders send which the original schema doesn't have: payments_s3.py
+-- sends a location_name with each payment and fiserv_DB.py a card_type with each
+-- record. Databases made from init.sql and these migrations (like the one in
+-- docker-compose.bench.yml) couldn't load either without them.
+--
+ALTER TABLE api.flowbird_payments_raw ADD COLUMN IF NOT EXISTS "location_name" text;
+ALTER TABLE api.fiserv_reports_raw ADD COLUMN IF NOT EXISTS "card_type" text;
@@ -0,0 +1,60 @@
+--
+-- Hash records for Socrata change detection in postgres, replacing published_hashes()
+--
+-- parking_socrata.py used to hash each page of records itself and look up the hashes
+-- they were last published with in a second request. changed_records() does both
+-- while reading the page, so only new or changed records come over the wire.
+-- Its hashes differ from the ones parking_socrata.py made, so every record is
+-- published once more on the first run after this migration.
+--
+
+DROP FUNCTION api.published_hashes(text, text[]);
+
+--
+-- Name: changed_records(text, timestamp with time zone, timestamp with time zone, text, int, boolean); Type: FUNCTION; Schema: api; Owner: postgres
+-- A page of the records of an api table updated between start_date and end_date
+-- (inclusive) whose contents, without updated_at, hash differently than when they were
+-- last published to Socrata, ordered by id after after_id. Every record is returned
+-- with include_unchanged.
+--
+
+CREATE FUNCTION api.changed_records(
+    dataset text,
+    start_date timestamp with time zone,
+    end_date timestamp with time zone,
+    after_id text DEFAULT NULL,
+    page_size int DEFAULT 1000,
+    include_unchanged boolean DEFAULT false
+) RETURNS TABLE (row_hash text, record jsonb)
+    LANGUAGE plpgsql STABLE
+    AS $$
+DECLARE
+    id_type text;
+BEGIN
+    -- ids are text for fiserv_reports_raw and numeric elsewhere, after_id is compared
+    -- as the id's own type so the page order is the id index's
+    SELECT format_type(a.atttypid, a.atttypmod) INTO id_type
+    FROM pg_attribute a
+    WHERE a.attrelid = format('api.%I', dataset)::regclass AND a.attname = 'id';
+
+    RETURN QUERY EXECUTE format(
+        'SELECT h.row_hash, h.record
+        FROM (
+            SELECT t.id, to_jsonb(t) AS record, md5((to_jsonb(t) - %L)::text) AS row_hash
+            FROM api.%I t
+            WHERE t.updated_at BETWEEN $1 AND $2
+                AND ($3 IS NULL OR t.id > $3::%s)
+        ) h
+        LEFT JOIN api.socrata_publish_state s ON s.dataset = $4 AND s.row_id = h.id::text
+        WHERE $5 OR s.row_hash IS DISTINCT FROM h.row_hash
+        ORDER BY h.id
+        LIMIT $6',
+        'updated_at', dataset, id_type
+    )
+    USING start_date, end_date, after_id, dataset, include_unchanged, page_size;
+END; $$;
+
+
+ALTER FUNCTION api.changed_records(text, timestamp with time zone, timestamp with time zone, text, int, boolean) OWNER TO postgres;
+
+GRANT EXECUTE ON FUNCTION api.changed_records(text, timestamp with time zone, timestamp with time zone, text, int, boolean) TO my_api_user;
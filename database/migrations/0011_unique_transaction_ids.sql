@@ -0,0 +1,57 @@
+--
+-- Keep id unique in the tables partitioned on start_time
+--
+-- Their primary keys are (id, start_time), so a transaction whose start_time changed
+-- upstream was upserted as a second row next to the old one. That broke the Socrata
+-- row identifier, paging by id and the daily rollup, which counted it on both days.
+-- A unique index on id alone isn't possible on a table partitioned on start_time, so
+-- the old row is deleted when the new one is inserted, by a trigger 0014 creates on
+-- each partition.
+--
+
+-- Rows already duplicated: keep the one updated last
+DELETE FROM api.flowbird_transactions_raw t
+USING api.flowbird_transactions_raw newer
+WHERE newer.id = t.id
+    AND (newer.updated_at, newer.start_time) > (t.updated_at, t.start_time);
+
+-- Days which lost transactions to another day, until the rollup next refreshes. The
+-- days of the rows deleted here are the first, 0012 queues them when a row moves.
+CREATE TABLE public.rollup_stale_days (
+  "day" date PRIMARY KEY
+);
+
+GRANT SELECT, INSERT ON TABLE public.rollup_stale_days TO my_api_user;
+
+WITH deleted AS (
+    DELETE FROM api.transactions t
+    USING api.transactions newer
+    WHERE newer.id = t.id
+        AND (newer.updated_at, newer.start_time) > (t.updated_at, t.start_time)
+    RETURNING t.start_time
+)
+INSERT INTO public.rollup_stale_days (day)
+SELECT DISTINCT start_time::date FROM deleted
+ON CONFLICT (day) DO NOTHING;
+
+-- Finding a transaction's other rows by id looks in every partition
+CREATE INDEX flowbird_transactions_raw_id_idx ON api.flowbird_transactions_raw (id);
+CREATE INDEX transactions_id_idx ON api.transactions (id);
+
+
+--
+-- Name: delete_moved_flowbird_transaction(); Type: FUNCTION; Schema: public; Owner: postgres
+-- Deletes the row a transaction had before its start_time changed. Upserts with an
+-- unchanged start_time conflict on the primary key as before and delete nothing.
+--
+
+CREATE FUNCTION public.delete_moved_flowbird_transaction() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$ BEGIN
+    DELETE FROM api.flowbird_transactions_raw
+    WHERE id = NEW.id AND start_time <> NEW.start_time;
+    RETURN NEW;
+END; $$;
+
+
+ALTER FUNCTION public.delete_moved_flowbird_transaction() OWNER TO postgres;
@@ -0,0 +1,147 @@
+--
+-- Move api.transactions rows when the raw row's start_time changes
+--
+-- The triggers from 0005 upsert on (id, start_time), so a raw row with a new
+-- start_time was inserted into api.transactions next to the stale row. The stale
+-- row is now deleted first, keeping one row per id, and its day is queued in
+-- public.rollup_stale_days (0011) for the daily rollup, which would otherwise go on
+-- counting it there.
+--
+
+--
+-- Name: flowbird_to_transactions(); Type: FUNCTION; Schema: public; Owner: postgres
+-- An upserted meter row with a new start_time is inserted into flowbird_transactions_raw,
+-- which has already deleted its old row, so the stale row is found by id.
+--
+
+CREATE OR REPLACE FUNCTION public.flowbird_to_transactions() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$ BEGIN
+    WITH moved AS (
+        DELETE FROM api.transactions t
+        USING changed_rows n
+        WHERE t.id = n.id AND t.start_time <> n.start_time
+        RETURNING t.start_time
+    )
+    INSERT INTO public.rollup_stale_days (day)
+    SELECT DISTINCT start_time::date FROM moved
+    ON CONFLICT (day) DO NOTHING;
+
+    INSERT INTO api.transactions (
+        id, source, payment_method, meter_id, duration_min, start_time, end_time, amount, location_name
+    )
+    SELECT
+        id, 'Parking Meters', payment_method, meter_id, duration_min, start_time, end_time, amount, location_name
+    FROM changed_rows
+    ON CONFLICT (id, start_time) DO UPDATE SET
+        source = EXCLUDED.source,
+        payment_method = EXCLUDED.payment_method,
+        meter_id = EXCLUDED.meter_id,
+        duration_min = EXCLUDED.duration_min,
+        end_time = EXCLUDED.end_time,
+        amount = EXCLUDED.amount,
+        location_name = EXCLUDED.location_name;
+    RETURN NULL;
+END; $$;
+
+
+--
+-- Name: passport_to_transactions(); Type: FUNCTION; Schema: public; Owner: postgres
+-- passport_transactions_raw isn't partitioned, a new start_time is an update there and
+-- the stale row is the one with the old start_time. The old_rows transition table is
+-- only referenced on update, the insert trigger doesn't have one.
+--
+
+CREATE OR REPLACE FUNCTION public.passport_to_transactions() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$ BEGIN
+    IF TG_OP = 'UPDATE' THEN
+        WITH moved AS (
+            DELETE FROM api.transactions t
+            USING old_rows o
+            JOIN changed_rows n ON n.id = o.id
+            WHERE t.id = o.id AND t.start_time = o.start_time AND n.start_time <> o.start_time
+            RETURNING t.start_time
+        )
+        INSERT INTO public.rollup_stale_days (day)
+        SELECT DISTINCT start_time::date FROM moved
+        ON CONFLICT (day) DO NOTHING;
+    ELSE
+        WITH moved AS (
+            DELETE FROM api.transactions t
+            USING changed_rows n
+            WHERE t.id = n.id AND t.start_time <> n.start_time
+            RETURNING t.start_time
+        )
+        INSERT INTO public.rollup_stale_days (day)
+        SELECT DISTINCT start_time::date FROM moved
+        ON CONFLICT (day) DO NOTHING;
+    END IF;
+
+    INSERT INTO api.transactions (
+        id, source, payment_method, zone_id, zone_group, duration_min, start_time, end_time, amount, location_name
+    )
+    SELECT
+        id, source, payment_method, zone_id, zone_group, duration_min, start_time, end_time, amount, location_name
+    FROM changed_rows
+    ON CONFLICT (id, start_time) DO UPDATE SET
+        source = EXCLUDED.source,
+        payment_method = EXCLUDED.payment_method,
+        zone_id = EXCLUDED.zone_id,
+        zone_group = EXCLUDED.zone_group,
+        duration_min = EXCLUDED.duration_min,
+        end_time = EXCLUDED.end_time,
+        amount = EXCLUDED.amount,
+        location_name = EXCLUDED.location_name;
+    RETURN NULL;
+END; $$;
+
+DROP TRIGGER passport_to_transactions_update ON api.passport_transactions_raw;
+CREATE TRIGGER passport_to_transactions_update AFTER UPDATE ON api.passport_transactions_raw
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS changed_rows
+    FOR EACH STATEMENT EXECUTE FUNCTION public.passport_to_transactions();
+
+
+--
+-- Name: refresh_transactions_daily(); Type: FUNCTION; Schema: api; Owner: postgres
+-- As before, plus the days queued in rollup_stale_days.
+--
+
+CREATE OR REPLACE FUNCTION api.refresh_transactions_daily() RETURNS int
+    LANGUAGE plpgsql
+    SECURITY DEFINER
+    SET search_path = public, pg_temp
+    AS $$
+DECLARE
+    since timestamp with time zone;
+    days date[];
+    changed int;
+BEGIN
+    -- One refresh at a time, the next one waits and picks up from this watermark
+    PERFORM pg_advisory_xact_lock(hashtext('api.refresh_transactions_daily'));
+
+    SELECT watermark INTO since FROM public.rollup_watermarks WHERE name = 'transactions_daily';
+
+    -- Rows from loads which started before the last refresh but committed after it
+    -- have an updated_at before the watermark, so look back a bit further. Days are
+    -- recomputed from scratch so going over them twice does no harm.
+    WITH stale AS (
+        DELETE FROM public.rollup_stale_days RETURNING day
+    )
+    SELECT array_agg(DISTINCT day) INTO days
+    FROM (
+        SELECT start_time::date AS day
+        FROM api.transactions
+        WHERE updated_at > coalesce(since - interval '1 hour', '-infinity')
+        UNION
+        SELECT day FROM stale
+    ) d;
+
+    changed := public.rollup_transactions_days(coalesce(days, '{}'));
+
+    INSERT INTO public.rollup_watermarks (name, watermark)
+    VALUES ('transactions_daily', now())
+    ON CONFLICT (name) DO UPDATE SET watermark = EXCLUDED.watermark;
+
+    RETURN changed;
+END; $$;
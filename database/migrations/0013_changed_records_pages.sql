@@ -0,0 +1,67 @@
+--
+-- Hash only the records of the page in changed_records()
+--
+-- 0010 hashed every record after after_id before applying the page's LIMIT, since
+-- the unchanged ones were filtered out first. Each page cost as much as the rest of
+-- the table, and publishing all of it was quadratic. The page's ids are now picked
+-- first, which the primary key index does without hashing anything, and only they
+-- are hashed. A page can then be all unchanged records, so every id in it is returned
+-- for paging, with the record only when it's changed. The hashes are the same as
+-- 0010's, nothing is republished.
+--
+
+DROP FUNCTION api.changed_records(text, timestamp with time zone, timestamp with time zone, text, int, boolean);
+
+--
+-- Name: changed_records(text, timestamp with time zone, timestamp with time zone, text, int, boolean); Type: FUNCTION; Schema: api; Owner: postgres
+-- A page of page_size records of an api table updated between start_date and end_date
+-- (inclusive), ordered by id after after_id. The record is null when its contents,
+-- without updated_at, hash the same as when it was last published to Socrata, unless
+-- include_unchanged is set. A page shorter than page_size is the last one.
+--
+
+CREATE FUNCTION api.changed_records(
+    dataset text,
+    start_date timestamp with time zone,
+    end_date timestamp with time zone,
+    after_id text DEFAULT NULL,
+    page_size int DEFAULT 1000,
+    include_unchanged boolean DEFAULT false
+) RETURNS TABLE (row_id text, row_hash text, record jsonb)
+    LANGUAGE plpgsql STABLE
+    AS $$
+DECLARE
+    id_type text;
+BEGIN
+    -- ids are text for fiserv_reports_raw and numeric elsewhere, after_id is compared
+    -- as the id's own type so the page order is the id index's
+    SELECT format_type(a.atttypid, a.atttypmod) INTO id_type
+    FROM pg_attribute a
+    WHERE a.attrelid = format('api.%I', dataset)::regclass AND a.attname = 'id';
+
+    RETURN QUERY EXECUTE format(
+        'WITH page AS (
+            SELECT t.*
+            FROM api.%I t
+            WHERE t.updated_at BETWEEN $1 AND $2
+                AND ($3 IS NULL OR t.id > $3::%s)
+            ORDER BY t.id
+            LIMIT $6
+        ), hashed AS (
+            SELECT p.id, to_jsonb(p) AS record, md5((to_jsonb(p) - %L)::text) AS row_hash
+            FROM page p
+        )
+        SELECT h.id::text, h.row_hash,
+            CASE WHEN $5 OR s.row_hash IS DISTINCT FROM h.row_hash THEN h.record END
+        FROM hashed h
+        LEFT JOIN api.socrata_publish_state s ON s.dataset = $4 AND s.row_id = h.id::text
+        ORDER BY h.id',
+        dataset, id_type, 'updated_at'
+    )
+    USING start_date, end_date, after_id, dataset, include_unchanged, page_size;
+END; $$;
+
+
+ALTER FUNCTION api.changed_records(text, timestamp with time zone, timestamp with time zone, text, int, boolean) OWNER TO postgres;
+
+GRANT EXECUTE ON FUNCTION api.changed_records(text, timestamp with time zone, timestamp with time zone, text, int, boolean) TO my_api_user;
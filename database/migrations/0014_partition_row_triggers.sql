@@ -0,0 +1,107 @@
+--
+-- Create the row triggers of the tables partitioned on start_time on their partitions
+--
+-- Postgres 12, which production runs, can't create BEFORE ... FOR EACH ROW triggers on
+-- a partitioned table, only on its partitions. 0004 and 0011 no longer create
+-- set_updated_at and delete_moved_transaction on api.transactions and
+-- api.flowbird_transactions_raw. They're created here on every partition, and by
+-- create_monthly_partition() on the partitions it adds. Databases on Postgres 13 or
+-- later which applied the earlier 0004 and 0011 have them on the tables, which clones
+-- them to the partitions, so those are dropped first.
+--
+
+DROP TRIGGER IF EXISTS set_updated_at ON api.transactions;
+DROP TRIGGER IF EXISTS set_updated_at ON api.flowbird_transactions_raw;
+DROP TRIGGER IF EXISTS delete_moved_transaction ON api.flowbird_transactions_raw;
+
+
+--
+-- Name: create_partition_triggers(regclass, regclass); Type: FUNCTION; Schema: public; Owner: postgres
+-- Creates the row triggers of a partition of api.transactions or
+-- api.flowbird_transactions_raw.
+--
+
+CREATE FUNCTION public.create_partition_triggers(parent regclass, partition regclass) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    EXECUTE format(
+        'CREATE TRIGGER set_updated_at BEFORE INSERT OR UPDATE ON %s
+        FOR EACH ROW EXECUTE FUNCTION public.trigger_set_updated_at()',
+        partition
+    );
+
+    IF parent = 'api.flowbird_transactions_raw'::regclass THEN
+        EXECUTE format(
+            'CREATE TRIGGER delete_moved_transaction BEFORE INSERT ON %s
+            FOR EACH ROW EXECUTE FUNCTION public.delete_moved_flowbird_transaction()',
+            partition
+        );
+    END IF;
+END; $$;
+
+
+ALTER FUNCTION public.create_partition_triggers(regclass, regclass) OWNER TO postgres;
+
+
+--
+-- Name: create_monthly_partition(regclass, date); Type: FUNCTION; Schema: public; Owner: postgres
+-- Creates the partition of a table partitioned on start_time for the month of for_month,
+-- moving any of its rows out of the default partition first. Does nothing if it exists.
+-- The partition's triggers are created after the rows are moved so they keep their
+-- updated_at.
+--
+
+CREATE OR REPLACE FUNCTION public.create_monthly_partition(parent regclass, for_month date) RETURNS void
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    parent_schema text;
+    parent_name text;
+    partition_name text;
+    default_partition regclass;
+    month_start timestamp := date_trunc('month', for_month);
+    month_end timestamp := date_trunc('month', for_month) + interval '1 month';
+BEGIN
+    SELECT n.nspname, c.relname INTO parent_schema, parent_name
+    FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+    WHERE c.oid = parent;
+
+    partition_name := format('%s_%s', parent_name, to_char(month_start, 'YYYY_MM'));
+    IF to_regclass(format('%I.%I', parent_schema, partition_name)) IS NOT NULL THEN
+        RETURN;
+    END IF;
+
+    EXECUTE format(
+        'CREATE TABLE %I.%I (LIKE %s INCLUDING DEFAULTS)',
+        parent_schema, partition_name, parent
+    );
+
+    -- A partition can't be attached while the default partition holds rows for it
+    SELECT i.inhrelid::regclass INTO default_partition
+    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+    WHERE i.inhparent = parent AND pg_get_expr(c.relpartbound, c.oid) = 'DEFAULT';
+
+    IF default_partition IS NOT NULL THEN
+        EXECUTE format(
+            'WITH moved AS (DELETE FROM %s WHERE start_time >= %L AND start_time < %L RETURNING *)
+            INSERT INTO %I.%I SELECT * FROM moved',
+            default_partition, month_start, month_end, parent_schema, partition_name
+        );
+    END IF;
+
+    PERFORM public.create_partition_triggers(
+        parent, format('%I.%I', parent_schema, partition_name)::regclass
+    );
+
+    EXECUTE format(
+        'ALTER TABLE %s ATTACH PARTITION %I.%I FOR VALUES FROM (%L) TO (%L)',
+        parent, parent_schema, partition_name, month_start, month_end
+    );
+END; $$;
+
+
+-- The existing partitions, default ones included
+SELECT public.create_partition_triggers(i.inhparent::regclass, i.inhrelid::regclass)
+FROM pg_inherits i
+WHERE i.inhparent IN ('api.transactions'::regclass, 'api.flowbird_transactions_raw'::regclass);
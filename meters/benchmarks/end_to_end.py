@@ -0,0 +1,414 @@
+"""Run the pipeline end to end on synthetic data against local stand-ins of its services,
+and report the throughput of each stage:
+
+    fetch    Flowbird and Passport reports from the mock APIs to S3
+    email    Fiserv report emails decrypted to S3
+    load     Every loader, S3 to postgres
+    match    Fiserv records matched to Flowbird payments
+    publish  Changed records published to the mock Socrata
+
+Each stage runs the scripts the way they run in production, with the environment this
+is run with. The Fiserv emails settle the payments fetched from Flowbird, so most of
+them have a match. Meant to be run by the bench profile of
+database/docker-compose.bench.yml, see the README.
+
+    $ python benchmarks/end_to_end.py --reset --executor threads --match-args=--in-database
+"""
+import argparse
+import base64
+from datetime import datetime, timedelta, timezone
+import hashlib
+import hmac
+import json
+import os
+import shlex
+import subprocess
+import sys
+import time
+
+from botocore.exceptions import ClientError
+import pandas as pd
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import bulk_load
+import fiserv_DB
+import payments_s3
+import pipeline
+import synthetic
+
+FSRV_EMAIL = os.getenv("FSRV_EMAIL")
+ENCRYPTION_KEY = os.getenv("FSRV_ENCRYPTION")
+MOCK_APIS_URL = os.getenv("MOCK_APIS_URL", "http://localhost:8000")
+# PostgREST's secret, which the scripts' token is signed with when POSTGREST_TOKEN isn't set
+PGRST_JWT_SECRET = os.getenv("PGRST_JWT_SECRET")
+
+# The role the scripts use PostgREST as
+POSTGREST_ROLE = "my_api_user"
+
+METERS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+# Where fiserv_email_pub.py picks up new emails
+INBOX_PREFIX = "emails/new/"
+
+# The synthetic data is all in one month
+MONTH = [(synthetic.START.year, synthetic.START.month)]
+
+STAGES = ["fetch", "email", "load", "match", "publish"]
+
+# The loaders which can load with COPY
+BULK_LOADERS = ["smartfolio_s3.py", "payments_s3.py", "passport_DB.py"]
+
+# Emptied by --reset
+TABLES = [
+    "api.transactions",
+    "api.transactions_daily",
+    "api.flowbird_transactions_raw",
+    "api.flowbird_payments_raw",
+    "api.passport_transactions_raw",
+    "api.fiserv_reports_raw",
+    "api.fiserv_match_attempts",
+    "api.socrata_publish_state",
+    "api.socrata_batch_sizes",
+    "public.rollup_watermarks",
+    "public.rollup_stale_days",
+]
+
+
+def postgrest_token(secret, role=POSTGREST_ROLE):
+    """A JWT for the role, signed with HS256 as PostgREST expects"""
+
+    def encode(data):
+        return base64.urlsafe_b64encode(data).rstrip(b"=")
+
+    def segment(claims):
+        return encode(json.dumps(claims, separators=(",", ":")).encode())
+
+    header = segment({"alg": "HS256", "typ": "JWT"})
+    payload = segment({"role": role})
+    signature = hmac.new(secret.encode(), header + b"." + payload, hashlib.sha256)
+    return b".".join([header, payload, encode(signature.digest())]).decode()
+
+
+def mock_rows(api):
+    """Rows the mock API has served or received since it was last reset"""
+    res = requests.get(f"{MOCK_APIS_URL}/stats")
+    res.raise_for_status()
+    return res.json()[api]["rows"]
+
+
+def table_rows(conn, table, where="true"):
+    with conn.cursor() as cur:
+        cur.execute(f"SELECT count(*) FROM {table} WHERE {where}")
+        return cur.fetchone()[0]
+
+
+def report_rows(client):
+    """Rows in the Fiserv reports fiserv_email_pub.py has decrypted to S3"""
+    rows = 0
+    for key in pipeline.list_files(fiserv_DB.LOADERS["transactions"], MONTH, client):
+        body = client.get_object(Bucket=pipeline.BUCKET_NAME, Key=key)["Body"]
+        # Less the header
+        rows += sum(1 for _ in body.iter_lines()) - 1
+    return rows
+
+
+def reset(conn, client):
+    """Empties the tables, the bucket and the mock APIs' stats"""
+    with conn.cursor() as cur:
+        cur.execute(f"TRUNCATE {', '.join(TABLES)}")
+
+    paginator = client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=pipeline.BUCKET_NAME):
+        keys = [{"Key": content["Key"]} for content in page.get("Contents", [])]
+        if keys:
+            client.delete_objects(
+                Bucket=pipeline.BUCKET_NAME, Delete={"Objects": keys, "Quiet": True}
+            )
+
+    res = requests.post(f"{MOCK_APIS_URL}/reset")
+    res.raise_for_status()
+
+
+def prepare(conn, client, args):
+    """Creates the bucket if it's missing and resets everything with --reset. PostgREST
+    is told to reload its schema, as the migrations may have just run."""
+    try:
+        client.head_bucket(Bucket=pipeline.BUCKET_NAME)
+    except ClientError:
+        client.create_bucket(Bucket=pipeline.BUCKET_NAME)
+
+    if args.reset:
+        reset(conn, client)
+
+    with conn.cursor() as cur:
+        cur.execute("NOTIFY pgrst, 'reload schema'")
+
+
+def send_emails(client):
+    """Sends a Fiserv email for each day of the fetched payments to the inbox, with a
+    report settling the day's completed payments
+
+    Returns:
+        int: Number of emails
+    """
+    loader = payments_s3.get_loader("atd")
+    files = pipeline.list_files(loader, MONTH, client)
+    payments = pd.concat(
+        pd.read_csv(client.get_object(Bucket=pipeline.BUCKET_NAME, Key=key)["Body"])
+        for key in files
+    )
+    payments = payments[
+        (payments["TRANSACTION_STATUS"] == "COMPLETED")
+        & payments["MONETRA_ID"].notna()
+    ]
+
+    days = pd.to_datetime(
+        payments["TRANSACTION_DATE"], format=synthetic.SMARTFOLIO_DATE_FORMAT
+    ).dt.normalize()
+    for day, day_payments in payments.groupby(days):
+        # The seed sets the day the email is sent
+        seed = (day - synthetic.START).days
+        email = synthetic.fiserv_email(
+            0,
+            seed,
+            password=ENCRYPTION_KEY,
+            sender=FSRV_EMAIL,
+            payments=day_payments,
+        )
+        client.put_object(
+            Body=email,
+            Bucket=pipeline.BUCKET_NAME,
+            Key=f"{INBOX_PREFIX}bench-{day.date()}",
+        )
+    return days.nunique()
+
+
+def get_steps(conn, client, args):
+    """The scripts each stage runs
+
+    Returns:
+        list: (stage, script arguments, function counting the stage's rows, function run
+            untimed before it or None) of each step. The rows of a step are how much the
+            count went up while it ran.
+    """
+    start = synthetic.START
+    end = start + timedelta(days=args.days - 1)
+    fetch_dates = ["--start", f"{start:%Y-%m-%d}", "--end", f"{end:%Y-%m-%d}"]
+
+    # The updated_at of everything loaded is today
+    today = datetime.now(timezone.utc).date()
+    updated = ["--start", f"{today}", "--end", f"{today + timedelta(days=1)}"]
+
+    load_args = ["--year", f"{start.year}", "--month", f"{start.month}"]
+    load_args += ["--executor", args.executor, "--workers", f"{args.workers}"]
+
+    def loaded(table):
+        return lambda: table_rows(conn, f"api.{table}")
+
+    def emails():
+        print(f"Sent {send_emails(client)} Fiserv emails")
+
+    steps = [
+        (
+            "fetch",
+            ["txn_history.py", "--report", "transactions", "-e", "prod"]
+            + fetch_dates,
+            lambda: mock_rows("flowbird"),
+            None,
+        ),
+        (
+            "fetch",
+            ["txn_history.py", "--report", "payments", "-e", "prod"] + fetch_dates,
+            lambda: mock_rows("flowbird"),
+            None,
+        ),
+        (
+            "fetch",
+            ["passport_txns.py", "-e", "prod"] + fetch_dates,
+            lambda: mock_rows("opsman"),
+            None,
+        ),
+        (
+            "email",
+            ["fiserv_email_pub.py"] + shlex.split(args.email_args),
+            lambda: report_rows(client),
+            # Once the payments the emails settle have been fetched
+            emails,
+        ),
+    ]
+
+    for script, table in [
+        ("smartfolio_s3.py", "flowbird_transactions_raw"),
+        ("payments_s3.py", "flowbird_payments_raw"),
+        ("passport_DB.py", "passport_transactions_raw"),
+        ("fiserv_DB.py", "fiserv_reports_raw"),
+    ]:
+        bulk = ["--bulk"] if args.bulk and script in BULK_LOADERS else []
+        steps.append(("load", [script] + load_args + bulk, loaded(table), None))
+
+    steps += [
+        (
+            "match",
+            ["match_field_processing.py"] + updated + shlex.split(args.match_args),
+            lambda: table_rows(
+                conn, "api.fiserv_reports_raw", "flowbird_id IS NOT NULL"
+            ),
+            None,
+        ),
+        (
+            "publish",
+            ["parking_socrata.py"] + updated + shlex.split(args.publish_args),
+            lambda: mock_rows("socrata"),
+            None,
+        ),
+    ]
+    return steps
+
+
+def run_step(argv, verbose):
+    """Runs a script, with its output shown if it fails or with --verbose
+
+    Returns:
+        float: Seconds it took
+    """
+    began = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable] + argv,
+        cwd=METERS_DIR,
+        stdout=None if verbose else subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    seconds = time.perf_counter() - began
+    if result.returncode != 0:
+        if not verbose:
+            print(result.stdout)
+        raise SystemExit(f"Failed: {' '.join(argv)}")
+    return seconds
+
+
+def rate(rows, seconds):
+    return rows / seconds if seconds else 0.0
+
+
+def run(conn, args):
+    """Runs the steps and prints, and with --save saves, their results"""
+    client = pipeline.get_s3_client()
+    prepare(conn, client, args)
+
+    print(f"{'stage':<8} {'script':<60} {'seconds':>8} {'rows':>9} {'rows/s':>10}")
+
+    results = []
+    for stage, argv, count, setup in get_steps(conn, client, args):
+        if setup:
+            setup()
+
+        before = count()
+        seconds = run_step(argv, args.verbose)
+        rows = count() - before
+        results.append(
+            {"stage": stage, "script": " ".join(argv), "seconds": seconds, "rows": rows}
+        )
+        print(
+            f"{stage:<8} {' '.join(argv)[:60]:<60} {seconds:>8.1f} {rows:>9} "
+            f"{rate(rows, seconds):>10,.1f}"
+        )
+
+    print()
+    print(f"{'stage':<8} {'seconds':>8} {'rows':>9} {'rows/s':>10}")
+    stages = {}
+    for stage in STAGES:
+        seconds = sum(r["seconds"] for r in results if r["stage"] == stage)
+        rows = sum(r["rows"] for r in results if r["stage"] == stage)
+        stages[stage] = {"seconds": seconds, "rows": rows}
+        print(f"{stage:<8} {seconds:>8.1f} {rows:>9} {rate(rows, seconds):>10,.1f}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {"args": vars(args), "steps": results, "stages": stages}, f, indent=2
+            )
+        print(f"Saved results to {args.save}")
+
+
+def main(args):
+    # The scripts inherit the environment
+    if not os.getenv("POSTGREST_TOKEN") and PGRST_JWT_SECRET:
+        os.environ["POSTGREST_TOKEN"] = postgrest_token(PGRST_JWT_SECRET)
+
+    conn = bulk_load.get_connection()
+    try:
+        # Without a transaction left open, which would hold locks the loaders need
+        conn.autocommit = True
+        run(conn, args)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--days",
+        type=int,
+        default=synthetic.DAYS,
+        help=f"Days of reports fetched from {synthetic.START:%Y-%m-%d}. Defaults to {synthetic.DAYS}",
+    )
+
+    parser.add_argument(
+        "--reset",
+        action="store_true",
+        help=f"Empty the tables, the bucket and the mock APIs' stats first. Only for a benchmark database and bucket",
+    )
+
+    parser.add_argument(
+        "--executor",
+        default="serial",
+        choices=pipeline.EXECUTORS,
+        help=f"The loaders' --executor. Defaults to serial",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help=f"The loaders' --workers. Defaults to 4",
+    )
+
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help=f"Load with COPY with the loaders which can ({', '.join(BULK_LOADERS)})",
+    )
+
+    parser.add_argument(
+        "--email-args",
+        default="",
+        help=f"Arguments for fiserv_email_pub.py, such as --email-args='--workers 4'",
+    )
+
+    parser.add_argument(
+        "--match-args",
+        default="",
+        help=f"Arguments for match_field_processing.py, such as --match-args=--in-database",
+    )
+
+    parser.add_argument(
+        "--publish-args",
+        default="",
+        help=f"Arguments for parking_socrata.py, such as --publish-args='--workers 4'",
+    )
+
+    parser.add_argument(
+        "--save", help=f"Save the results to this JSON file",
+    )
+
+    parser.add_argument(
+        "-v", "--verbose", action="store_true", help=f"Show the scripts' output",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
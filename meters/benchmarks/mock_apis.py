@@ -0,0 +1,279 @@
+"""Local stand-ins for the Flowbird, OpsMan and Socrata APIs, serving synthetic reports
+and accepting Socrata upserts, with configurable latency and rate limits.
+
+    $ python benchmarks/mock_apis.py --port 8000 --rows 1000 --latency 0.2 --rate-limit 5
+
+Point the scripts at it with:
+
+    ENDPOINT=http://localhost:8000/flowbird
+    OPS_MAN_URL=http://localhost:8000/opsman
+    SO_WEB=http://localhost:8000
+
+GET /stats returns the requests and rows each API has served or received, POST /reset
+sets them back to zero.
+"""
+import argparse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import sys
+import threading
+import time
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import synthetic
+from txn_history import HEADER_ROW_LENGTH
+
+APIS = ["flowbird", "opsman", "socrata"]
+
+# The columns the real reports have which the fetch scripts drop
+FLOWBIRD_FORBIDDEN = {
+    "transaction_history": ["PLATE_NUMBER", "CARD_SERIAL_NUMBER"],
+    "archipel_transactionspub": ["PAN_HIDDEN"],
+}
+OPSMAN_FORBIDDEN = ["Customer ID", "Space/LPN"]
+
+
+class RateLimit:
+    """Spaces out an API's requests to at most rate a second. Requests over the limit
+    wait for their turn, like a throttled API, rather than failing."""
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_slot = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+class Stats:
+    """Requests and rows of each API since the last reset"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = {api: {"requests": 0, "rows": 0} for api in APIS}
+
+    def add(self, api, rows):
+        with self.lock:
+            self.counts[api]["requests"] += 1
+            self.counts[api]["rows"] += rows
+
+    def get(self):
+        with self.lock:
+            return json.loads(json.dumps(self.counts))
+
+
+def by_day(df, column, date_format):
+    """Splits a month of generated rows into days, keyed by date"""
+    days = pd.to_datetime(df[column], format=date_format).dt.date
+    return {day: rows.reset_index(drop=True) for day, rows in df.groupby(days)}
+
+
+def flowbird_report(df, report):
+    """A day of a Flowbird report as the endpoint returns it: with the columns
+    txn_history.py drops, and at least as long a header as txn_history.py checks for"""
+    df = df.assign(**{column: "x" for column in FLOWBIRD_FORBIDDEN[report]})
+    padding = 0
+    while len(",".join(df.columns)) < HEADER_ROW_LENGTH:
+        padding += 1
+        df[f"UNUSED_{padding}"] = ""
+    return df.to_csv(index=False)
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Set by main()
+    reports = None
+    limits = None
+    stats = None
+    latency = 0.0
+    row_latency = 0.0
+
+    def log_message(self, format, *args):
+        # One line per request would drown out the benchmark's output
+        pass
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return self.rfile.read(length)
+
+    def respond(self, status, body, content_type="application/json", headers=None):
+        body = body.encode() if isinstance(body, str) else body
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers or []:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def delay(self, api, rows):
+        """Waits for the API's rate limit, then for its latency"""
+        self.limits[api].wait()
+        time.sleep(self.latency + self.row_latency * rows)
+        self.stats.add(api, rows)
+
+    def get_day(self, report, day):
+        """A report's rows for a day, none outside the month"""
+        days = self.reports[report]
+        return days.get(day, next(iter(days.values())).iloc[0:0])
+
+    def do_GET(self):
+        if urlparse(self.path).path == "/stats":
+            self.respond(200, json.dumps(self.stats.get()))
+        else:
+            self.respond(404, json.dumps({"error": "not found"}))
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        body = self.read_body()
+
+        if path == "/reset":
+            self.stats.reset()
+            self.respond(200, json.dumps(self.stats.get()))
+        elif path == "/flowbird":
+            self.flowbird(parse_qs(body.decode()))
+        elif path == "/opsman/index.php/login":
+            self.delay("opsman", 0)
+            self.respond(
+                200,
+                json.dumps({"success": True}),
+                headers=[
+                    ("Set-Cookie", "omsessiondata=local; Path=/"),
+                    ("Set-Cookie", "PHPSESSID=local; Path=/"),
+                ],
+            )
+        elif path == "/opsman/reports_index.php/runcustomreport":
+            self.opsman(json.loads(body))
+        elif path.startswith("/resource/") and path.endswith(".json"):
+            rows = len(json.loads(body))
+            self.delay("socrata", rows)
+            self.respond(
+                200,
+                json.dumps(
+                    {
+                        "Errors": 0,
+                        "Rows Created": rows,
+                        "Rows Updated": 0,
+                        "Rows Deleted": 0,
+                    }
+                ),
+            )
+        else:
+            self.respond(404, json.dumps({"error": "not found"}))
+
+    def flowbird(self, form):
+        """A day of transaction_history or archipel_transactionspub, as CSV"""
+        report = form["report"][0]
+        start = form.get("startdate", form.get("startdatetime"))[0]
+        day = pd.to_datetime(start, format="%Y%m%d%H%M%S").date()
+        df = self.get_day(report, day)
+        self.delay("flowbird", len(df))
+        self.respond(200, flowbird_report(df, report), content_type="text/csv")
+
+    def opsman(self, payload):
+        """A page of a day of the Passport report"""
+        day = pd.to_datetime(payload["startdate"], format="%m/%d/%Y").date()
+        df = self.get_day("passport", day)
+        page = df.iloc[payload["start"] : payload["start"] + payload["count"]]
+        page = page.assign(**{column: "x" for column in OPSMAN_FORBIDDEN})
+        self.delay("opsman", len(page))
+        self.respond(
+            200,
+            json.dumps(
+                {"data": json.loads(page.to_json(orient="records")), "count": len(df)}
+            ),
+        )
+
+
+def generate(rows, seed):
+    """A month of each report, split into days"""
+    month_rows = rows * synthetic.DAYS
+    reports = {
+        "transaction_history": by_day(
+            synthetic.transaction_history(month_rows, seed),
+            "METER_DATE",
+            synthetic.SMARTFOLIO_DATE_FORMAT,
+        ),
+        "archipel_transactionspub": by_day(
+            synthetic.archipel_transactionspub(month_rows, seed),
+            "TRANSACTION_DATE",
+            synthetic.SMARTFOLIO_DATE_FORMAT,
+        ),
+        "passport": by_day(
+            synthetic.passport_report(month_rows, seed),
+            "Entry Time",
+            synthetic.PASSPORT_DATE_FORMAT,
+        ),
+    }
+    return reports
+
+
+def main(args):
+    Handler.reports = generate(args.rows, args.seed)
+    Handler.limits = {api: RateLimit(args.rate_limit) for api in APIS}
+    Handler.stats = Stats()
+    Handler.latency = args.latency
+    Handler.row_latency = args.row_latency
+
+    server = ThreadingHTTPServer(("", args.port), Handler)
+    print(f"Serving {args.rows} rows a day of each report on port {args.port}")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--port", type=int, default=8000, help=f"Defaults to 8000",
+    )
+
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=1000,
+        help=f"Rows a day in each report, before duplicates. Defaults to 1000",
+    )
+
+    parser.add_argument(
+        "--seed", type=int, default=0, help=f"Random seed. Defaults to 0",
+    )
+
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help=f"Seconds added to every response. Defaults to 0",
+    )
+
+    parser.add_argument(
+        "--row-latency",
+        type=float,
+        default=0.0,
+        help=f"Seconds added to a response for each row served or upserted. Defaults to 0",
+    )
+
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        default=0.0,
+        help=f"Requests a second each API handles, the rest wait. Defaults to 0, no limit",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,123 @@
+"""Benchmark matching.partitioned_match against a single process merge_asof on
+synthetic data, for an increasing number of worker processes. Prints each run's
+speedup over the single process and exits non-zero if the best one is below
+--min-speedup.
+
+    $ python benchmarks/rematch.py --rows 2000000 --min-speedup 1.5
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import matching
+
+
+def make_data(rows, seed=0):
+    """Fiserv records and payments where most payments have a fiserv record a few
+    minutes away with the same invoice_id, and invoice_ids get reused"""
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2019-01-01").value
+    span = pd.Timedelta(days=3 * 365).value
+
+    payment_dates = pd.to_datetime(start + rng.integers(0, span, rows))
+    payments = pd.DataFrame(
+        {
+            "id": np.arange(rows),
+            "invoice_id": rng.integers(0, rows // 4, rows),
+            "transaction_date": payment_dates,
+        }
+    )
+
+    offsets = pd.to_timedelta(rng.integers(-600, 600, rows), unit="s")
+    fiserv = pd.DataFrame(
+        {
+            "id": [f"f{i}" for i in range(rows)],
+            "invoice_id": payments["invoice_id"].to_numpy(),
+            "transaction_date": payment_dates + offsets,
+        }
+    )
+
+    return (
+        fiserv.sort_values(by="transaction_date", kind="stable"),
+        payments.sort_values(by="transaction_date", kind="stable"),
+    )
+
+
+def timed(func, *args, **kwargs):
+    began = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - began
+
+
+def main(args):
+    fiserv, payments = make_data(args.rows)
+    tolerance = pd.Timedelta(args.tolerance) if args.tolerance else None
+
+    (expected, _), single = timed(matching.match, fiserv, payments, tolerance)
+    print(f"{args.rows} rows, {args.partitions} partitions")
+    print(f"{'workers':>8} {'seconds':>8} {'rows/s':>12} {'speedup':>8}")
+    print(f"{'single':>8} {single:8.2f} {args.rows / single:12,.0f} {1:8.2f}")
+
+    best = 0
+    workers = 1
+    while workers <= args.max_workers:
+        (output, _), seconds = timed(
+            matching.partitioned_match,
+            fiserv,
+            payments,
+            tolerance,
+            partitions=args.partitions,
+            workers=workers,
+        )
+        # Partitions without a NaN match come back with integer ids
+        pd.testing.assert_frame_equal(
+            output, expected.reset_index(drop=True), check_dtype=False
+        )
+        speedup = single / seconds
+        best = max(best, speedup)
+        print(f"{workers:>8} {seconds:8.2f} {args.rows / seconds:12,.0f} {speedup:8.2f}")
+        workers *= 2
+
+    print(f"best speedup over single process: {best:.2f}")
+    if args.min_speedup and best < args.min_speedup:
+        print(f"regression: below the minimum speedup of {args.min_speedup:.2f}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--rows", type=int, default=1000000, help=f"Fiserv records and payments each",
+    )
+
+    parser.add_argument(
+        "--partitions", type=int, default=64, help=f"Partitions by invoice_id",
+    )
+
+    parser.add_argument(
+        "--max-workers",
+        type=int,
+        default=os.cpu_count(),
+        help=f"Doubles the workers from 1 up to this. Defaults to the number of CPUs",
+    )
+
+    parser.add_argument(
+        "--tolerance", type=str, help=f"Match tolerance, such as '3 days'",
+    )
+
+    parser.add_argument(
+        "--min-speedup",
+        type=float,
+        help=f"Exit with an error if no run is at least this much faster than the single process",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,388 @@
+"""Synthetic inputs for the loaders, shaped like the files they read from S3: Flowbird
+transaction_history and archipel_transactionspub CSVs, Passport report JSON, Fiserv
+report CSVs and the encrypted Fiserv emails they arrive in.
+
+Each generator takes a number of rows and a seed, so the same arguments always give the
+same data. The data has what the transforms have to deal with: duplicate ids, coin
+payments without a banking id, pool entries without a duration, incomplete payments,
+test zones, refunds and meters outside the known locations.
+
+Write a file of each to a folder:
+
+    $ python benchmarks/synthetic.py --rows 100000 --out synthetic/
+"""
+import argparse
+from email.message import EmailMessage
+from io import BytesIO
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pyzipper
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from config.fiserv import REQUIRED_FIELDS
+from config.location_names import APP_LOCATION_NAMES, METER_LOCATION_NAMES
+
+# The month the data is in
+START = pd.Timestamp("2022-01-01")
+DAYS = 31
+
+# Share of meters and zones which aren't in any of the location ranges
+UNKNOWN_LOCATIONS = 0.05
+# Share of rows repeated later in the same file, like overlapping exports
+DUPLICATES = 0.02
+
+SMARTFOLIO_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+PASSPORT_DATE_FORMAT = "%Y/%m/%d %I:%M:%S %p"
+FISERV_DATE_FORMAT = "%m/%d/%Y"
+
+
+def location_ids(ranges, rng, rows, unknown_start):
+    """Ids drawn from the location ranges, with UNKNOWN_LOCATIONS of them from outside"""
+    known = np.concatenate([np.array(id_range) for id_range in ranges])
+    ids = rng.choice(known, rows)
+    unknown = rng.random(rows) < UNKNOWN_LOCATIONS
+    ids[unknown] = unknown_start + rng.integers(0, 1000, unknown.sum())
+    return ids
+
+
+def random_times(rng, rows):
+    """Times in the month, busier during the day"""
+    days = rng.integers(0, DAYS, rows)
+    seconds = np.clip(rng.normal(13 * 3600, 3 * 3600, rows), 0, 86399).astype(int)
+    return START + pd.to_timedelta(days, unit="D") + pd.to_timedelta(seconds, unit="s")
+
+
+def with_duplicates(df, rng):
+    """Repeats DUPLICATES of the rows at random places in the file"""
+    repeats = df.sample(frac=DUPLICATES, random_state=int(rng.integers(2 ** 31)))
+    df = pd.concat([df, repeats])
+    return df.iloc[rng.permutation(len(df))].reset_index(drop=True)
+
+
+def transaction_history(rows, seed=0):
+    """Flowbird parking transactions, as read by smartfolio_s3.py
+
+    Args:
+        rows (int): Number of transactions, before duplicates
+        seed (int): Random seed
+
+    Returns:
+        pandas dataframe: The transaction_history CSV columns
+    """
+    rng = np.random.default_rng(seed)
+    meter_date = random_times(rng, rows)
+    duration = rng.choice([15, 30, 60, 90, 120, 180, 240, 600], rows) * 60.0
+    payment_mean = rng.choice(
+        ["CARD_1_0", "CARD_0_116", "COIN", "CARD"], rows, p=[0.55, 0.25, 0.15, 0.05]
+    )
+
+    # Coin payments don't have a banking id
+    banking_id = pd.array(rng.integers(1, 999999, rows), dtype="Int64")
+    banking_id[payment_mean == "COIN"] = pd.NA
+
+    # Pool entries don't have a duration or an end
+    pool_entry = rng.random(rows) < 0.01
+    duration[pool_entry] = np.nan
+    end_date = (meter_date + pd.to_timedelta(duration, unit="s")).strftime(
+        SMARTFOLIO_DATE_FORMAT
+    )
+
+    df = pd.DataFrame(
+        {
+            "SYSTEM_ID": seed * 100000000 + np.arange(rows),
+            "CARD_TRANS_ID": banking_id,
+            "METER_CODE": location_ids(
+                METER_LOCATION_NAMES, rng, rows, unknown_start=90000000
+            ),
+            "TOTAL_DURATION": duration,
+            "SERVER_DATE": (meter_date + pd.Timedelta(seconds=5)).strftime(
+                SMARTFOLIO_DATE_FORMAT
+            ),
+            "METER_DATE": meter_date.strftime(SMARTFOLIO_DATE_FORMAT),
+            "END_DATE": end_date,
+            "PAYMENT_MEAN": payment_mean,
+            "AMOUNT": (duration / 60 * 0.03).round(2),
+            "TRANSACTION_TYPE": np.where(pool_entry, "Pool Entry", "Parking"),
+        }
+    )
+    return with_duplicates(df, rng)
+
+
+def archipel_transactionspub(rows, seed=0):
+    """Flowbird card payments, as read by payments_s3.py
+
+    Args:
+        rows (int): Number of payments
+        seed (int): Random seed
+
+    Returns:
+        pandas dataframe: The archipel_transactionspub CSV columns
+    """
+    rng = np.random.default_rng(seed)
+    transaction_date = random_times(rng, rows)
+    status = rng.choice(
+        ["COMPLETED", "INCOMPLETE", "UNSUCCESSFUL"], rows, p=[0.94, 0.03, 0.03]
+    )
+
+    # Payments which didn't go through have no Monetra id or handling date
+    monetra_id = pd.array(seed * 100000000 + np.arange(rows), dtype="Int64")
+    monetra_id[status == "INCOMPLETE"] = pd.NA
+    handling_date = (transaction_date + pd.Timedelta(days=1)).strftime(
+        SMARTFOLIO_DATE_FORMAT
+    )
+    handling_date = pd.Series(handling_date).where(status == "COMPLETED")
+
+    df = pd.DataFrame(
+        {
+            "TRANSACTION_NUMBER": rng.integers(1, 999999, rows),
+            "TERMINAL_ID": location_ids(
+                METER_LOCATION_NAMES, rng, rows, unknown_start=90000000
+            ),
+            "TRANSACTION_DATE": transaction_date.strftime(SMARTFOLIO_DATE_FORMAT),
+            "TRANSACTION_HANDLING_DATE": handling_date,
+            "MONETRA_ID": monetra_id,
+            "SCHEME": rng.choice(
+                ["VISA", "MASTERCARD", "AMEX", "DISCOVER"], rows, p=[0.6, 0.25, 0.1, 0.05]
+            ),
+            "TRANSACTION_AMOUNT": rng.integers(25, 2000, rows) / 100,
+            "TRANSACTION_STATUS": status,
+            "REMITTANCE_STATUS": np.where(status == "COMPLETED", "REMITTED", "NONE"),
+        }
+    )
+    # Unlike the other exports, payments aren't repeated. payments_s3.py doesn't drop
+    # duplicates, and an upsert with the same id twice fails.
+    return df
+
+
+def passport_report(rows, seed=0):
+    """Passport app parking sessions, as read by passport_DB.py
+
+    Args:
+        rows (int): Number of sessions, before duplicates
+        seed (int): Random seed
+
+    Returns:
+        pandas dataframe: The report's records, write them with to_json(orient="records")
+    """
+    rng = np.random.default_rng(seed)
+    entry = random_times(rng, rows)
+    exit_time = entry + pd.to_timedelta(rng.integers(10, 300, rows), unit="m")
+    revenue = rng.integers(0, 2000, rows) / 100
+
+    # Test zones are the 101 zone and ones with AUS in their id
+    zones = location_ids(APP_LOCATION_NAMES, rng, rows, unknown_start=50000).astype(
+        object
+    )
+    zones[rng.random(rows) < 0.005] = 101
+    test = rng.random(rows) < 0.001
+    zones[test] = [f"AUS{zone}" for zone in zones[test]]
+
+    df = pd.DataFrame(
+        {
+            "Transaction #": seed * 100000000 + np.arange(rows),
+            "Zone #": zones,
+            "Zone Group": rng.choice(["Downtown", "Pools", "Lots"], rows),
+            "Method": rng.choice(["Mobile", "Web", "IVR"], rows, p=[0.8, 0.15, 0.05]),
+            "Payment Type": rng.choice(
+                [
+                    "Credit/Debit Card",
+                    "Zone Cash",
+                    "Validation",
+                    "Free",
+                    "Network Token",
+                ],
+                rows,
+                p=[0.7, 0.15, 0.05, 0.05, 0.05],
+            ),
+            "Parking Revenue": [f"${amount:.2f}" for amount in revenue],
+            "Net Revenue": [f"${amount:.2f}" for amount in revenue * 0.9],
+            "Entry Time": entry.strftime(PASSPORT_DATE_FORMAT),
+            "Exit Time": exit_time.strftime(PASSPORT_DATE_FORMAT),
+        }
+    )
+    return with_duplicates(df, rng)
+
+
+def invoice_ids(payments):
+    """The invoice numbers Fiserv has for archipel_transactionspub payments, the last 4
+    digits of the terminal followed by the zero-padded transaction number"""
+    terminal = payments["TERMINAL_ID"].astype(str).str[-4:]
+    number = payments["TRANSACTION_NUMBER"].astype(int).map("{:06d}".format)
+    return (terminal + number).astype("int64").to_numpy()
+
+
+def fiserv_report(rows, seed=0, payments=None):
+    """A Fiserv transaction detail report, as read by fiserv_DB.py
+
+    Args:
+        rows (int): Number of card transactions, before duplicates
+        seed (int): Random seed
+        payments (pandas dataframe): Optional archipel_transactionspub payments which
+            the report settles instead of random transactions, one row each, so its
+            records can be matched to them
+
+    Returns:
+        pandas dataframe: The REQUIRED_FIELDS and Product Code columns
+    """
+    rng = np.random.default_rng(seed)
+    if payments is None:
+        txn_date = random_times(rng, rows)
+    else:
+        # Fiserv's time is a little off the meter's
+        rows = len(payments)
+        txn_date = pd.DatetimeIndex(
+            pd.to_datetime(payments["TRANSACTION_DATE"], format=SMARTFOLIO_DATE_FORMAT)
+        ) + pd.to_timedelta(rng.integers(-120, 120, rows), unit="s")
+    batch_date = txn_date.normalize() + pd.Timedelta(days=1)
+    card_type = rng.choice(
+        ["VISA", "MASTERCARD", "AMEX", "DISCOVER"], rows, p=[0.6, 0.25, 0.1, 0.05]
+    )
+
+    # Accounts ending in 885 (PARD) are submitted on their funded date
+    account = rng.choice([123456885, 123456111, 123456222], rows, p=[0.2, 0.5, 0.3])
+
+    df = pd.DataFrame(
+        {
+            "Invoice Number": rng.integers(1000000000, 9999999999, rows),
+            "Txn Date": txn_date.strftime("%m/%d/%Y %H:%M"),
+            "Transaction Type": rng.choice(["Sale", "Refund"], rows, p=[0.99, 0.01]),
+            "Terminal ID": location_ids(
+                METER_LOCATION_NAMES, rng, rows, unknown_start=90000000
+            ),
+            "Batch No.": seed * 100000 + rng.integers(0, 5000, rows),
+            "Batch Sequence ID": rng.integers(1, 500, rows),
+            "Batch Date": batch_date.strftime(FISERV_DATE_FORMAT),
+            "Funded Date": (batch_date + pd.Timedelta(days=2)).strftime(
+                FISERV_DATE_FORMAT
+            ),
+            "Processed Sales Amount": rng.integers(25, 2000, rows) / 100,
+            "Transaction Status": rng.choice(
+                ["Approved", "Declined"], rows, p=[0.97, 0.03]
+            ),
+            "Site ID (BE)": account,
+            "Product Code": card_type,
+        }
+    )
+    if payments is not None:
+        df["Invoice Number"] = invoice_ids(payments)
+        df["Terminal ID"] = payments["TERMINAL_ID"].to_numpy()
+    assert set(REQUIRED_FIELDS).issubset(df.columns)
+    return with_duplicates(df, rng)
+
+
+def encrypt(fname, data, password):
+    """An AES256 encrypted zip file with one file in it, like Fiserv sends
+
+    Args:
+        fname (str): The name of the file in the zip
+        data (bytes): Its contents
+        password (str): The zip's password
+
+    Returns:
+        bytes: The zip file
+    """
+    buffer = BytesIO()
+    with pyzipper.AESZipFile(
+        buffer, "w", compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES
+    ) as zip_file:
+        zip_file.setpassword(password.encode())
+        zip_file.writestr(fname, data)
+    return buffer.getvalue()
+
+
+def fiserv_email(
+    rows,
+    seed=0,
+    password="password",
+    sender="reports@fiserv.com",
+    reports=1,
+    payments=None,
+):
+    """A Fiserv report email, as read by fiserv_email_pub.py
+
+    Args:
+        rows (int): Number of card transactions in each report
+        seed (int): Random seed, which also sets the day of the month it's sent
+        password (str): The password of the zip attachments, FSRV_ENCRYPTION
+        sender (str): The From address, FSRV_EMAIL
+        reports (int): Number of report attachments
+        payments (pandas dataframe): Optional payments each report settles, see
+            fiserv_report
+
+    Returns:
+        bytes: The email as it's stored in S3
+    """
+    message = EmailMessage()
+    message["From"] = sender
+    message["To"] = "parking-reports@example.com"
+    message["Subject"] = "Scheduled Report"
+    message["Date"] = (START + pd.Timedelta(days=seed % DAYS, hours=6)).strftime(
+        "%a, %d %b %Y %H:%M:%S +0000"
+    )
+    message.set_content("Your scheduled report is attached.")
+
+    for report in range(reports):
+        name = f"Transaction Detail {seed}-{report}"
+        df = fiserv_report(rows, seed * 1000 + report, payments)
+        csv = df.to_csv(index=False).encode()
+        message.add_attachment(
+            encrypt(f"{name}.csv", csv, password),
+            maintype="application",
+            subtype="zip",
+            filename=f"{name}.zip",
+        )
+    return message.as_bytes()
+
+
+# The generator and file format of each loader's input
+SOURCES = {
+    "transaction_history": (transaction_history, "csv"),
+    "archipel_transactionspub": (archipel_transactionspub, "csv"),
+    "passport": (passport_report, "json"),
+    "fiserv": (fiserv_report, "csv"),
+}
+
+
+def to_bytes(df, file_format):
+    """A generated dataframe as the file it's read from"""
+    if file_format == "json":
+        return df.to_json(orient="records").encode()
+    return df.to_csv(index=False).encode()
+
+
+def main(args):
+    os.makedirs(args.out, exist_ok=True)
+    for name, (generator, file_format) in SOURCES.items():
+        path = os.path.join(args.out, f"{name}.{file_format}")
+        with open(path, "wb") as f:
+            f.write(to_bytes(generator(args.rows, args.seed), file_format))
+        print(f"Wrote {path}")
+
+    path = os.path.join(args.out, "fiserv.eml")
+    with open(path, "wb") as f:
+        f.write(fiserv_email(args.rows, args.seed))
+    print(f"Wrote {path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--rows", type=int, default=10000, help=f"Rows in each file. Defaults to 10000",
+    )
+
+    parser.add_argument(
+        "--seed", type=int, default=0, help=f"Random seed. Defaults to 0",
+    )
+
+    parser.add_argument(
+        "--out", default="synthetic", help=f"Folder the files are written to",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
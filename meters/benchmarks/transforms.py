@@ -0,0 +1,208 @@
+"""Benchmark each loader's parse and transform on synthetic data, reporting rows per
+second and peak memory, and compare them with a saved baseline.
+
+    $ python benchmarks/transforms.py --rows 100000 --save benchmarks/baseline.json
+    $ python benchmarks/transforms.py --rows 100000 --compare benchmarks/baseline.json
+"""
+import argparse
+from io import BytesIO
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import fiserv_DB
+import passport_DB
+import payments_s3
+import smartfolio_s3
+import synthetic
+
+# Each loader with the generator and file format of its input
+LOADERS = {
+    "smartfolio_s3": (
+        smartfolio_s3.LOADER,
+        synthetic.transaction_history,
+        "csv",
+    ),
+    "payments_s3": (
+        payments_s3.get_loader("atd"),
+        synthetic.archipel_transactionspub,
+        "csv",
+    ),
+    "passport_DB": (passport_DB.LOADER, synthetic.passport_report, "json"),
+    "fiserv_DB": (
+        fiserv_DB.LOADERS["transactions"],
+        synthetic.fiserv_report,
+        "csv",
+    ),
+}
+
+# Measured for each loader, higher is better for rows per second
+METRICS = [
+    ("parse_rows_per_sec", "parse rows/s", True),
+    ("transform_rows_per_sec", "transform rows/s", True),
+    ("transform_peak_mb", "transform peak MB", False),
+]
+
+
+def best_time(func, make_input, repeat):
+    """The quickest of several runs, each on a new input made outside the timing"""
+    seconds = []
+    for _ in range(repeat):
+        data = make_input()
+        began = time.perf_counter()
+        func(data)
+        seconds.append(time.perf_counter() - began)
+    return min(seconds)
+
+
+def peak_memory(func, data):
+    """The most memory allocated at once while running, in MB. Timed separately as
+    tracing slows it down."""
+    tracemalloc.start()
+    try:
+        func(data)
+        return tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def benchmark(loader, generator, file_format, rows, seed, repeat):
+    """Times a loader's parse and transform on a synthetic file
+
+    Returns:
+        dict: Rows in the file and the METRICS
+    """
+    raw = synthetic.to_bytes(generator(rows, seed), file_format)
+    parsed = loader.read(BytesIO(raw))
+    rows = len(parsed)
+
+    parse_seconds = best_time(loader.read, lambda: BytesIO(raw), repeat)
+    # Transforms change the dataframe they're given, so each run gets its own copy
+    transform_seconds = best_time(loader.transform, parsed.copy, repeat)
+
+    return {
+        "rows": rows,
+        "parse_rows_per_sec": rows / parse_seconds,
+        "transform_rows_per_sec": rows / transform_seconds,
+        "transform_peak_mb": peak_memory(loader.transform, parsed.copy()),
+    }
+
+
+def change(current, baseline, higher_is_better):
+    """How much worse (positive) or better (negative) a metric got, in percent"""
+    if not baseline:
+        return 0.0
+    difference = (current - baseline) / baseline * 100
+    return -difference if higher_is_better else difference
+
+
+def main(args):
+    names = args.loaders or list(LOADERS)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            saved = json.load(f)
+        baseline = saved["results"]
+        # Rows per second and memory both depend on the size of the files
+        if saved["rows"] != args.rows or saved["seed"] != args.seed:
+            print(
+                f"Warning: the baseline is of {saved['rows']} rows with seed "
+                f"{saved['seed']}, use the same --rows and --seed to compare"
+            )
+
+    print(f"{'loader':<14} {'rows':>8}", end="")
+    for _, label, _ in METRICS:
+        print(f" {label:>18}", end="")
+    print()
+
+    results = {}
+    regressions = []
+    for name in names:
+        loader, generator, file_format = LOADERS[name]
+        result = benchmark(
+            loader, generator, file_format, args.rows, args.seed, args.repeat
+        )
+        results[name] = result
+
+        print(f"{name:<14} {result['rows']:>8}", end="")
+        for metric, label, higher_is_better in METRICS:
+            cell = f"{result[metric]:,.1f}"
+            if baseline and name in baseline:
+                worse = change(result[metric], baseline[name][metric], higher_is_better)
+                cell = f"{cell} ({worse:+.0f}%)"
+                if args.max_regression is not None and worse > args.max_regression:
+                    regressions.append(f"{name} {label} {worse:+.0f}%")
+            print(f" {cell:>18}", end="")
+        print()
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(
+                {
+                    "rows": args.rows,
+                    "seed": args.seed,
+                    "python": platform.python_version(),
+                    "pandas": pd.__version__,
+                    "machine": platform.machine(),
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+        print(f"Saved baseline to {args.save}")
+
+    if baseline:
+        print("(+N%) is how much worse than the baseline, (-N%) how much better")
+    if regressions:
+        raise SystemExit(f"Worse than the baseline: {', '.join(regressions)}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--rows",
+        type=int,
+        default=100000,
+        help=f"Rows in each synthetic file, before duplicates. Defaults to 100000",
+    )
+
+    parser.add_argument(
+        "--seed", type=int, default=0, help=f"Random seed. Defaults to 0",
+    )
+
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help=f"Runs timed for each, the quickest is reported. Defaults to 3",
+    )
+
+    parser.add_argument(
+        "--loaders", nargs="+", choices=list(LOADERS), help=f"Defaults to all of them",
+    )
+
+    parser.add_argument(
+        "--save", help=f"Save the results as a baseline to this JSON file",
+    )
+
+    parser.add_argument(
+        "--compare", help=f"Show the change from the baseline in this JSON file",
+    )
+
+    parser.add_argument(
+        "--max-regression",
+        type=float,
+        help=f"With --compare, exit with an error if any metric is more than this percent worse",
+    )
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,151 @@
+"""Bulk upserts straight to postgres with COPY, for backfills too big for PostgREST"""
+import os
+from io import StringIO
+
+from pandas.api.types import is_float_dtype
+import psycopg2
+from psycopg2 import sql
+
+# Postgres connection URL, the loaders' --bulk mode connects with this
+DATABASE_URL = os.getenv("DATABASE_URL")
+
+
+def get_connection(database_url=DATABASE_URL):
+    """A new psycopg2 connection, which the caller closes"""
+    return psycopg2.connect(database_url)
+
+
+def get_primary_key(cur, table):
+    """Get the primary key columns of a table, which are the conflict target for upserts.
+
+    Args:
+        cur: psycopg2 cursor
+        table (str): Schema qualified table name, e.g. api.transactions
+
+    Returns:
+        list: Column names
+    """
+    cur.execute(
+        """SELECT a.attname
+        FROM pg_index i
+        JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey)
+        WHERE i.indrelid = %s::regclass AND i.indisprimary
+        ORDER BY array_position(i.indkey, a.attnum)""",
+        (table,),
+    )
+    return [row[0] for row in cur.fetchall()]
+
+
+def get_integer_columns(cur, table):
+    """Get the integer columns of a table.
+
+    Args:
+        cur: psycopg2 cursor
+        table (str): Schema qualified table name, e.g. api.transactions
+
+    Returns:
+        set: Column names
+    """
+    cur.execute(
+        """SELECT attname
+        FROM pg_attribute
+        WHERE attrelid = %s::regclass AND attnum > 0 AND NOT attisdropped
+            AND atttypid IN ('smallint'::regtype, 'integer'::regtype, 'bigint'::regtype)""",
+        (table,),
+    )
+    return {row[0] for row in cur.fetchall()}
+
+
+def to_csv(df, columns, integer_columns):
+    """Write the columns of a dataframe as CSV for COPY.
+        pandas stores integers with missing values as floats, which would be written as
+        123.0 and rejected by an integer column, so they're written as integers.
+
+    Args:
+        df (pandas dataframe): Formatted dataframe that works with the table schema
+        columns (list): The columns of df to write
+        integer_columns (set): The table's integer columns, from get_integer_columns
+
+    Returns:
+        StringIO: The CSV, at its start
+    """
+    df = df[columns]
+    floats = [
+        c for c in columns if c in integer_columns and is_float_dtype(df[c].dtype)
+    ]
+    if floats:
+        df = df.astype({c: "Int64" for c in floats})
+
+    csv_buffer = StringIO()
+    df.to_csv(csv_buffer, index=False, header=False)
+    csv_buffer.seek(0)
+    return csv_buffer
+
+
+def copy_upsert(conn, table, df, columns):
+    """Upsert the columns of a dataframe into a postgres table.
+        The rows are streamed as CSV over COPY into a temporary (so not WAL logged)
+        staging table and then upserted into the table with a single
+        INSERT ... ON CONFLICT DO UPDATE. Rows identical to the stored ones are left alone.
+
+    Args:
+        conn: psycopg2 connection
+        table (str): Schema qualified table name, e.g. api.transactions
+        df (pandas dataframe): Formatted dataframe that works with the table schema
+        columns (list): The columns of df to load
+
+    Returns:
+        int: The number of rows inserted or changed
+    """
+    schema, name = table.split(".")
+    target = sql.Identifier(schema, name)
+    staging = sql.Identifier(f"{name}_staging")
+    cols = sql.SQL(", ").join(sql.Identifier(c) for c in columns)
+
+    with conn, conn.cursor() as cur:
+        pk = get_primary_key(cur, table)
+        csv_buffer = to_csv(df, columns, get_integer_columns(cur, table))
+        updates = [c for c in columns if c not in pk]
+
+        cur.execute(
+            sql.SQL(
+                "CREATE TEMPORARY TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP"
+            ).format(staging, target)
+        )
+        cur.copy_expert(
+            sql.SQL("COPY {} ({}) FROM STDIN WITH (FORMAT csv)").format(
+                staging, cols
+            ),
+            csv_buffer,
+        )
+        if updates:
+            action = sql.SQL(
+                "DO UPDATE SET {set} WHERE ({current}) IS DISTINCT FROM ({excluded})"
+            ).format(
+                set=sql.SQL(", ").join(
+                    sql.SQL("{0} = EXCLUDED.{0}").format(sql.Identifier(c))
+                    for c in updates
+                ),
+                current=sql.SQL(", ").join(
+                    sql.SQL("t.{}").format(sql.Identifier(c)) for c in updates
+                ),
+                excluded=sql.SQL(", ").join(
+                    sql.SQL("EXCLUDED.{}").format(sql.Identifier(c)) for c in updates
+                ),
+            )
+        else:
+            action = sql.SQL("DO NOTHING")
+
+        cur.execute(
+            sql.SQL(
+                "INSERT INTO {} AS t ({}) SELECT {} FROM {} ON CONFLICT ({}) {}"
+            ).format(
+                target,
+                cols,
+                cols,
+                staging,
+                sql.SQL(", ").join(sql.Identifier(c) for c in pk),
+                action,
+            )
+        )
+        return cur.rowcount
@@ -25,3 +25,41 @@ FIELD_MAPPING = {
     "Site ID (BE)": "account",
     "Product Code": "card_type",
 }
+
+# Report types fiserv_email_pub.py sorts the decrypted attachments into, by the columns
+# in their header row. A report is the first type whose fields are all in its header,
+# and is uploaded under the type's prefix followed by <year>/<month>/.
+REPORT_TYPES = {
+    # Transaction detail reports, loaded to fiserv_reports_raw by fiserv_DB.py
+    "transactions": {
+        "fields": REQUIRED_FIELDS,
+        "prefix": "emails/current_processed/",
+    },
+}
+
+# Where reports which don't match any of the REPORT_TYPES, or don't start with a CSV
+# header, are uploaded
+UNCLASSIFIED_PREFIX = "emails/unclassified/"
+
+# The report types fiserv_DB.py knows how to load
+LOADED_REPORT_TYPES = ["transactions"]
+
+
+def normalize_columns(columns):
+    """
+    Returns the column names of a header row without the whitespace around them, which
+    some reports have. Reports are classified and loaded by the normalized names.
+    """
+    return [str(c).strip() for c in columns]
+
+
+def report_type(columns):
+    """
+    Returns the name of the report type a header row belongs to, None if it doesn't
+    match any of the REPORT_TYPES
+    """
+    columns = set(normalize_columns(columns))
+    for name, report in REPORT_TYPES.items():
+        if columns.issuperset(report["fields"]):
+            return name
+    return None
@@ -1,117 +1,91 @@
 # Standard library imports
+import csv
 import os
-import ntpath
 import logging
 import argparse
-from datetime import datetime
 
 
 # Related third-party imports
-import boto3
+from botocore.exceptions import ClientError
 import pandas as pd
-from pypgrest import Postgrest
 
+import pipeline
 import utils
 
-from config.fiserv import FIELD_MAPPING, REQUIRED_FIELDS
+from config.fiserv import (
+    FIELD_MAPPING,
+    LOADED_REPORT_TYPES,
+    REPORT_TYPES,
+    REQUIRED_FIELDS,
+    normalize_columns,
+    report_type,
+)
 
 # Environment variables
 
-AWS_ACCESS_ID = os.getenv("AWS_ACCESS_ID")
-AWS_PASS = os.getenv("AWS_PASS")
 BUCKET_NAME = os.getenv("BUCKET_NAME")
-POSTGREST_TOKEN = os.getenv("POSTGREST_TOKEN")
-POSTGREST_ENDPOINT = os.getenv("POSTGREST_ENDPOINT")
+
+# Bytes downloaded from the start of each CSV to find its report type
+HEADER_BYTES = 64 * 1024
 
 
-def handle_year_month_args(year, month, lastmonth, aws_s3_client):
+def get_report_type(csv_file, client):
     """
+    Finds the report type of a CSV from its header row, downloading only the start of it.
+    Older folders have every type of report in them.
 
     Parameters
     ----------
-    year : Int
-        Argument provided value for year.
-    month : Int
-        Argument provided value for month.
-    lastmonth : Bool
-        Argument that determines if the previous month should also be queried.
-    aws_s3_client : boto3 client object
-        For sending on to get_csv_list
+    csv_file : String
+        The S3 key of the CSV.
+    client : boto3 client object
 
     Returns
     -------
-    csv_file_list : List
-        A list of the csv files to be downloaded and upsert to Postgres.
+    report : String
+        The report type, None if it doesn't match any.
+    has_rows : Bool
+        False if the CSV is only a header row.
 
     """
-    # If args are missing, default to current month and/or year
-    if not year:
-        f_year = datetime.now().year
-    else:
-        f_year = year
-
-    if not month:
-        f_month = datetime.now().month
-    else:
-        f_month = month
-
-    csv_file_list = get_csv_list(f_year, f_month, aws_s3_client)
-
-    if not month and not year:
-        if lastmonth == True:
-            prev_month = f_month - 1
-            prev_year = f_year
-            if prev_month == 0:
-                prev_year = prev_year - 1
-                prev_month = 12
-            logger.debug(
-                f"Getting data from folders: {prev_month}-{prev_year} and {f_month}-{f_year}"
-            )
-            prev_list = get_csv_list(prev_year, prev_month, aws_s3_client)
-            csv_file_list.extend(prev_list)
-        else:
-            logger.debug(f"Getting data from folders: {f_month}-{f_year}")
-
-    csv_file_list = [f for f in csv_file_list if f.endswith(".csv")]
-
-    return csv_file_list
-
+    try:
+        response = client.get_object(
+            Bucket=BUCKET_NAME, Key=csv_file, Range=f"bytes=0-{HEADER_BYTES - 1}"
+        )
+    except ClientError as e:
+        # An empty file has no bytes to return
+        if e.response["Error"]["Code"] == "InvalidRange":
+            return None, False
+        raise e
+    start = response["Body"].read()
+    lines = start.decode("utf-8-sig", errors="replace").splitlines()
+    columns = next(csv.reader(lines[:1]), [])
 
-def get_file_name(file_key):
-    """
-    Returns the name of an email file based on the full s3 file path
-    :param file_key: the file path
-    :return: string
-    """
-    return ntpath.basename(file_key)
+    # The whole file was downloaded when it's smaller than the range
+    whole_file = len(start) < HEADER_BYTES
+    has_rows = not whole_file or any(line.strip() for line in lines[1:])
+    return report_type(columns), has_rows
 
 
-def get_csv_list(year, month, client):
-    """
-    Returns an array of files parsed into an actual array (as opposed to an object)
-    :return: array of strings
+def skip_file(csv_file, client):
     """
-    csv_file_list = []
-    pending_csv_list = aws_list_files(year, month, client)
-    for csv_file in pending_csv_list:
-        csv_file_list.append(csv_file)
-
-    # Finally return the final list
-    return csv_file_list
+    Skips the report types which aren't loaded without downloading them. Passed to the
+    pipeline as its skip check.
 
+    Returns
+    -------
+    reason : String
+        Why the file is skipped, None to load it.
 
-def aws_list_files(year, month, client):
     """
-    Returns a list of email files.
-    :return: object
-    """
-    response = client.list_objects(
-        Bucket=BUCKET_NAME,
-        Prefix="emails/current_processed/" + str(year) + "/" + str(month),
-    )
-
-    for content in response.get("Contents", []):
-        yield content.get("Key")
+    report, has_rows = get_report_type(csv_file, client)
+    if report not in LOADED_REPORT_TYPES:
+        return "unsupported report type"
+    # Ignore the emails which send a CSV with only column headers
+    # This happens with the "Contactless-Detail" reports for some reason
+    if not has_rows:
+        return "no rows"
+    return None
 
 
 def id_field_creation(invoice_id, batch_number):
@@ -144,6 +118,9 @@ def transform(fiserv_df):
     Args: dataframe of data from fiserv report csv
     Returns: formatted dataframe to conform to postgres schema
     """
+    # The same names the report was classified by in get_report_type
+    fiserv_df = fiserv_df.set_axis(normalize_columns(fiserv_df.columns), axis=1)
+
     for field in REQUIRED_FIELDS:
         assert field in list(
             fiserv_df.columns
@@ -193,82 +170,35 @@ def transform(fiserv_df):
     return fiserv_df
 
 
-def to_postgres(fiserv_df):
-    """
-    Upserts fiserv data to local postgres DB
-    Args: Formatted dataframe from transform function
-    Returns: None.
-    """
-    payload = fiserv_df.to_dict(orient="records")
-
-    # Connect to local DB
-    client = Postgrest(
-        POSTGREST_ENDPOINT,
-        token=POSTGREST_TOKEN,
-        headers={"Prefer": "return=representation"},
-    )
-
-    # Upsert to postgres DB
-    try:
-        res = client.upsert(resource="fiserv_reports_raw", data=payload)
-    except Exception as e:
-        logger.error(client.res.text)
-        raise e
+# The loaders of the report types in LOADED_REPORT_TYPES
+LOADERS = {
+    "transactions": pipeline.Loader(
+        prefix=REPORT_TYPES["transactions"]["prefix"],
+        suffix=".csv",
+        read=pd.read_csv,
+        transform=transform,
+        table="fiserv_reports_raw",
+        skip=skip_file,
+    ),
+}
 
 
 def main(args):
-    aws_s3_client = boto3.client(
-        "s3",
-        aws_access_key_id=AWS_ACCESS_ID,
-        aws_secret_access_key=AWS_PASS,
-    )
-
-    csv_file_list = handle_year_month_args(
-        args.year, args.month, args.lastmonth, aws_s3_client
-    )
-
-    if len(csv_file_list) == 0:
-        logger.debug("No Files found for selected months, nothing happened.")
-        return 0
-
-    # Access the files from S3 and place them into a dataframe
-    for csv_f in csv_file_list:
-        # Parse the file
-        response = aws_s3_client.get_object(Bucket=BUCKET_NAME, Key=csv_f)
-        df = pd.read_csv(response.get("Body"))
-
-        logger.debug(f"Loaded CSV File: {csv_f}")
-        # Ignore the emails which send a CSV with only column headers
-        # This happens with the "Contactless-Detail" reports for some reason
-        if not df.empty:
-            df = transform(df)
-            to_postgres(df)
+    months = pipeline.get_months(args.year, args.month, args.lastmonth)
+    for report in LOADED_REPORT_TYPES:
+        pipeline.run(
+            LOADERS[report], months, executor=args.executor, workers=args.workers
+        )
 
 
-# CLI arguments definition
-parser = argparse.ArgumentParser()
+if __name__ == "__main__":
+    # CLI arguments definition
+    parser = argparse.ArgumentParser()
 
-parser.add_argument(
-    "--year",
-    type=int,
-    help=f"Year of folder to select, defaults to current year",
-)
-
-parser.add_argument(
-    "--month",
-    type=int,
-    help=f"Month of folder to select. defaults to current month",
-)
-
-parser.add_argument(
-    "--lastmonth",
-    type=bool,
-    help=f"Will download from current month folder as well as previous.",
-    default=False,
-)
+    pipeline.add_arguments(parser)
 
-args = parser.parse_args()
+    args = parser.parse_args()
 
-logger = utils.get_logger(__file__, level=logging.DEBUG)
+    logger = utils.get_logger(__file__, level=logging.DEBUG)
 
-main(args)
+    main(args)
@@ -1,11 +1,22 @@
 # Standard Library imports
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 import ntpath
 import base64
+import csv
+import email
+import json
 import logging
+import time
+from tempfile import SpooledTemporaryFile
+from urllib.parse import unquote_plus
 
 # Related third party imports
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import mailparser
 import pandas as pd
 import pyzipper
@@ -14,6 +25,8 @@ import utils
 from io import StringIO
 from io import BytesIO
 
+from config.fiserv import REPORT_TYPES, UNCLASSIFIED_PREFIX, report_type
+
 # Envrioment variables
 
 AWS_ACCESS_ID = os.getenv("AWS_ACCESS_ID")
@@ -21,17 +34,59 @@ AWS_PASS = os.getenv("AWS_PASS")
 BUCKET_NAME = os.getenv("BUCKET_NAME")
 FSRV_EMAIL = os.getenv("FSRV_EMAIL")
 ENCRYPTION_KEY = os.getenv("FSRV_ENCRYPTION")
+# Optional, for pointing the AWS clients at a local S3/SQS stand-in
+AWS_ENDPOINT_URL = os.getenv("AWS_ENDPOINT_URL")
+
+INBOX_PREFIX = "emails/new/"
+
+# Emails are kept in memory up to this size, bigger ones are spooled to a temporary file
+SPOOL_MAX_BYTES = 16 * 1024 * 1024
+# Emails bigger than this are left in the inbox with a warning
+MAX_EMAIL_BYTES = int(os.getenv("FSRV_MAX_EMAIL_MB", "100")) * 1024 * 1024
+DOWNLOAD_CHUNK_BYTES = 1024 * 1024
+
+# Decrypted CSVs are streamed to S3, in 8 MB parts once they're bigger than that.
+# The stream is read in order on the email's own thread.
+TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    use_threads=False,
+)
+# The longest CSV header line accepted
+MAX_HEADER_BYTES = 64 * 1024
+# Attachments of an email decrypted and uploaded at once
+ATTACHMENT_WORKERS = 4
+
+# Archive copies made at once
+ARCHIVE_WORKERS = 16
+# Most keys S3 accepts in one delete_objects request
+DELETE_BATCH_SIZE = 1000
+# Times keys S3 didn't delete are retried
+DELETE_RETRIES = 3
+# How long a poll of the SQS queue waits for a message, the longest SQS allows
+POLL_SECONDS = 20
+
+logger = utils.get_logger(__file__, level=logging.DEBUG)
 
 
 # Downloads a file from s3
 def download_s3_file(file_key, client):
     """
-    Downloads an email file from s3
+    Downloads an email file from s3 into memory, or a temporary file which is deleted
+    when it's closed once it grows past SPOOL_MAX_BYTES
     :param file_key: the full path to the email file
-    :return:
+    :return: SpooledTemporaryFile at the start of the email, None if it's over MAX_EMAIL_BYTES
     """
-    with open((get_file_name(file_key)), "wb") as f:
-        client.download_fileobj(BUCKET_NAME, file_key, f)
+    response = client.get_object(Bucket=BUCKET_NAME, Key=file_key)
+    if response["ContentLength"] > MAX_EMAIL_BYTES:
+        response["Body"].close()
+        return None
+
+    spool = SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+    for chunk in response["Body"].iter_chunks(DOWNLOAD_CHUNK_BYTES):
+        spool.write(chunk)
+    spool.seek(0)
+    return spool
 
 
 def get_file_name(file_key):
@@ -43,12 +98,21 @@ def get_file_name(file_key):
     return ntpath.basename(file_key)
 
 
-def parse_email(file_key):
+def parse_email(spool):
     """
-    Returns the parsed email file object using mailparser
+    Returns the parsed email file object using mailparser. The parsed email holds its
+    attachments' base64 payloads, which attachment_to_s3 decodes one zip at a time.
+    :param spool: SpooledTemporaryFile from download_s3_file
     :return: mailparser object
     """
-    return mailparser.parse_from_file(get_file_name(file_key))
+    spool.seek(0, os.SEEK_END)
+    size = spool.tell()
+    spool.seek(0)
+    if size <= SPOOL_MAX_BYTES:
+        return mailparser.parse_from_bytes(spool.read())
+    # Spooled to disk, parsed from the file so there isn't a copy of the raw email in
+    # memory next to the parsed one
+    return mailparser.MailParser(email.message_from_binary_file(spool))
 
 
 def get_email_list(s3):
@@ -59,126 +123,481 @@ def get_email_list(s3):
     email_file_list = []
 
     my_bucket = s3.Bucket(BUCKET_NAME)
-    prefix = "emails/new/"
+    prefix = INBOX_PREFIX
     for object_summary in my_bucket.objects.filter(Prefix=prefix):
-        if object_summary.key != prefix:
-            email_file_list.append(object_summary.key)
+        if object_summary.key == prefix:
+            continue
+        if object_summary.size > MAX_EMAIL_BYTES:
+            logger.warning(f"Skipped email over the size limit: {object_summary.key}")
+            continue
+        email_file_list.append(object_summary.key)
 
     return email_file_list
 
 
-def format_file_name(emailObject):
+def format_file_name(emailObject, fname, report):
     """
-    Returns a file name + path for each csv file based on the email send date
+    Returns a file name + path for a csv file based on its report type and the email send date
+    :param emailObject: mailparser object of the email
+    :param fname: the name of the CSV file in the email attachment
+    :param report: the report type of the CSV, None if it doesn't have one
     :return: string
     """
+    prefix = REPORT_TYPES[report]["prefix"] if report else UNCLASSIFIED_PREFIX
 
     file_name = (
-        "emails/current_processed/"
+        prefix
         + str(emailObject.date.year)
         + "/"
         + str(emailObject.date.month)
         + "/"
-        + emailObject.attachments[0]["filename"]
-        .replace(" ", "-")
-        .replace(".zip", ".csv")
+        + ntpath.basename(fname).replace(" ", "-")
     )
 
     return file_name
 
 
-def decode_file_contents(email_data, fname):
+class HeaderReader:
+    """
+    Reads a stream after its header line has already been read from it, by returning the
+    header first. It has no seek/tell so boto3 uploads it in order as it's read, rather
+    than seeking through it to find its size.
+    """
+
+    def __init__(self, header, stream):
+        self._pending = header
+        self._stream = stream
+
+    def read(self, size=-1):
+        pending, self._pending = self._pending, b""
+        if size is None or size < 0:
+            return pending + self._stream.read()
+        if len(pending) >= size:
+            self._pending = pending[size:]
+            return pending[:size]
+        return pending + self._stream.read(size - len(pending))
+
+
+def check_header(header, fname):
+    """
+    Cheap check that the first line of a decrypted attachment is a CSV header, without
+    parsing the rest of the file
+    :param header: bytes of the first line
+    :param fname: the name of the CSV file, for the warning
+    :return: list of the column names, None if it isn't a CSV header
+    """
+    if not header.endswith(b"\n") and len(header) >= MAX_HEADER_BYTES:
+        logger.warning(f"No CSV header in the first {MAX_HEADER_BYTES} bytes of {fname}")
+        return None
+    try:
+        columns = next(csv.reader([header.decode("utf-8-sig")]), [])
+    except UnicodeDecodeError:
+        logger.warning(f"CSV header of {fname} isn't UTF-8")
+        return None
+    if len(columns) < 2 or not all(c.strip() for c in columns):
+        logger.warning(f"Unexpected CSV header in {fname}: {header[:200]!r}")
+        return None
+    return columns
+
+
+def attachment_to_s3(attachment, emailObject, client, reformat=False):
     """
-    Decodes the password protected AES256 encrypted zip file from Fiserv with the password we set.
+    Decrypts a password protected AES256 encrypted zip file from Fiserv and uploads each
+    CSV in it under the prefix of its report type, which is found from its header row.
+    CSVs are streamed to S3 as they are. Ones which don't start with a CSV header, such
+    as empty ones, are uploaded under UNCLASSIFIED_PREFIX with a warning rather than
+    failing the email, which would otherwise be retried on every run.
 
     Args:
-        email_data: Raw base64 payload from the email attachment
-        fname: the name of the CSV file to extract from the email attachment
+        attachment: mailparser attachment, with the raw base64 payload of the zip file
+        emailObject: mailparser object of the email
+        client: boto3 s3 client
+        reformat: parse each CSV with pandas and write it back out, rather than uploading it as it is
 
     Returns:
-        df: a pandas dataframe of the email CSV
+        uploaded: list of the S3 key and report type (None if unclassified) of each CSV
 
     """
-    zip_data = BytesIO(base64.b64decode(email_data))
+    uploaded = []
+    zip_data = BytesIO(base64.b64decode(attachment["payload"]))
     with pyzipper.AESZipFile(
         zip_data, "r", compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES
     ) as extracted_zip:
-        with extracted_zip.open(fname, pwd=str.encode(ENCRYPTION_KEY)) as csv_file:
-            df = pd.read_csv(csv_file)
-    return df
-
-
-def df_to_s3(df, resource, filename):
+        for fname in extracted_zip.namelist():
+            if not fname.lower().endswith(".csv"):
+                continue
+            df = None
+            if reformat:
+                with extracted_zip.open(fname, pwd=str.encode(ENCRYPTION_KEY)) as csv_file:
+                    try:
+                        df = pd.read_csv(csv_file)
+                    except (
+                        pd.errors.EmptyDataError,
+                        pd.errors.ParserError,
+                        UnicodeDecodeError,
+                    ) as e:
+                        logger.warning(f"Uploading {fname} as it is, it can't be parsed: {e}")
+
+            if df is not None:
+                report = report_type(df.columns)
+                file_name = format_file_name(emailObject, fname, report)
+                df_to_s3(df, client, file_name)
+            else:
+                with extracted_zip.open(fname, pwd=str.encode(ENCRYPTION_KEY)) as csv_file:
+                    header = csv_file.readline(MAX_HEADER_BYTES)
+                    columns = check_header(header, fname)
+                    report = report_type(columns) if columns else None
+                    file_name = format_file_name(emailObject, fname, report)
+                    client.upload_fileobj(
+                        HeaderReader(header, csv_file),
+                        BUCKET_NAME,
+                        file_name,
+                        Config=TRANSFER_CONFIG,
+                    )
+            uploaded.append((file_name, report))
+    return uploaded
+
+
+def df_to_s3(df, client, filename):
     """
     Send pandas dataframe to an S3 bucket as a CSV
     h/t https://stackoverflow.com/questions/38154040/save-dataframe-to-csv-directly-to-s3-python
     Parameters
     ----------
     df : Pandas Dataframe
-    resource : boto3 s3 resource
+    client : boto3 s3 client
     filename : String of the file that will be created in the S3 bucket ex:
     """
     csv_buffer = StringIO()
     df.to_csv(csv_buffer, index=False)
-    resource.Object(BUCKET_NAME, filename).put(Body=csv_buffer.getvalue())
+    client.put_object(Bucket=BUCKET_NAME, Key=filename, Body=csv_buffer.getvalue())
+
+
+def archive_emails(email_files, client):
+    """
+    Copies emails to the archive folder, ARCHIVE_WORKERS at a time
+    :param email_files: the full paths to the email files
+    :param client: boto3 s3 client
+    :return: list of the emails which were archived
+    """
+
+    def archive(email_file):
+        client.copy_object(
+            Bucket=BUCKET_NAME,
+            Key="emails/archive/" + get_file_name(email_file),
+            CopySource={"Bucket": BUCKET_NAME, "Key": email_file},
+        )
+
+    archived = []
+    with ThreadPoolExecutor(max_workers=ARCHIVE_WORKERS) as executor:
+        futures = {
+            executor.submit(archive, email_file): email_file
+            for email_file in email_files
+        }
+        for future in as_completed(futures):
+            email_file = futures[future]
+            try:
+                future.result()
+                archived.append(email_file)
+            except Exception as e:
+                logger.error(f"Failed to archive email: {email_file}: {e}")
+    return archived
+
+
+def delete_emails(email_files, client):
+    """
+    Removes emails from the inbox, DELETE_BATCH_SIZE per request. Keys S3 reports it
+    couldn't delete are retried up to DELETE_RETRIES times.
+    :param email_files: the full paths to the email files
+    :param client: boto3 s3 client
+    :return: list of the emails which couldn't be deleted
+    """
+    remaining = list(email_files)
+    for attempt in range(DELETE_RETRIES + 1):
+        if not remaining:
+            break
+        leftover = []
+        for i in range(0, len(remaining), DELETE_BATCH_SIZE):
+            batch = remaining[i : i + DELETE_BATCH_SIZE]
+            try:
+                response = client.delete_objects(
+                    Bucket=BUCKET_NAME,
+                    Delete={"Objects": [{"Key": key} for key in batch]},
+                )
+            except Exception as e:
+                logger.warning(f"Failed to delete {len(batch)} emails: {e}")
+                leftover.extend(batch)
+                continue
+            # Checked key by key, a request can succeed with some of its keys failing
+            deleted = {d["Key"] for d in response.get("Deleted", [])}
+            for error in response.get("Errors", []):
+                logger.warning(
+                    f"Failed to delete email: {error['Key']}: {error.get('Message')}"
+                )
+            leftover.extend(key for key in batch if key not in deleted)
+        remaining = leftover
+    return remaining
 
 
-def main():
-    # Initialize AWS clients
+def process_email(email_file, client, reformat=False):
+    """
+    Uploads the CSVs in an email's zip attachments, ATTACHMENT_WORKERS attachments at a time.
+    :param email_file: the full path to the email file
+    :param client: boto3 s3 client, which unlike boto3 resources is safe to share between threads
+    :param reformat: parse the CSVs with pandas and write them back out, rather than uploading them as they are
+    :return: True if it's a Fiserv email whose CSVs were all uploaded, so it can be removed from the inbox
+    """
+    # Downloads email contents
+    spool = download_s3_file(email_file, client)
+    if spool is None:
+        logger.warning(f"Skipped email over the size limit: {email_file}")
+        return False
+
+    with spool:
+        emailObject = parse_email(spool)
+
+    attachments = [
+        attachment
+        for attachment in emailObject.attachments
+        if (attachment.get("filename") or "").lower().endswith(".zip")
+    ]
+
+    # email must be from Fiserv
+    if len(attachments) > 0 and emailObject.headers["From"] == FSRV_EMAIL:
+
+        logger.debug(f"Loaded Email File: {email_file}")
+
+        # An attachment failing fails the whole email, which is retried on the next run
+        with ThreadPoolExecutor(
+            max_workers=min(ATTACHMENT_WORKERS, len(attachments))
+        ) as executor:
+            results = executor.map(
+                lambda attachment: attachment_to_s3(
+                    attachment, emailObject, client, reformat
+                ),
+                attachments,
+            )
+            uploaded = [upload for result in results for upload in result]
+
+        for file_name, report in uploaded:
+            if report:
+                logger.debug(f"Uploaded {report} report: {file_name}")
+            else:
+                logger.warning(f"Uploaded report of an unknown type: {file_name}")
+        return True
+
+    return False
+
+
+def process_emails(email_file_list, client, workers, reformat):
+    """
+    Archives emails, uploads their CSVs and removes them from the inbox
+    :param email_file_list: the full paths to the email files
+    :param client: boto3 s3 client
+    :param workers: number of emails processed at once
+    :param reformat: passed on to process_email
+    :return: list of the emails which failed and were left in the inbox
+    """
+    # Send a copy of the emails to the archive folder, the ones which fail are left
+    # in the inbox until the next run
+    archived = archive_emails(email_file_list, client)
+    failed = sorted(set(email_file_list) - set(archived))
+
+    # Emails are independent, one failing doesn't stop the rest
+    processed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(process_email, email_file, client, reformat): email_file
+            for email_file in archived
+        }
+        for future in as_completed(futures):
+            email_file = futures[future]
+            try:
+                if future.result():
+                    processed.append(email_file)
+            except Exception as e:
+                logger.error(f"Failed to process email: {email_file}: {e}")
+                failed.append(email_file)
+
+    # Removes the archived and uploaded emails from the inbox
+    not_deleted = delete_emails(processed, client)
+    failed.extend(not_deleted)
+    logger.debug(f"Removed {len(processed) - len(not_deleted)} emails from the inbox")
+
+    return failed
+
+
+def get_event_emails(message):
+    """
+    Returns the inbox emails created according to an SQS message of S3 event
+    notifications, which can be wrapped in an SNS notification
+    :param message: SQS message
+    :return: list of the full paths to the email files
+    """
+    body = json.loads(message["Body"])
+    if body.get("Type") == "Notification":
+        body = json.loads(body["Message"])
+
+    email_files = []
+    # s3:TestEvent messages have no records
+    for record in body.get("Records", []):
+        if not record.get("eventName", "").startswith("ObjectCreated"):
+            continue
+        s3_object = record["s3"]["object"]
+        # Keys are URL encoded in notifications
+        key = unquote_plus(s3_object["key"])
+        if not key.startswith(INBOX_PREFIX) or key == INBOX_PREFIX:
+            continue
+        if s3_object.get("size", 0) > MAX_EMAIL_BYTES:
+            logger.warning(f"Skipped email over the size limit: {key}")
+            continue
+        email_files.append(key)
+    return email_files
+
+
+def email_exists(client, email_file):
+    """
+    Checks if an email is still in the inbox
+    :return: bool
+    """
+    try:
+        client.head_object(Bucket=BUCKET_NAME, Key=email_file)
+        return True
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("404", "NoSuchKey"):
+            return False
+        raise e
+
+
+def listen(queue_url, client, s3, sqs, args):
+    """
+    Processes emails as their S3 notifications arrive on an SQS queue. The whole inbox
+    is scanned at the start and every --reconcile-minutes, for emails whose notification
+    went missing or failed.
+
+    A message is deleted from the queue once all of its emails have been processed (or
+    are no longer in the inbox). Messages with a failed email become visible on the queue
+    again after its visibility timeout and are retried.
+    :return: None
+    """
+    last_scan = None
+    idle_polls = 0
+    while True:
+        if last_scan is None or time.monotonic() - last_scan >= args.reconcile_minutes * 60:
+            email_file_list = get_email_list(s3)
+            logger.debug(f"Emails in inbox: {len(email_file_list)}")
+            process_emails(email_file_list, client, args.workers, args.reformat)
+            last_scan = time.monotonic()
+
+        response = sqs.receive_message(
+            QueueUrl=queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=POLL_SECONDS
+        )
+        messages = response.get("Messages", [])
+        if not messages:
+            idle_polls += 1
+            if args.max_idle_polls and idle_polls >= args.max_idle_polls:
+                return
+            continue
+        idle_polls = 0
+
+        message_emails = {m["MessageId"]: get_event_emails(m) for m in messages}
+        # Emails already taken care of by an earlier message or scan are skipped
+        email_file_list = [
+            f
+            for f in sorted({f for files in message_emails.values() for f in files})
+            if email_exists(client, f)
+        ]
+        logger.debug(f"Emails from notifications: {len(email_file_list)}")
+
+        failed = process_emails(email_file_list, client, args.workers, args.reformat)
+        # Emails processed by another run in the meantime aren't retried
+        failed = {f for f in failed if email_exists(client, f)}
+
+        done = [
+            {"Id": m["MessageId"], "ReceiptHandle": m["ReceiptHandle"]}
+            for m in messages
+            if not failed.intersection(message_emails[m["MessageId"]])
+        ]
+        if done:
+            sqs.delete_message_batch(QueueUrl=queue_url, Entries=done)
+
+
+def main(args):
+    # Initialize AWS clients, the client is shared by the workers
     aws_s3_client = boto3.client(
-        "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS,
+        "s3",
+        aws_access_key_id=AWS_ACCESS_ID,
+        aws_secret_access_key=AWS_PASS,
+        endpoint_url=AWS_ENDPOINT_URL,
+        config=Config(max_pool_connections=max(ARCHIVE_WORKERS, args.workers)),
     )
 
     s3 = boto3.resource(
-        "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS,
+        "s3",
+        aws_access_key_id=AWS_ACCESS_ID,
+        aws_secret_access_key=AWS_PASS,
+        endpoint_url=AWS_ENDPOINT_URL,
     )
 
+    if args.queue_url:
+        sqs = boto3.client(
+            "sqs",
+            aws_access_key_id=AWS_ACCESS_ID,
+            aws_secret_access_key=AWS_PASS,
+            endpoint_url=AWS_ENDPOINT_URL,
+        )
+        listen(args.queue_url, aws_s3_client, s3, sqs, args)
+        return
+
     email_file_list = get_email_list(s3)
 
     logger.debug(f"Emails in inbox: {len(email_file_list)}")
 
-    if len(email_file_list) > 0:
-        for email_file in email_file_list:
-
-            # Downloads email contents to disk
-            download_s3_file(email_file, aws_s3_client)
-
-            # Send a copy of the file to the archive folder
-            s3.Object(
-                BUCKET_NAME, "emails/archive/" + get_file_name(email_file)
-            ).copy_from(CopySource=BUCKET_NAME + "/" + email_file)
+    if len(email_file_list) == 0:
+        logger.debug(f"Zero emails in inbox, nothing happened.")
+        return
 
-            emailObject = parse_email(email_file)
+    failed = process_emails(email_file_list, aws_s3_client, args.workers, args.reformat)
 
-            # email must be from Fiserv
-            if (
-                len(emailObject.attachments) > 0
-                and emailObject.headers["From"] == FSRV_EMAIL
-            ):
+    if failed:
+        raise Exception(f"Failed to process {len(failed)} emails: {', '.join(failed)}")
 
-                logger.debug(f"Loaded Email File: {email_file}")
 
-                # Create a file name and path for the email
-                file_name = format_file_name(emailObject)
-                attachment_name = emailObject.attachments[0]["filename"][:-3]
-                attachment_name = f"{attachment_name}csv"
+if __name__ == "__main__":
+    # CLI arguments definition
+    parser = argparse.ArgumentParser()
 
-                # Parse attachment contents
-                df = decode_file_contents(
-                    emailObject.attachments[0]["payload"], attachment_name
-                )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help=f"Number of emails processed at once. Defaults to 1",
+    )
 
-                # Uploading CSV to S3
-                df_to_s3(df, s3, file_name)
-                logger.debug(f"Uploaded file: {file_name}")
+    parser.add_argument(
+        "--reformat",
+        action="store_true",
+        help=f"Parse each CSV with pandas and write it back out, instead of uploading the decrypted CSV as it is",
+    )
 
-                # Removes the file from processed folder
-                s3.Object(BUCKET_NAME, email_file).delete()
+    parser.add_argument(
+        "--queue-url",
+        help=f"Keep running, processing emails as the bucket's object created notifications for emails/new/ arrive on this SQS queue. Without it the inbox is scanned once",
+    )
 
-    else:
-        logger.debug(f"Zero emails in inbox, nothing happened.")
+    parser.add_argument(
+        "--reconcile-minutes",
+        type=int,
+        default=60,
+        help=f"With --queue-url, how often the whole inbox is scanned for emails whose notification was missed. Defaults to 60",
+    )
 
+    parser.add_argument(
+        "--max-idle-polls",
+        type=int,
+        help=f"With --queue-url, stop after this many polls of the queue in a row (20 seconds each) find nothing. Defaults to never stopping",
+    )
 
-logger = utils.get_logger(__file__, level=logging.DEBUG)
+    args = parser.parse_args()
 
-main()
+    main(args)
@@ -8,6 +8,8 @@ import logging
 from pypgrest import Postgrest
 import pandas as pd
 
+import matching
+import payments_cache
 import utils
 
 # Envrioment variables
@@ -17,6 +19,17 @@ DATE_FORMAT_HUMANS = "%Y-%m-%d"
 POSTGREST_TOKEN = os.getenv("POSTGREST_TOKEN")
 POSTGREST_ENDPOINT = os.getenv("POSTGREST_ENDPOINT")
 
+# Postgres function which does the same match as main() without leaving the database
+MATCH_RPC = "rpc/match_fiserv_payments"
+
+# --windowed mode: unmatched fiserv rows are read from this view a page at a time
+# and the rows still unmatched afterwards have their attempts counted in the table
+UNMATCHED_VIEW = "fiserv_unmatched"
+ATTEMPTS_TABLE = "fiserv_match_attempts"
+
+# Rows per request when paging through postgres and writing matches back
+PAGE_SIZE = 5000
+
 
 def handle_date_args(start_string, end_string):
     """Parse or set default start and end dates from CLI args.
@@ -78,6 +91,111 @@ def get_fiserv(pstgrs):
     return fiserv
 
 
+def get_fiserv_window(pstgrs, start, end, max_attempts):
+    """
+    Asks postgres for the unmatched fiserv data with a transaction_date between the
+    start/end dates, leaving out rows which have already failed to match max_attempts times.
+    Pages through the rows by id so no request returns more than PAGE_SIZE of them.
+    Parameters
+    ----------
+    pstgrs : Postgrest client object
+    start : datetime
+        Earliest transaction_date to fetch.
+    end : datetime
+        Latest transaction_date to fetch.
+    max_attempts : int
+        Rows which have been through this many runs without a match are skipped.
+
+    Returns
+    -------
+    fiserv : Pandas Dataframe
+        The unmatched fiserv rows in the window, with their match_attempts so far.
+
+    """
+    params = {
+        "select": "id,invoice_id,transaction_date,match_attempts",
+        "and": f"(transaction_date.gte.{start},transaction_date.lte.{end})",
+        "match_attempts": f"lt.{max_attempts}",
+        "order": "id",
+        "limit": PAGE_SIZE,
+    }
+
+    rows = select_pages(pstgrs, UNMATCHED_VIEW, params)
+
+    fiserv = pd.DataFrame(
+        rows, columns=["id", "invoice_id", "transaction_date", "match_attempts"]
+    )
+    return fiserv
+
+
+def get_rematch_data(pstgrs, start, end):
+    """
+    Asks postgres for every fiserv record and payment (matched or not) with a
+    transaction_date between the start/end dates, for rematching a date range.
+    Parameters
+    ----------
+    pstgrs : Postgrest client object
+    start : datetime
+        Earliest transaction_date to fetch.
+    end : datetime
+        Latest transaction_date to fetch.
+
+    Returns
+    -------
+    fiserv : Pandas Dataframe
+        The fiserv records with their current flowbird_id.
+    payments : Pandas Dataframe
+        The payments which can be matched.
+
+    """
+    params = {
+        "select": "id,invoice_id,transaction_date,flowbird_id",
+        "and": f"(transaction_date.gte.{start},transaction_date.lte.{end})",
+        "invoice_id": "not.is.null",
+        "order": "id",
+        "limit": PAGE_SIZE,
+    }
+    fiserv = pd.DataFrame(
+        select_pages(pstgrs, "fiserv_reports_raw", params),
+        columns=["id", "invoice_id", "transaction_date", "flowbird_id"],
+    )
+
+    params["select"] = "id,invoice_id,transaction_date,updated_at"
+    payments = pd.DataFrame(
+        select_pages(pstgrs, "flowbird_payments_raw", params),
+        columns=["id", "invoice_id", "transaction_date", "updated_at"],
+    )
+    return fiserv, payments
+
+
+def select_pages(pstgrs, resource, params):
+    """
+    Selects all the rows matching params a page at a time, keyed on id.
+    Parameters
+    ----------
+    pstgrs : Postgrest client object
+    resource : String
+        Table or view.
+    params : Dict
+        PostgREST params, ordered by id with a limit.
+
+    Returns
+    -------
+    rows : List
+        The rows of every page.
+
+    """
+    params = dict(params)
+    rows = []
+    while True:
+        page = pstgrs.select(resource=resource, params=params, pagination=False)
+        rows.extend(page)
+        if len(page) < params["limit"]:
+            break
+        params["id"] = f"gt.{page[-1]['id']}"
+    return rows
+
+
 def get_payments(pstgrs, start, end):
     """
     Asks postgres for the payments data based on CLI arguments (if given)
@@ -121,9 +239,10 @@ def datetime_handling(df):
         The input dataframe sorted by the transcation_date with the datetime datatype.
 
     """
-    df["transaction_date"] = pd.to_datetime(
-        df["transaction_date"], format="%Y-%m-%d %H:%M:%S", infer_datetime_format=True,
-    )
+    # PostgREST sends ISO 8601 with a T. pandas 1.x parsed an ISO 8601 format with
+    # infer_datetime_format like no format at all, pandas 2 removed infer_datetime_format
+    # and parses a format strictly, so none is given
+    df["transaction_date"] = pd.to_datetime(df["transaction_date"])
     df = df.sort_values(by=["transaction_date"])
 
     return df
@@ -131,7 +250,10 @@ def datetime_handling(df):
 
 def to_postgres(output, pstgrs):
     """
-    This function cleans up the merged dataframe and then upserts the matched data back to the database
+    This function cleans up the merged dataframe and then upserts the matched data back to the database.
+    Only the fiserv records whose flowbird_id is new or different are sent. Fiserv records
+    fetched with their current match (--rematch) whose match is now outside the tolerance
+    have it cleared.
     Parameters
     ----------
     output : Pandas Dataframe
@@ -140,23 +262,102 @@ def to_postgres(output, pstgrs):
 
     Returns
     -------
-    None.
+    sent : int
+        The number of fiserv records given a new or different match.
+    cleared : int
+        The number of fiserv records whose match was cleared.
 
     """
+    cleared = []
+    if "flowbird_id" in output and "outside_tolerance" in output:
+        stale = output[output["outside_tolerance"] & output["flowbird_id"].notna()]
+        cleared = [{"id": id, "flowbird_id": None} for id in stale["id_x"]]
+
+    output = output.dropna(subset=["id_y"])
+
+    # Fiserv records fetched with their current match, skip the ones it hasn't changed
+    if "flowbird_id" in output:
+        output = output[output["flowbird_id"] != output["id_y"]]
+
     output = output[["id_x", "id_y"]]
 
     output = output.rename(columns={"id_x": "id", "id_y": "flowbird_id"})
 
     output = output[["id", "flowbird_id"]]
 
-    output = output.dropna(subset=["flowbird_id"])
-
     output["flowbird_id"] = output["flowbird_id"].astype(int)
 
-    payload = output.to_dict(orient="records")
+    sent = len(output)
+    payload = output.to_dict(orient="records") + cleared
+
+    for i in range(0, len(payload), PAGE_SIZE):
+        try:
+            res = pstgrs.upsert(
+                resource="fiserv_reports_raw", data=payload[i : i + PAGE_SIZE]
+            )
+        except Exception as e:
+            logger.error(pstgrs.res.text)
+            raise e
+
+    return sent, len(cleared)
+
+
+def record_attempts(output, pstgrs):
+    """
+    Counts another attempt for each of the fiserv rows which didn't match this run.
+    Parameters
+    ----------
+    output : Pandas Dataframe
+        The merged dataframe, from fiserv rows fetched with get_fiserv_window.
+    pstgrs : Postgrest client object
+
+    Returns
+    -------
+    None.
+
+    """
+    unmatched = output[output["id_y"].isna()]
+    unmatched = unmatched.rename(columns={"id_x": "id"})
+    unmatched["attempts"] = unmatched["match_attempts"] + 1
+
+    payload = unmatched[["id", "attempts"]].to_dict(orient="records")
+
+    for i in range(0, len(payload), PAGE_SIZE):
+        try:
+            res = pstgrs.upsert(
+                resource=ATTEMPTS_TABLE, data=payload[i : i + PAGE_SIZE]
+            )
+        except Exception as e:
+            logger.error(pstgrs.res.text)
+            raise e
+
+
+def match_in_database(pstgrs, start, end, tolerance=None):
+    """
+    Has postgres match the unmatched fiserv rows to the payments updated between the
+    start/end dates and set their flowbird_id, without sending either table over the wire.
+    Parameters
+    ----------
+    pstgrs : Postgrest client object
+    start : datetime
+        Start date of the updated_at field to search for potential matches.
+    end : datetime
+        End date of the updated_at field to search for potential matches.
+    tolerance : Pandas Timedelta
+        The furthest apart a fiserv record and its payment can be, no limit if None.
+
+    Returns
+    -------
+    matched : int
+        The number of fiserv rows given a flowbird_id.
+
+    """
+    data = {"start_date": start.isoformat(), "end_date": end.isoformat()}
+    if tolerance is not None:
+        data["tolerance"] = f"{tolerance.total_seconds()} seconds"
 
     try:
-        res = pstgrs.upsert(resource="fiserv_reports_raw", data=payload)
+        return pstgrs.insert(resource=MATCH_RPC, data=data)
     except Exception as e:
         logger.error(pstgrs.res.text)
         raise e
@@ -172,46 +373,168 @@ def main(args):
 
     # format date arugments
     start_date, end_date = handle_date_args(args.start, args.end)
+    tolerance = pd.Timedelta(args.tolerance) if args.tolerance else None
+
+    if args.in_database:
+        matched = match_in_database(pstgrs, start_date, end_date, tolerance)
+        logger.info(f"Matched {matched} fiserv records")
+        return
 
     # Get data from postgres database
-    fiserv = get_fiserv(pstgrs)
-    payments = get_payments(pstgrs, start_date, end_date)
+    if args.rematch:
+        margin = timedelta(days=args.margin)
+        fiserv, payments = get_rematch_data(
+            pstgrs, start_date - margin, end_date + margin
+        )
+        logger.debug(f"Fetched {len(fiserv)} fiserv records, {len(payments)} payments")
+    elif args.windowed:
+        margin = timedelta(days=args.margin)
+        fiserv = get_fiserv_window(
+            pstgrs, start_date - margin, end_date + margin, args.max_attempts
+        )
+        logger.debug(f"Fetched {len(fiserv)} unmatched fiserv records")
+    else:
+        fiserv = get_fiserv(pstgrs)
+
+    # An empty frame has object columns, which can't be merged with the payments
+    if fiserv.empty:
+        logger.info("No fiserv records to match")
+        return
 
     # Handling datatype for the transaction_date column (postgres returns a str)
     fiserv = datetime_handling(fiserv)
-    payments = datetime_handling(payments)
-
-    # Merge the two datasets first based on the match_field column.
-    # If there are multiple matches (dupes),
-    # then match based on the closest transaction_date.
-    output = pd.merge_asof(
-        left=fiserv,
-        right=payments,
-        by="invoice_id",
-        on="transaction_date",
-        direction="nearest",
-    )
+
+    if args.rematch:
+        payments = datetime_handling(payments)
+    elif args.payments_cache:
+        # Already typed and sorted
+        cache, fetched, removed = payments_cache.refresh(
+            pstgrs,
+            args.payments_cache,
+            rebuild=args.rebuild_payments_cache,
+            reconcile_every=pd.Timedelta(days=args.reconcile_days),
+        )
+        logger.debug(
+            f"Fetched {fetched} updated payments, dropped {removed} deleted ones, {len(cache)} cached"
+        )
+        payments = payments_cache.window(cache, start_date, end_date)
+    else:
+        payments = get_payments(pstgrs, start_date, end_date)
+        payments = datetime_handling(payments)
+
+    if args.rematch:
+        output, outside = matching.partitioned_match(
+            fiserv,
+            payments,
+            tolerance,
+            partitions=args.partitions,
+            workers=args.workers,
+        )
+    else:
+        output, outside = matching.match(fiserv, payments, tolerance)
+
     # Clean up the output table and send it back to postgres
-    to_postgres(output, pstgrs)
+    sent, cleared = to_postgres(output, pstgrs)
+
+    matched = int(output["id_y"].notna().sum())
+    logger.info(
+        f"{matched} fiserv records matched ({sent} new or changed, {matched - sent} unchanged), "
+        f"{outside} outside tolerance ({cleared} earlier matches cleared), "
+        f"{len(output) - matched - outside} without a match"
+    )
+
+    if args.windowed:
+        record_attempts(output, pstgrs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--start",
+        type=str,
+        help=f"Date (in UTC) of earliest records to be searched for matches (YYYY-MM-DD). Defaults to 2022-01-01.",
+    )
+
+    parser.add_argument(
+        "--end",
+        type=str,
+        help=f"Date (in UTC) of the most recent records to be searched for matches (YYYY-MM-DD). Defaults to today",
+    )
+
+    parser.add_argument(
+        "--in-database",
+        action="store_true",
+        help=f"Match inside postgres (api.match_fiserv_payments) instead of fetching both tables",
+    )
 
+    parser.add_argument(
+        "--windowed",
+        action="store_true",
+        help=f"Only try to match fiserv records with a transaction_date within --margin days of --start/--end",
+    )
+
+    parser.add_argument(
+        "--rematch",
+        action="store_true",
+        help=f"Match every fiserv record (matched or not) to every payment with a transaction_date within --margin days of --start/--end, in parallel",
+    )
+
+    parser.add_argument(
+        "--margin",
+        type=int,
+        default=3,
+        help=f"Days either side of --start/--end to look for records in with --windowed or --rematch. Defaults to 3",
+    )
+
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=5,
+        help=f"With --windowed, skip fiserv records which have failed to match this many times. Defaults to 5",
+    )
+
+    parser.add_argument(
+        "--payments-cache",
+        nargs="?",
+        const=payments_cache.CACHE_PATH,
+        help=f"Match against a local Parquet copy of flowbird_payments_raw, only downloading the payments updated since the last run. Optionally the path of the file, defaults to the PAYMENTS_CACHE env var or {payments_cache.CACHE_PATH}",
+    )
+
+    parser.add_argument(
+        "--rebuild-payments-cache",
+        action="store_true",
+        help=f"With --payments-cache, download every payment again instead of only the ones updated since the last run",
+    )
+
+    parser.add_argument(
+        "--reconcile-days",
+        type=int,
+        default=payments_cache.RECONCILE_EVERY.days,
+        help=f"With --payments-cache, how many days apart to download every payment id and drop deleted payments from the cache. Defaults to the PAYMENTS_CACHE_RECONCILE_DAYS env var or 7",
+    )
 
-# CLI arguments definition
-parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--tolerance",
+        type=str,
+        help=f"Only match fiserv records to payments within this much time of them, such as '3 days' or '12h'. No limit by default",
+    )
 
-parser.add_argument(
-    "--start",
-    type=str,
-    help=f"Date (in UTC) of earliest records to be searched for matches (YYYY-MM-DD). Defaults to 2022-01-01.",
-)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help=f"Number of processes matching with --rematch. Defaults to the number of CPUs",
+    )
 
-parser.add_argument(
-    "--end",
-    type=str,
-    help=f"Date (in UTC) of the most recent records to be searched for matches (YYYY-MM-DD). Defaults to today",
-)
+    parser.add_argument(
+        "--partitions",
+        type=int,
+        default=64,
+        help=f"Number of partitions (by invoice_id) the data is split into with --rematch, more partitions use less memory per process. Defaults to 64",
+    )
 
-args = parser.parse_args()
+    args = parser.parse_args()
 
-logger = utils.get_logger(__file__, level=logging.DEBUG)
+    logger = utils.get_logger(__file__, level=logging.DEBUG)
 
-main(args)
+    main(args)
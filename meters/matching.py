@@ -0,0 +1,222 @@
+"""Nearest-in-time matching of Fiserv records to Flowbird payments by invoice_id"""
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import multiprocessing
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def apply_tolerance(output, tolerance):
+    """
+    Drops the matches whose payment is further away in time than the tolerance, such
+    as an invoice_id reused months apart.
+    Parameters
+    ----------
+    output : Pandas Dataframe
+        The merged dataframe, with the matched payment's transaction_date in payment_date.
+    tolerance : Pandas Timedelta
+        The furthest apart a fiserv record and its payment can be.
+
+    Returns
+    -------
+    output : Pandas Dataframe
+        The merged dataframe without the matches outside the tolerance, which are
+        flagged in outside_tolerance.
+    outside : int
+        The number of matches dropped.
+
+    """
+    distance = (output["transaction_date"] - output["payment_date"]).abs()
+    outside = distance > tolerance
+    output["id_y"] = output["id_y"].where(~outside)
+    output["outside_tolerance"] = outside
+    return output, int(outside.sum())
+
+
+def match(fiserv, payments, tolerance=None):
+    """
+    Matches each fiserv record to the payment with the same invoice_id and the closest
+    transaction_date.
+    Parameters
+    ----------
+    fiserv : Pandas Dataframe
+        Fiserv records sorted by transaction_date.
+    payments : Pandas Dataframe
+        Payments sorted by transaction_date.
+    tolerance : Pandas Timedelta
+        The furthest apart a fiserv record and its payment can be, no limit if None.
+
+    Returns
+    -------
+    output : Pandas Dataframe
+        The fiserv records with the matched payment's id in id_y (the fiserv id is id_x).
+    outside : int
+        The number of matches dropped for being outside the tolerance.
+
+    """
+    # Keep the matched payment's transaction_date to check it against the tolerance
+    payments = payments.assign(payment_date=payments["transaction_date"])
+
+    # Merge the two datasets first based on the match_field column.
+    # If there are multiple matches (dupes),
+    # then match based on the closest transaction_date.
+    output = pd.merge_asof(
+        left=fiserv,
+        right=payments,
+        by="invoice_id",
+        on="transaction_date",
+        direction="nearest",
+    )
+
+    outside = 0
+    if tolerance is not None:
+        output, outside = apply_tolerance(output, tolerance)
+
+    return output, outside
+
+
+def partition(df, partitions):
+    """
+    Splits a dataframe into partitions by a hash of invoice_id, so all the rows for
+    an invoice_id end up in the same partition. Rows keep their order.
+    Parameters
+    ----------
+    df : Pandas Dataframe
+        Rows with an invoice_id.
+    partitions : int
+        Number of partitions.
+
+    Returns
+    -------
+    parts : list
+        The positions in df of the rows of each partition, some of them can be empty.
+
+    """
+    invoice_ids = df["invoice_id"].to_numpy()
+    if np.issubdtype(invoice_ids.dtype, np.integer):
+        # Cheaper than hashing and just as even, invoice_ids end in a sequence number
+        keys = invoice_ids % partitions
+    else:
+        keys = (
+            pd.util.hash_pandas_object(df["invoice_id"], index=False) % partitions
+        ).to_numpy()
+    # One stable sort by partition instead of a pass over the rows per partition, which
+    # numpy does as a linear radix sort for 16 bit keys
+    keys = keys.astype(np.int16 if partitions <= np.iinfo(np.int16).max else np.int64)
+    order = np.argsort(keys, kind="stable")
+    bounds = np.searchsorted(keys[order], np.arange(1, partitions))
+    return np.split(order, bounds)
+
+
+# What partitioned_match is matching, set before its pool of processes is forked so
+# the workers inherit the frames and partitions rather than having them pickled
+_shared = {}
+
+
+def match_partition(part, tolerance):
+    """
+    Matches one partition of the frames in _shared.
+    Parameters
+    ----------
+    part : int
+        The partition.
+    tolerance : Pandas Timedelta
+        The furthest apart a fiserv record and its payment can be, no limit if None.
+
+    Returns
+    -------
+    part : int
+        The partition.
+    matched : Pandas Dataframe
+        Only the columns the match added to the partition's fiserv records, the
+        parent process has the rest.
+    outside : int
+        The number of matches dropped for being outside the tolerance.
+
+    """
+    fiserv = _shared["fiserv"].iloc[_shared["fiserv_parts"][part]]
+    payments = _shared["payments"].iloc[_shared["payments_parts"][part]]
+    output, outside = match(fiserv, payments, tolerance)
+    return part, output.iloc[:, len(fiserv.columns) :], outside
+
+
+def partitioned_match(fiserv, payments, tolerance=None, partitions=64, workers=None):
+    """
+    Same result as match(), with the data split into partitions by invoice_id which
+    are matched in a pool of processes. merge_asof only ever matches rows with the same
+    invoice_id, so no match crosses partitions.
+
+    The workers are forked with the data already in memory and are only sent the number
+    of the partition to match, and they only send back the columns the match added.
+    Where processes can't be forked (Windows) the partitions are matched one at a time
+    in this process. At most two partitions per worker are waiting in the pool at once.
+    Parameters
+    ----------
+    fiserv : Pandas Dataframe
+        Fiserv records sorted by transaction_date.
+    payments : Pandas Dataframe
+        Payments sorted by transaction_date.
+    tolerance : Pandas Timedelta
+        The furthest apart a fiserv record and its payment can be, no limit if None.
+    partitions : int
+        Number of partitions to split the data into.
+    workers : int
+        Number of processes, defaults to the number of CPUs.
+
+    Returns
+    -------
+    output : Pandas Dataframe
+        The fiserv records with the matched payment's id in id_y (the fiserv id is id_x),
+        in the same order as match() returns them.
+    outside : int
+        The number of matches dropped for being outside the tolerance.
+
+    """
+    if fiserv.empty:
+        return match(fiserv, payments, tolerance)
+
+    _shared["fiserv"] = fiserv
+    _shared["payments"] = payments
+    _shared["fiserv_parts"] = partition(fiserv, partitions)
+    _shared["payments_parts"] = partition(payments, partitions)
+    parts = [p for p, rows in enumerate(_shared["fiserv_parts"]) if len(rows)]
+
+    results = []
+    try:
+        if "fork" in multiprocessing.get_all_start_methods():
+            workers = workers or os.cpu_count()
+            max_pending = workers * 2
+            with ProcessPoolExecutor(
+                max_workers=workers, mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                pending = set()
+                for part in parts:
+                    if len(pending) >= max_pending:
+                        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                        results.extend(future.result() for future in done)
+                    pending.add(executor.submit(match_partition, part, tolerance))
+                results.extend(future.result() for future in wait(pending).done)
+        else:
+            results = [match_partition(part, tolerance) for part in parts]
+
+        # Put the partitions' rows back where they were in fiserv, merge_asof keeps the
+        # order of its left side
+        positions = np.concatenate([_shared["fiserv_parts"][r[0]] for r in results])
+        order = np.empty_like(positions)
+        order[positions] = np.arange(len(positions))
+        matched = pd.concat([r[1] for r in results], ignore_index=True).iloc[order]
+    finally:
+        _shared.clear()
+
+    # The fiserv side of the columns as merge_asof names them
+    left = match(fiserv.iloc[:0], payments.iloc[:0], tolerance)[0]
+    left = left.columns[: len(fiserv.columns)]
+    output = pd.concat(
+        [
+            fiserv.set_axis(left, axis=1).reset_index(drop=True),
+            matched.reset_index(drop=True),
+        ],
+        axis=1,
+    )
+    return output, sum(r[2] for r in results)
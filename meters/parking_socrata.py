@@ -2,9 +2,19 @@
 import os
 import argparse
 from datetime import datetime, timezone, timedelta
+import json
 import logging
+import threading
+import time
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 
 # Related third-party imports
+import requests
 from sodapy import Socrata
 from pypgrest import Postgrest
 
@@ -26,14 +36,158 @@ FISERV_DATASET = os.getenv("FISERV_DATASET")
 METERS_DATASET = os.getenv("METERS_DATASET")
 PAYMENTS_DATASET = os.getenv("PAYMENTS_DATASET")
 TXNS_DATASET = os.getenv("TXNS_DATASET")
+DAILY_DATASET = os.getenv("DAILY_DATASET")
+
+# Number of records fetched from postgres and sent to Socrata at a time, this is
+# the starting point for a dataset's first run, after which BatchSizer adapts it
+PAGE_SIZE = 1000
+MIN_BATCH_SIZE = 100
+MAX_BATCH_SIZE = 20000
+
+# What BatchSizer aims for with each Socrata upsert
+TARGET_BATCH_BYTES = 4 * 1024 * 1024
+TARGET_UPSERT_SECONDS = 30
+
+# Times a batch is split and retried after a Socrata timeout or 5xx error
+MAX_RETRIES = 3
+
+# Postgres table where the last batch size chosen for each dataset is kept
+BATCH_SIZES_TABLE = "socrata_batch_sizes"
+
+# Postgres table with a hash of every record last published to each dataset, and the
+# function which reads the records whose hash has changed since
+PUBLISH_STATE_TABLE = "socrata_publish_state"
+CHANGED_RECORDS_RPC = "rpc/changed_records"
+
+# How many pages postgres can be read ahead of each Socrata upload worker
+PAGES_PER_WORKER = 2
 
 DATASETS = {
     "fiserv_reports_raw": FISERV_DATASET,
     "flowbird_transactions_raw": METERS_DATASET,
     "flowbird_payments_raw": PAYMENTS_DATASET,
     "transactions": TXNS_DATASET,
+    "transactions_daily": DAILY_DATASET,
 }
 
+# CLI dataset names -> postgres tables
+TABLES = {
+    "fiserv": "fiserv_reports_raw",
+    "meters": "flowbird_transactions_raw",
+    "payments": "flowbird_payments_raw",
+    "transactions": "transactions",
+    "daily": "transactions_daily",
+}
+
+
+class TableLogger(logging.LoggerAdapter):
+    """Prefixes log messages with the table being published, so the progress of
+    datasets being published at the same time can be told apart."""
+
+    def process(self, msg, kwargs):
+        return f"[{self.extra['table']}] {msg}", kwargs
+
+
+class BatchSizer:
+    """Chooses the number of records per Socrata upsert for one dataset.
+
+    Narrow and wide tables produce very different payloads for the same number of
+    records, so the batch size grows while upserts are small and quick and shrinks
+    when they go over TARGET_BATCH_BYTES/TARGET_UPSERT_SECONDS or fail.
+    Shared by the reader and upload workers of a table, so updates are locked.
+
+    Args:
+        size (int): The batch size to start with
+    """
+
+    def __init__(self, size=PAGE_SIZE):
+        self.lock = threading.Lock()
+        self.size = self._clamp(size)
+
+    @staticmethod
+    def _clamp(size):
+        return max(MIN_BATCH_SIZE, min(MAX_BATCH_SIZE, int(size)))
+
+    def record(self, rows, payload_bytes, seconds):
+        """Adjust the batch size after a successful upsert.
+
+        Args:
+            rows (int): Number of records sent
+            payload_bytes (int): Size of the JSON payload sent
+            seconds (float): How long the upsert took
+        """
+        with self.lock:
+            if seconds > TARGET_UPSERT_SECONDS:
+                size = self.size * 0.75
+            else:
+                # grow by half, but no further than the size which fits in the target bytes
+                bytes_per_row = max(payload_bytes / rows, 1)
+                size = min(self.size * 1.5, TARGET_BATCH_BYTES / bytes_per_row)
+            self.size = self._clamp(size)
+
+    def shrink(self):
+        """Halve the batch size after a timeout or server error.
+
+        Returns:
+            int: The new batch size
+        """
+        with self.lock:
+            self.size = self._clamp(self.size / 2)
+            return self.size
+
+
+def is_retryable(error):
+    """Socrata timeouts and 5xx errors are worth retrying with smaller batches"""
+    if isinstance(
+        error, (requests.exceptions.Timeout, requests.exceptions.ConnectionError)
+    ):
+        return True
+    if isinstance(error, requests.exceptions.HTTPError) and error.response is not None:
+        return error.response.status_code >= 500
+    return False
+
+
+def load_batch_size(pstgrs, table):
+    """Get the batch size chosen for the table on its last run.
+
+    Args:
+        pstgrs: Postgrest client object
+        table (string): The name of the table in postgres we are uploading
+
+    Returns:
+        int: The saved batch size, PAGE_SIZE if there isn't one
+    """
+    params = {"select": "batch_size", "dataset": f"eq.{table}"}
+    try:
+        res = pstgrs.select(resource=BATCH_SIZES_TABLE, params=params, pagination=False)
+    except requests.exceptions.HTTPError:
+        logger.warning(f"Could not read saved batch size for {table}: {pstgrs.res.text}")
+        return PAGE_SIZE
+    return res[0]["batch_size"] if res else PAGE_SIZE
+
+
+def save_batch_size(pstgrs, table, size):
+    """Save the batch size chosen for the table so the next run starts from it"""
+    try:
+        pstgrs.upsert(
+            resource=BATCH_SIZES_TABLE, data=[{"dataset": table, "batch_size": size}]
+        )
+    except requests.exceptions.HTTPError:
+        logger.warning(f"Could not save batch size for {table}: {pstgrs.res.text}")
+
+
+def save_hashes(pstgrs, table, hashes):
+    """Record the hashes of records which have been published to Socrata"""
+    payload = [
+        {"dataset": table, "row_id": row_id, "row_hash": row_hash}
+        for row_id, row_hash in hashes.items()
+    ]
+    try:
+        pstgrs.upsert(resource=PUBLISH_STATE_TABLE, data=payload)
+    except Exception as e:
+        logger.error(pstgrs.res.text)
+        raise e
+
 
 def tzcleanup(data):
     """Removes timezone from a postgres datetime field for upload to socrata.
@@ -83,87 +237,259 @@ def handle_date_args(start_string, end_string):
     return start_date, end_date
 
 
-def batch_upload(start, end, pstgrs, soda, table):
+def page_params(start, end, table, last_id, limit=PAGE_SIZE, full=False):
+    """Build the changed_records RPC arguments for one page of records updated between
+        start and end. Pages are keyed on the primary key (`id`) rather than an offset, so
+        postgres can seek straight to the next page instead of scanning past the earlier ones.
+
+    Args:
+        start (datetime): Inclusive date (UTC) of earliest records to be uploaded (updated_at)
+        end (datetime): Inclusive date (UTC) of latest records to be uploaded (updated_at)
+        table (string): The name of the table in postgres we are uploading
+        last_id (string or int): The largest `id` of the previous page, None for the first page.
+        limit (int): The number of records per page.
+        full (bool): Include records which haven't changed since they were last published
+
+    Returns:
+        dict: changed_records RPC arguments
+    """
+    return {
+        "dataset": table,
+        "start_date": start.isoformat(),
+        "end_date": end.isoformat(),
+        "after_id": None if last_id is None else str(last_id),
+        "page_size": limit,
+        "include_unchanged": full,
+    }
+
+
+def read_pages(start, end, pstgrs, table, sizer, full=False):
+    """Generator which yields pages of records from postgres updated between start and end.
+        Postgres hashes the records of each page and leaves out the ones which hash the
+        same as when they were last published, unless full is set. Pages with nothing
+        left in them aren't yielded.
+
+    Args:
+        start (datetime): Inclusive date (UTC) of earliest records to be uploaded (updated_at)
+        end (datetime): Inclusive date (UTC) of latest records to be uploaded (updated_at)
+        pstgrs: Postgrest client object
+        table (string): The name of the table in postgres we are uploading
+        sizer (BatchSizer): Gives the number of records to read for each page
+        full (bool): Include records which haven't changed since they were last published
+
+    Yields:
+        tuple: One page of records (list of dicts) and the hash of each of them (dict of
+            record ids, as strings, to hashes)
     """
-    Uploads data to Socrata in batches of 1,000 records.
+    last_id = None
+    while True:
+        params = page_params(start, end, table, last_id, limit=sizer.size, full=full)
+        response = pstgrs.insert(resource=CHANGED_RECORDS_RPC, data=params)
+        # Unchanged records come back without their record, only to move the page on
+        changed = [row for row in response if row["record"] is not None]
+        if changed:
+            page = [row["record"] for row in changed]
+            hashes = {row["row_id"]: row["row_hash"] for row in changed}
+            yield page, hashes
+        if len(response) < params["page_size"]:
+            return
+        last_id = response[-1]["row_id"]
+
+
+def upload_page(soda, table, page, slots, sizer, attempt=0):
+    """Upserts one page of postgres records to the table's Socrata dataset.
+        After a timeout or 5xx error the batch size is halved and the page is
+        retried in batches of the new size.
+
+    Args:
+        soda: SodaPy client object
+        table (string): The name of the table in postgres we are uploading
+        page (list of dicts): Records from postgres
+        slots (threading.Semaphore): Shared between all tables, limits the number
+            of upserts sent to Socrata at once.
+        sizer (BatchSizer): Told how big and how slow the upsert was
+        attempt (int): The number of times this page has been retried
+
+    Returns:
+        int: The number of records uploaded
+    """
+    payload_bytes = len(json.dumps(page))
+    try:
+        with slots:
+            started = time.monotonic()
+            soda.upsert(DATASETS[table], page)
+            seconds = time.monotonic() - started
+    except Exception as e:
+        if not is_retryable(e) or attempt >= MAX_RETRIES:
+            raise e
+        size = sizer.shrink()
+        logger.warning(
+            f"Upsert of {len(page)} records to {table} failed ({e}), retrying in batches of {size}"
+        )
+        for i in range(0, len(page), size):
+            upload_page(soda, table, page[i : i + size], slots, sizer, attempt + 1)
+        return len(page)
+
+    sizer.record(len(page), payload_bytes, seconds)
+    return len(page)
+
+
+def batch_upload(start, end, pstgrs, soda, table, workers=1, slots=None, full=False):
+    """
+    Uploads data to Socrata in batches, starting from the size chosen on the
+    table's last run and adapted by BatchSizer as the upserts come back.
+    Records whose contents match what was last published to Socrata are left out by
+    postgres, unless full is set.
+    Postgres is read on this thread while a pool of workers upserts to Socrata, so
+    the next pages are fetched while earlier ones are being published. The reader
+    stops and waits once it is PAGES_PER_WORKER pages per worker ahead.
     Parameters
     ----------
-    start (string): Inclusive date (UTC) of earliest records to be uploaded (updated_at)
-    end (string): Inclusive date (UTC) of latest records to be uploaded (updated_at)
+    start (datetime): Inclusive date (UTC) of earliest records to be uploaded (updated_at)
+    end (datetime): Inclusive date (UTC) of latest records to be uploaded (updated_at)
     pstgrs: Postgrest client object
     soda: SodaPy client object
     table (string): The name of the table in postgres we are uploading
+    workers (int): Number of threads upserting to Socrata at once
+    slots (threading.Semaphore): Limits upserts to Socrata across all tables
+        being published. Defaults to no limit beyond workers.
+    full (bool): Publish every record in the date range, even unchanged ones
 
     Returns
-    None
+    records (int): The number of records published
     -------
 
     """
-    logger.debug(f"Publishing table: {table} to Socrata from {start} to {end}")
-    paginate = True
-    offset = 0
-    while paginate:
-        params = {
-            "select": "*",
-            "and": f"(updated_at.lte.{end},updated_at.gte.{start})",
-            "order": "id",
-            "limit": 1000,
-            "offset": offset,
-        }
-        offset += 1000
-        response = pstgrs.select(resource=table, params=params, pagination=True)
-        if len(response) == 0:
-            paginate = False
-        else:
-            response = tzcleanup(response)
-            if offset % 10000 == 0:
-                logger.debug(f"Uploading chunks: {offset} records so far")
-            soda.upsert(DATASETS[table], response)
+    log = TableLogger(logger, {"table": table})
+    log.debug(f"Publishing to Socrata from {start} to {end}")
+    if slots is None:
+        slots = threading.BoundedSemaphore(workers)
+    sizer = BatchSizer(load_batch_size(pstgrs, table))
+    log.debug(f"Starting with batches of {sizer.size} records")
+    max_pending = workers * PAGES_PER_WORKER
+    records = 0
+    # upload futures -> hashes of the records being uploaded
+    pending = {}
+
+    def finish(futures):
+        # Hashes are only saved once their records have made it to Socrata
+        nonlocal records
+        for future in futures:
+            records += future.result()
+            save_hashes(pstgrs, table, pending.pop(future))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for page, hashes in read_pages(start, end, pstgrs, table, sizer, full):
+            page = tzcleanup(page)
+            future = executor.submit(upload_page, soda, table, page, slots, sizer)
+            pending[future] = hashes
+            if len(pending) < max_pending:
+                continue
+            # Backpressure: wait for an upload to finish before reading further
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            finish(done)
+            log.debug(
+                f"Uploading chunks: {records} records so far, batch size {sizer.size}"
+            )
 
-def main(args):
-    ## Client objects
-    # postgrest
-    pstgrs = Postgrest(
+        finish(as_completed(list(pending)))
+
+    log.debug(f"Published {records} records, next run starts at {sizer.size}")
+    save_batch_size(pstgrs, table, sizer.size)
+    return records
+
+
+def get_postgrest_client():
+    return Postgrest(
         POSTGREST_ENDPOINT,
         token=POSTGREST_TOKEN,
         headers={"Prefer": "return=representation"},
     )
-    # sodapy
-    soda = Socrata(SO_WEB, SO_TOKEN, username=SO_USER, password=SO_PASS, timeout=500,)
 
-    # format date arguments
-    start_date, end_date = handle_date_args(args.start, args.end)
 
-    # CLI argument logic
-    if args.dataset:
-        if args.dataset == "fiserv":
-            batch_upload(start_date, end_date, pstgrs, soda, "fiserv_reports_raw")
+def get_socrata_client():
+    domain, session_adapter = SO_WEB, None
+    # SO_WEB can be an http:// URL, for publishing to a local stand-in
+    if SO_WEB.startswith("http://"):
+        domain = SO_WEB[len("http://") :]
+        session_adapter = {
+            "prefix": "http://",
+            "adapter": requests.adapters.HTTPAdapter(),
+        }
+    return Socrata(
+        domain,
+        SO_TOKEN,
+        username=SO_USER,
+        password=SO_PASS,
+        timeout=500,
+        session_adapter=session_adapter,
+    )
 
-        if args.dataset == "meters":
-            batch_upload(
-                start_date, end_date, pstgrs, soda, "flowbird_transactions_raw"
-            )
 
-        if args.dataset == "payments":
-            batch_upload(start_date, end_date, pstgrs, soda, "flowbird_payments_raw")
+def publish_table(start, end, table, workers, slots, full):
+    """Publishes one table with its own postgres and Socrata clients, so that
+    tables can be published from separate threads.
 
-        if args.dataset == "transactions":
-            batch_upload(start_date, end_date, pstgrs, soda, "transactions")
+    Args:
+        start (datetime): Inclusive date (UTC) of earliest records to be uploaded (updated_at)
+        end (datetime): Inclusive date (UTC) of latest records to be uploaded (updated_at)
+        table (string): The name of the table in postgres we are uploading
+        workers (int): Number of threads upserting this table to Socrata
+        slots (threading.Semaphore): Limits upserts to Socrata across all tables
+        full (bool): Publish every record in the date range, even unchanged ones
+
+    Returns:
+        int: The number of records published
+    """
+    pstgrs = get_postgrest_client()
+    soda = get_socrata_client()
+    return batch_upload(start, end, pstgrs, soda, table, workers, slots, full)
 
-        if args.dataset == "all":
-            batch_upload(start_date, end_date, pstgrs, soda, "fiserv_reports_raw")
-            batch_upload(
-                start_date, end_date, pstgrs, soda, "flowbird_transactions_raw"
-            )
-            batch_upload(start_date, end_date, pstgrs, soda, "flowbird_payments_raw")
-            batch_upload(start_date, end_date, pstgrs, soda, "transactions")
 
-    # If no dataset argument then publish all
+def main(args):
+    # format date arguments
+    start_date, end_date = handle_date_args(args.start, args.end)
+
+    # CLI argument logic, if no dataset argument then publish all
+    if args.dataset and args.dataset != "all":
+        tables = [TABLES[args.dataset]]
     else:
-        batch_upload(start_date, end_date, pstgrs, soda, "fiserv_reports_raw")
-        batch_upload(start_date, end_date, pstgrs, soda, "flowbird_transactions_raw")
-        batch_upload(start_date, end_date, pstgrs, soda, "flowbird_payments_raw")
-        batch_upload(start_date, end_date, pstgrs, soda, "transactions")
+        # Skipping datasets which haven't been set up in this environment yet
+        tables = [table for table in TABLES.values() if DATASETS[table]]
+
+    if not tables:
+        logger.info("No Socrata datasets are set up in this environment, nothing to publish")
+        return
+
+    # Datasets are independent so they are all published at once, the number of
+    # upserts in flight to Socrata is capped across all of them by --concurrency.
+    # Every table gets its own thread, so a big one never waits for smaller ones to
+    # finish before it starts reading postgres.
+    slots = threading.BoundedSemaphore(args.concurrency)
+    failed = []
+    with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+        futures = {
+            executor.submit(
+                publish_table,
+                start_date,
+                end_date,
+                table,
+                args.workers,
+                slots,
+                args.full,
+            ): table
+            for table in tables
+        }
+        for future in as_completed(futures):
+            table = futures[future]
+            try:
+                future.result()
+            except Exception as e:
+                logger.error(f"Failed to publish table: {table}: {e}")
+                failed.append(table)
+
+    if failed:
+        raise Exception(f"Failed to publish tables: {', '.join(failed)}")
 
 
 # CLI arguments definition
@@ -173,8 +499,8 @@ parser.add_argument(
     "--dataset",
     type=str,
     default="all",
-    choices=["fiserv", "meters", "payments", "transactions", "all"],
-    help=f"Dataset Name to upload to Socrata (fiserv, meters, payments, transactions, all)",
+    choices=["fiserv", "meters", "payments", "transactions", "daily", "all"],
+    help=f"Dataset Name to upload to Socrata (fiserv, meters, payments, transactions, daily, all)",
 )
 
 parser.add_argument(
@@ -189,6 +515,26 @@ parser.add_argument(
     help=f"Date (in UTC) of the most recent records to be uploaded (YYYY-MM-DD). Defaults to today",
 )
 
+parser.add_argument(
+    "--workers",
+    type=int,
+    default=1,
+    help=f"Number of threads upserting each dataset to Socrata while postgres is read. Defaults to 1",
+)
+
+parser.add_argument(
+    "--concurrency",
+    type=int,
+    default=2,
+    help=f"Maximum number of upserts sent to Socrata at once across all datasets. Defaults to 2",
+)
+
+parser.add_argument(
+    "--full",
+    action="store_true",
+    help=f"Publish every record in the date range, including those unchanged since they were last published",
+)
+
 args = parser.parse_args()
 
 logger = utils.get_logger(__file__, level=logging.DEBUG)
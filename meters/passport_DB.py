@@ -1,110 +1,31 @@
-import os
-import ntpath
 import argparse
 import logging
-from datetime import datetime
 
-from pypgrest import Postgrest
 import pandas as pd
-import boto3
 
+import pipeline
 import utils
 from config.location_names import APP_LOCATION_NAMES
 
-AWS_ACCESS_ID = os.getenv("AWS_ACCESS_ID")
-AWS_PASS = os.getenv("AWS_PASS")
-BUCKET_NAME = os.getenv("BUCKET_NAME")
-
-POSTGREST_ENDPOINT = os.getenv("POSTGREST_ENDPOINT")
-POSTGREST_TOKEN = os.getenv("POSTGREST_TOKEN")
+logger = utils.get_logger(__name__, level=logging.DEBUG)
 
 S3_ENV = "prod"
 
+# Columns sent to passport_transactions_raw
+PASSPORT_TRANSACTIONS_COLUMNS = [
+    "id",
+    "zone_id",
+    "zone_group",
+    "payment_method",
+    "start_time",
+    "end_time",
+    "duration_min",
+    "amount",
+    "net_revenue",
+    "source",
+    "location_name",
+]
 
-def get_csv_list_for_processing(year, month, lastmonth, s3_client):
-    """
-    Parameters
-    ----------
-    year : Int
-        Argument provided value for year.
-    month : Int
-        Argument provided value for month.
-    lastmonth : Bool
-        Argument that determines if the previous month should also be queried.
-    client : boto3 client object
-        For sending on to get_csv_list
-    Returns
-    -------
-    csv_file_list : List
-        A list of the csv files to be downloaded and upsert to Postgres.
-    """
-    # If args are missing, default to current month and/or year
-    if not year:
-        f_year = datetime.now().year
-    else:
-        f_year = year
-
-    if not month:
-        f_month = datetime.now().month
-    else:
-        f_month = month
-
-    file_list = get_file_list(f_year, f_month, s3_client)
-
-    if not month and not year:
-        if lastmonth == True:
-            prev_month = f_month - 1
-            prev_year = f_year
-            if prev_month == 0:
-                prev_year = prev_year - 1
-                prev_month = 12
-            logger.debug(
-                f"Getting data from folders: {prev_month}-{prev_year} and {f_month}-{f_year}"
-            )
-            prev_list = get_file_list(prev_year, prev_month, s3_client)
-            file_list.extend(prev_list)
-        else:
-            logger.debug(f"Getting data from folders: {f_month}-{f_year}")
-
-    file_list = [f for f in file_list if f.endswith(".json")]
-
-    return file_list
-
-
-def get_file_name(file_key):
-    """
-    Returns the name of an email file based on the full s3 file path
-    :param file_key: the file path
-    :return: string
-    """
-    return ntpath.basename(file_key)
-
-
-def get_file_list(year, month, s3_client):
-    """
-    Returns an array of files parsed into an actual array (as opposed to an object)
-    :return: array of strings
-    """
-    csv_file_list = []
-    pending_csv_list = aws_list_files(year, month, s3_client)
-    for csv_file in pending_csv_list:
-        csv_file_list.append(csv_file)
-
-    # Finally return the final list
-    return csv_file_list
-
-
-def aws_list_files(year, month, client):
-    """
-    Returns a list of email files.
-    :return: object
-    """
-    response = client.list_objects(
-        Bucket=BUCKET_NAME, Prefix=f"app/{S3_ENV}/{str(year)}/{str(month)}",
-    )
-
-    for content in response.get("Contents", []):
-        yield content.get("Key")
 
 def create_location_name(row):
     id = row["zone_id"]
@@ -140,26 +61,33 @@ def transform(passport):
 
     # Convert string currency amounts to floats
     passport["amount"] = (
-        passport["Parking Revenue"].str.replace("$", "", regex=True).astype(float)
+        passport["Parking Revenue"].str.replace("$", "", regex=False).astype(float)
     )
     passport["net_revenue"] = (
-        passport["Net Revenue"].str.replace("$", "", regex=True).astype(float)
+        passport["Net Revenue"].str.replace("$", "", regex=False).astype(float)
     )
 
     passport["start_time"] = pd.to_datetime(
-        passport["Entry Time"],
-        format="%Y/%m/%d %I:%M:%S %p",
-        infer_datetime_format=True,
+        passport["Entry Time"], format="%Y/%m/%d %I:%M:%S %p"
     )
 
     passport["end_time"] = pd.to_datetime(
-        passport["Exit Time"], format="%Y/%m/%d %I:%M:%S %p", infer_datetime_format=True
+        passport["Exit Time"], format="%Y/%m/%d %I:%M:%S %p"
     )
 
     passport["duration_min"] = (
         (passport["end_time"] - passport["start_time"]).dt.seconds
     ) / 60
 
+    # Postgres copies these rows on to transactions, where start_time is part of the
+    # primary key and the partition key, a row without one would fail its whole batch
+    missing_start = passport["start_time"].isna()
+    if missing_start.any():
+        logger.warning(
+            f"Dropped {missing_start.sum()} transactions without an Entry Time"
+        )
+        passport = passport[~missing_start]
+
     # Convert back to string for datetime fields
     passport["start_time"] = passport["start_time"].astype(str)
     passport["end_time"] = passport["end_time"].astype(str)
@@ -187,111 +115,50 @@ def transform(passport):
     passport = passport[passport["zone_id"] != 101]
     
     # Subset of columns for aligning schema
-    passport = passport[
-        [
-            "id",
-            "zone_id",
-            "zone_group",
-            "payment_method",
-            "start_time",
-            "end_time",
-            "duration_min",
-            "amount",
-            "net_revenue",
-            "source",
-            "location_name",
-        ]
-    ]
+    passport = passport[PASSPORT_TRANSACTIONS_COLUMNS]
 
     return passport
 
 
-def to_postgres(df, client):
-    # Upsert to database
-
-    payload = df.to_dict(orient="records")
-    try:
-        res = client.upsert(resource="passport_transactions_raw", data=payload)
-    except Exception as e:
-        logger.error(client.res.text)
-        raise e
-
-    df = df[
-        [
-            "id",
-            "payment_method",
-            "zone_group",
-            "zone_id",
-            "duration_min",
-            "start_time",
-            "end_time",
-            "amount",
-            "source",
-            "location_name",
-        ]
-    ]
-
-    payload = df.to_dict(orient="records")
-    try:
-        res = client.upsert(resource="transactions", data=payload)
-    except Exception as e:
-        logger.error(client.res.text)
-        raise e
-
-    return res
+# Passport report JSON files, loaded to passport_transactions_raw. Postgres copies
+# the rows on to the combined transactions table.
+LOADER = pipeline.Loader(
+    prefix=f"app/{S3_ENV}/",
+    suffix=".json",
+    read=pd.read_json,
+    transform=transform,
+    table="passport_transactions_raw",
+    columns=PASSPORT_TRANSACTIONS_COLUMNS,
+)
 
 
 def main(args):
-    s3_client = boto3.client(
-        "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS,
-    )
+    client = pipeline.get_postgrest_client()
 
-    client = Postgrest(
-        POSTGREST_ENDPOINT,
-        token=POSTGREST_TOKEN,
-        headers={"Prefer": "return=representation"},
-    )
+    # Monthly partitions for the data we're about to load
+    utils.ensure_transaction_partitions(client, args.year, args.month)
 
-    # Get list of JSON files and handle year/month args
-    file_list = get_csv_list_for_processing(
-        args.year, args.month, args.lastmonth, s3_client
+    months = pipeline.get_months(args.year, args.month, args.lastmonth)
+    pipeline.run(
+        LOADER, months, executor=args.executor, workers=args.workers, bulk=args.bulk
     )
 
-    # Go through all files and combine into a dataframe
-    data = []
-    for file in file_list:
-        # Parse the file
-        if ".json" in file:
-            response = s3_client.get_object(Bucket=BUCKET_NAME, Key=file)
-            # Read the JSON in each object
-            df = pd.read_json(response.get("Body"))
-            print("Loaded File: '%s'" % file)
-            if not df.empty:
-                df = transform(df)
+    changed = utils.refresh_transactions_daily(client)
+    logger.debug(f"Updated {changed} daily rollup rows")
 
-                res = to_postgres(df, client)
 
+if __name__ == "__main__":
+    # CLI arguments definition
+    parser = argparse.ArgumentParser()
 
-# CLI arguments definition
-parser = argparse.ArgumentParser()
+    pipeline.add_arguments(parser)
 
-parser.add_argument(
-    "--year", type=int, help=f"Year of folder to select, defaults to current year",
-)
-
-parser.add_argument(
-    "--month", type=int, help=f"Month of folder to select. defaults to current month",
-)
-
-parser.add_argument(
-    "--lastmonth",
-    type=bool,
-    help=f"Will download from current month folder as well as previous.",
-    default=False,
-)
-
-args = parser.parse_args()
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help=f"Load with COPY straight to postgres (DATABASE_URL) instead of PostgREST, for backfills",
+    )
 
-logger = utils.get_logger(__file__, level=logging.DEBUG)
+    args = parser.parse_args()
 
-main(args)
+    main(args)
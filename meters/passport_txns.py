@@ -17,8 +17,9 @@ DATE_FORMAT_API = "%m/%d/%Y"
 DATE_FORMAT_INPUT = "%Y-%m-%d"
 
 # OpsMan Endpoints
-LOGIN_URL = "https://ppprk.com/server/opmgmt/api/index.php/login"
-REPORT_URL = "https://ppprk.com/server/opmgmt/api/reports_index.php/runcustomreport"
+OPS_MAN_URL = os.getenv("OPS_MAN_URL", "https://ppprk.com/server/opmgmt/api")
+LOGIN_URL = f"{OPS_MAN_URL}/index.php/login"
+REPORT_URL = f"{OPS_MAN_URL}/reports_index.php/runcustomreport"
 
 # OpsMan Credentials
 USER = os.getenv("OPS_MAN_USER")
@@ -28,6 +29,8 @@ PASSWORD = os.getenv("OPS_MAN_PASS")
 AWS_ACCESS_ID = os.getenv("AWS_ACCESS_ID")
 AWS_PASS = os.getenv("AWS_PASS")
 BUCKET = os.getenv("BUCKET_NAME")
+# Optional, for pointing the S3 client at a local stand-in
+AWS_ENDPOINT_URL = os.getenv("AWS_ENDPOINT_URL")
 
 
 def validate_session(session):
@@ -168,7 +171,10 @@ def main(args):
 
     # AWS log in
     s3 = boto3.client(
-        "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS,
+        "s3",
+        aws_access_key_id=AWS_ACCESS_ID,
+        aws_secret_access_key=AWS_PASS,
+        endpoint_url=AWS_ENDPOINT_URL,
     )
 
     # Get request params
@@ -0,0 +1,214 @@
+"""Local Parquet copy of the flowbird_payments_raw columns used for matching, kept up to
+date with the rows updated since it was last refreshed"""
+import json
+import os
+
+import pandas as pd
+
+# Where match_field_processing.py keeps the cache by default
+CACHE_PATH = os.getenv("PAYMENTS_CACHE", "flowbird_payments_cache.parquet")
+
+COLUMNS = ["id", "invoice_id", "transaction_date", "updated_at"]
+
+# Payments fetched per request while refreshing
+PAGE_SIZE = 50000
+
+# Rows from loads which committed after the last refresh can have an updated_at just
+# before it, and postgres' clock can be behind this one, so each refresh looks back
+# this far before the time the last one started. Overlapping rows are deduplicated.
+LOOKBACK = pd.Timedelta(hours=1)
+
+# How often the cache is checked for payments which have been deleted from postgres,
+# which downloads the id of every payment
+RECONCILE_EVERY = pd.Timedelta(days=int(os.getenv("PAYMENTS_CACHE_RECONCILE_DAYS", 7)))
+
+
+def empty_cache():
+    return pd.DataFrame(
+        {
+            "id": pd.Series(dtype="int64"),
+            "invoice_id": pd.Series(dtype="float64"),
+            "transaction_date": pd.Series(dtype="datetime64[ns]"),
+            "updated_at": pd.Series(dtype="datetime64[ns, UTC]"),
+        }
+    )
+
+
+def read_cache(path):
+    """Read the cached payments, an empty frame if there isn't a cache yet.
+
+    Args:
+        path (str): Parquet file
+
+    Returns:
+        pandas dataframe: Payments sorted by transaction_date
+    """
+    if not os.path.exists(path):
+        return empty_cache()
+    return pd.read_parquet(path)
+
+
+def state_path(path):
+    return f"{path}.json"
+
+
+def read_state(path):
+    """When the cache was last refreshed and last reconciled with postgres, kept in a
+    JSON file next to it.
+
+    Args:
+        path (str): Parquet file
+
+    Returns:
+        (pandas Timestamp, pandas Timestamp): The start of the last refresh and of the
+            last reconcile, both None without a state file
+    """
+    if not os.path.exists(state_path(path)):
+        return None, None
+    with open(state_path(path)) as f:
+        state = json.load(f)
+    return pd.Timestamp(state["refreshed_at"]), pd.Timestamp(state["reconciled_at"])
+
+
+def write_cache(path, cache):
+    # Written next to the cache and renamed over it so a failed write can't corrupt it
+    tmp_path = f"{path}.tmp"
+    cache.to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def write_state(path, refreshed_at, reconciled_at):
+    # Written after the cache, a failure in between only means the next refresh
+    # downloads more than it needs to
+    tmp_path = f"{state_path(path)}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(
+            {
+                "refreshed_at": refreshed_at.isoformat(),
+                "reconciled_at": reconciled_at.isoformat(),
+            },
+            f,
+        )
+    os.replace(tmp_path, state_path(path))
+
+
+def fetch_pages(pstgrs, params):
+    """Fetch every row matching PostgREST params a page at a time, keyed on id"""
+    params = {**params, "order": "id", "limit": PAGE_SIZE}
+    rows = []
+    while True:
+        page = pstgrs.select(
+            resource="flowbird_payments_raw", params=params, pagination=False
+        )
+        rows.extend(page)
+        if len(page) < PAGE_SIZE:
+            return rows
+        params["id"] = f"gt.{page[-1]['id']}"
+
+
+def fetch_updated(pstgrs, since):
+    """Fetch the payments updated since a point in time, a page at a time.
+
+    Args:
+        pstgrs: Postgrest client object
+        since (pandas Timestamp): Fetch rows with an updated_at from this on, all rows if None
+
+    Returns:
+        pandas dataframe: The payments with typed date columns
+    """
+    params = {"select": ",".join(COLUMNS)}
+    if since is not None:
+        params["updated_at"] = f"gte.{since.isoformat()}"
+
+    payments = pd.DataFrame(fetch_pages(pstgrs, params), columns=COLUMNS)
+    payments["invoice_id"] = payments["invoice_id"].astype("float64")
+    payments["transaction_date"] = pd.to_datetime(payments["transaction_date"])
+    payments["updated_at"] = pd.to_datetime(payments["updated_at"], utc=True)
+    return payments
+
+
+def fetch_ids(pstgrs):
+    """Fetch the id of every payment in postgres, a page at a time.
+
+    Returns:
+        pandas series: Payment ids
+    """
+    rows = fetch_pages(pstgrs, {"select": "id"})
+    return pd.Series([row["id"] for row in rows], dtype="int64")
+
+
+def refresh(pstgrs, path=CACHE_PATH, rebuild=False, reconcile_every=RECONCILE_EVERY):
+    """Bring the cache up to date with postgres and save it. The first refresh
+    downloads every payment, later ones only what was updated since the last one
+    started. Once every reconcile_every the ids of every payment are downloaded too,
+    and payments which were deleted from postgres are dropped from the cache.
+
+    Args:
+        pstgrs: Postgrest client object
+        path (str): Parquet file
+        rebuild (bool): Download every payment again instead of updating the cache
+        reconcile_every (pandas timedelta): How often to drop deleted payments
+
+    Returns:
+        (pandas dataframe, int, int): Every cached payment sorted by transaction_date,
+            the number of rows fetched and the number of deleted payments dropped
+    """
+    refreshed_at, reconciled_at = read_state(path)
+    # A cache without its state can't be updated safely, it's downloaded again
+    if rebuild or refreshed_at is None:
+        cache = empty_cache()
+        since = None
+    else:
+        cache = read_cache(path)
+        since = refreshed_at - LOOKBACK
+
+    started = pd.Timestamp.now(tz="UTC")
+    updated = fetch_updated(pstgrs, since)
+    changed = not updated.empty
+    if changed:
+        cache = pd.concat([cache, updated], ignore_index=True)
+        cache = cache.drop_duplicates(subset="id", keep="last")
+        cache = cache.sort_values(by=["transaction_date"], kind="stable")
+
+    removed = 0
+    if since is None:
+        # Everything was just downloaded
+        reconciled_at = started
+    elif started - reconciled_at >= reconcile_every:
+        exists = cache["id"].isin(fetch_ids(pstgrs))
+        removed = int((~exists).sum())
+        cache = cache[exists]
+        changed = changed or removed > 0
+        reconciled_at = started
+
+    if changed or since is None:
+        write_cache(path, cache)
+    write_state(path, started, reconciled_at)
+
+    return cache.reset_index(drop=True), len(updated), removed
+
+
+def window(cache, start, end):
+    """The cached payments updated between two points in time, like get_payments.
+
+    Args:
+        cache (pandas dataframe): From refresh()
+        start (datetime): Earliest updated_at
+        end (datetime): Latest updated_at
+
+    Returns:
+        pandas dataframe: Matchable payments sorted by transaction_date
+    """
+    start = pd.Timestamp(start)
+    end = pd.Timestamp(end)
+    # Dates without a timezone are taken to be UTC
+    start = start.tz_localize("UTC") if start.tzinfo is None else start
+    end = end.tz_localize("UTC") if end.tzinfo is None else end
+    payments = cache[
+        (cache["updated_at"] >= start)
+        & (cache["updated_at"] <= end)
+        # Payments without these can't be matched
+        & cache["invoice_id"].notna()
+        & cache["transaction_date"].notna()
+    ]
+    return payments.astype({"invoice_id": "int64"})
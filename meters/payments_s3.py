@@ -1,117 +1,28 @@
-import ntpath
-import os
 import logging
 import argparse
-from datetime import datetime
 
-
-from pypgrest import Postgrest
 import pandas as pd
-import boto3
 
+import pipeline
 import utils
 from config.location_names import METER_LOCATION_NAMES
-# Envrioment variables
-
-AWS_ACCESS_ID = os.getenv("AWS_ACCESS_ID")
-AWS_PASS = os.getenv("AWS_PASS")
-BUCKET_NAME = os.getenv("BUCKET_NAME")
-POSTGREST_TOKEN = os.getenv("POSTGREST_TOKEN")
-POSTGREST_ENDPOINT = os.getenv("POSTGREST_ENDPOINT")
-
-
-def handle_year_month_args(year, month, lastmonth, aws_s3_client, user):
-    """
-
-    Parameters
-    ----------
-    year : Int
-        Argument provided value for year.
-    month : Int
-        Argument provided value for month.
-    lastmonth : Bool
-        Argument that determines if the previous month should also be queried.
-    aws_s3_client : boto3 client object
-        For sending on to get_csv_list
-
-    Returns
-    -------
-    csv_file_list : List
-        A list of the csv files to be downloaded and upsert to Postgres.
-
-    """
-    # If args are missing, default to current month and/or year
-    if not year:
-        f_year = datetime.now().year
-    else:
-        f_year = year
-
-    if not month:
-        f_month = datetime.now().month
-    else:
-        f_month = month
-
-    csv_file_list = get_csv_list(f_year, f_month, aws_s3_client, user)
-
-    if not month and not year:
-        if lastmonth == True:
-            prev_month = f_month - 1
-            prev_year = f_year
-            if prev_month == 0:
-                prev_year = prev_year - 1
-                prev_month = 12
-            logger.debug(
-                f"Getting data from folders: {prev_month}-{prev_year} and {f_month}-{f_year}"
-            )
-            prev_list = get_csv_list(prev_year, prev_month, aws_s3_client, user)
-            csv_file_list.extend(prev_list)
-        else:
-            logger.debug(f"Getting data from folders: {f_month}-{f_year}")
-
-    csv_file_list = [f for f in csv_file_list if f.endswith(".csv")]
-
-    return csv_file_list
-
-
-def get_file_name(file_key):
-    """
-    Returns the name of an email file based on the full s3 file path
-    :param file_key: the file path
-    :return: string
-    """
-    return ntpath.basename(file_key)
-
-
-def get_csv_list(year, month, client, user):
-    """
-    Returns an array of files parsed into an actual array (as opposed to an object)
-    :return: array of strings
-    """
-    csv_file_list = []
-    pending_csv_list = aws_list_files(year, month, client, user)
-    for csv_file in pending_csv_list:
-        csv_file_list.append(csv_file)
-
-    # Finally return the final list
-    return csv_file_list
-
-
-def aws_list_files(year, month, client, user):
-    """
-    Returns a list of email files.
-    :return: object
-    """
-    subdir = "archipel_transactionspub"
-
-    if user == "pard":
-        subdir = f"{subdir}-PARD"
 
-    response = client.list_objects(
-        Bucket=BUCKET_NAME, Prefix=f"meters/prod/{subdir}/{str(year)}/{str(month)}",
-    )
+logger = utils.get_logger(__name__, level=logging.DEBUG)
 
-    for content in response.get("Contents", []):
-        yield content.get("Key")
+# Columns sent to flowbird_payments_raw
+FLOWBIRD_PAYMENTS_COLUMNS = [
+    "id",
+    "invoice_id",
+    "card_type",
+    "meter_id",
+    "transaction_type",
+    "transaction_date",
+    "transaction_status",
+    "remittance_status",
+    "processed_date",
+    "amount",
+    "location_name",
+]
 
 
 def get_invoice_id(banking_id, terminal_code):
@@ -150,9 +61,9 @@ def postgres_datetime(time_field):
     Returns:
         output (string): Formatted datetime field that is compatable with postgres
     """
-    output = pd.to_datetime(
-        time_field, format="%Y-%m-%d %H:%M:%S", infer_datetime_format=True
-    )
+    # pandas 1.x parsed an ISO 8601 format with infer_datetime_format like no format at
+    # all, which pandas 2 removed, so no format keeps the dates it accepts the same
+    output = pd.to_datetime(time_field)
     return str(output)
 
 
@@ -223,97 +134,66 @@ def transform(smartfolio):
     smartfolio["location_name"] = smartfolio.apply(create_location_name, axis=1)
 
     # Payload to DB
-    smartfolio = smartfolio[
-        [
-            "id",
-            "invoice_id",
-            "card_type",
-            "meter_id",
-            "transaction_type",
-            "transaction_date",
-            "transaction_status",
-            "remittance_status",
-            "processed_date",
-            "amount",
-            "location_name",
-        ]
-    ]
+    smartfolio = smartfolio[FLOWBIRD_PAYMENTS_COLUMNS]
 
     return smartfolio
 
 
-def to_postgres(smartfolio):
-    """Uploads the formatted dataframe to two different postgres DBs.
-        flowbird_transactions_raw - just for smartfolio aka flowbird data
-        transactions - a combined parking DB which will also include data from passport
-    
+def get_loader(user):
+    """The loader of the smartfolio payments CSVs of a user account, which are
+        upserted to flowbird_payments_raw.
+
     Args:
-        smartfolio (pandas dataframe): Formatted dataframe that works with DB schema.
-    
+        user (string): The user account the data is from, atd or pard
+
     Returns:
-        None
+        pipeline.Loader: The loader
     """
-    # Upsert to database
-    payload = smartfolio.to_dict(orient="records")
+    subdir = "archipel_transactionspub"
 
-    client = Postgrest(
-        POSTGREST_ENDPOINT,
-        token=POSTGREST_TOKEN,
-        headers={"Prefer": "return=representation"},
+    if user == "pard":
+        subdir = f"{subdir}-PARD"
+
+    return pipeline.Loader(
+        prefix=f"meters/prod/{subdir}/",
+        suffix=".csv",
+        read=pd.read_csv,
+        transform=transform,
+        table="flowbird_payments_raw",
+        columns=FLOWBIRD_PAYMENTS_COLUMNS,
     )
-    try:
-        res = client.upsert(resource="flowbird_payments_raw", data=payload)
-    except Exception as e:
-        logger.error(client.res.text)
-        raise e
 
 
 def main(args):
-
-    aws_s3_client = boto3.client(
-        "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS,
-    )
-
-    csv_file_list = handle_year_month_args(
-        args.year, args.month, args.lastmonth, aws_s3_client, args.user
+    months = pipeline.get_months(args.year, args.month, args.lastmonth)
+    pipeline.run(
+        get_loader(args.user),
+        months,
+        executor=args.executor,
+        workers=args.workers,
+        bulk=args.bulk,
     )
-    for csv_f in csv_file_list:
-        # Parse the file
-        response = aws_s3_client.get_object(Bucket=BUCKET_NAME, Key=csv_f)
-        df = pd.read_csv(response.get("Body"))
-        logger.debug(f"Loaded CSV File: {csv_f}")
 
-        df = transform(df)
-        to_postgres(df)
 
+if __name__ == "__main__":
+    # CLI arguments definition
+    parser = argparse.ArgumentParser()
 
-# CLI arguments definition
-parser = argparse.ArgumentParser()
+    pipeline.add_arguments(parser)
 
-parser.add_argument(
-    "--year", type=int, help=f"Year of folder to select, defaults to current year",
-)
-
-parser.add_argument(
-    "--month", type=int, help=f"Month of folder to select. defaults to current month",
-)
-
-parser.add_argument(
-    "--lastmonth",
-    type=bool,
-    help=f"Will download from current month folder as well as previous.",
-    default=False,
-)
-
-parser.add_argument(
-    "--user",
-    default="atd",
-    choices=["pard", "atd"],
-    help=f"The user account to use to access data [atd (parking meters), pard (pool passes)]",
-)
+    parser.add_argument(
+        "--user",
+        default="atd",
+        choices=["pard", "atd"],
+        help=f"The user account to use to access data [atd (parking meters), pard (pool passes)]",
+    )
 
-args = parser.parse_args()
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help=f"Load with COPY straight to postgres (DATABASE_URL) instead of PostgREST, for backfills",
+    )
 
-logger = utils.get_logger(__file__, level=logging.DEBUG)
+    args = parser.parse_args()
 
-main(args)
+    main(args)
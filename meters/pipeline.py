@@ -0,0 +1,379 @@
+"""Shared S3 to postgres pipeline for smartfolio_s3.py, payments_s3.py, passport_DB.py and
+fiserv_DB.py.
+
+Each of them declares a Loader: the S3 folder its monthly files are in, how to read a
+file, its transform and the table it's loaded to. run() lists a month's files and takes
+each one through the same stages, source -> parse -> transform -> load, one file at a
+time or several at once in a pool of threads or processes."""
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+import logging
+import multiprocessing
+import multiprocessing.util
+import os
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+from pypgrest import Postgrest
+
+import bulk_load
+import utils
+
+AWS_ACCESS_ID = os.getenv("AWS_ACCESS_ID")
+AWS_PASS = os.getenv("AWS_PASS")
+BUCKET_NAME = os.getenv("BUCKET_NAME")
+POSTGREST_TOKEN = os.getenv("POSTGREST_TOKEN")
+POSTGREST_ENDPOINT = os.getenv("POSTGREST_ENDPOINT")
+# Optional, for pointing the S3 client at a local stand-in
+AWS_ENDPOINT_URL = os.getenv("AWS_ENDPOINT_URL")
+
+EXECUTORS = ["serial", "threads", "processes"]
+
+# Connections the shared S3 client keeps open, enough for the biggest pool of threads
+S3_MAX_CONNECTIONS = 32
+
+STAGES = ["fetch", "parse", "transform", "load"]
+
+logger = utils.get_logger(__file__, level=logging.DEBUG)
+
+# Clients are made the first time they're needed and belong to the process which made
+# them, a forked worker process makes its own
+_s3 = {}
+_s3_lock = threading.Lock()
+_local = threading.local()
+# Every bulk connection made by this process's threads, closed at the end of a run
+_bulk_connections = []
+_bulk_lock = threading.Lock()
+
+
+class Loader:
+    """Declares how one loader's files get from S3 to postgres.
+
+    Args:
+        prefix (str): The S3 prefix of the monthly folders, which are <prefix><year>/<month>
+        suffix (str): Only files ending with this are loaded
+        read (function): Parses the body of an S3 object into a dataframe
+        transform (function): Formats a parsed dataframe for the table
+        table (str): The table in the api schema the rows are upserted to
+        columns (list): The columns loaded with COPY in bulk mode, None if the loader
+            doesn't support it
+        skip (function): Optional, called with a file's S3 key and the S3 client before
+            it's downloaded. Returns why the file is skipped, None to load it.
+    """
+
+    def __init__(
+        self, prefix, suffix, read, transform, table, columns=None, skip=None
+    ):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.read = read
+        self.transform = transform
+        self.table = table
+        self.columns = columns
+        self.skip = skip
+
+
+def get_s3_client():
+    """The boto3 s3 client of this process, which its threads share
+
+    Returns:
+        boto3 s3 client
+    """
+    pid = os.getpid()
+    with _s3_lock:
+        if pid not in _s3:
+            _s3.clear()
+            _s3[pid] = boto3.client(
+                "s3",
+                aws_access_key_id=AWS_ACCESS_ID,
+                aws_secret_access_key=AWS_PASS,
+                endpoint_url=AWS_ENDPOINT_URL,
+                config=Config(max_pool_connections=S3_MAX_CONNECTIONS),
+            )
+        return _s3[pid]
+
+
+def get_postgrest_client():
+    """The Postgrest client of this thread. They keep the last response on the client,
+    so they aren't shared between threads.
+
+    Returns:
+        Postgrest client object
+    """
+    pid, client = getattr(_local, "postgrest", (None, None))
+    if pid != os.getpid():
+        client = Postgrest(
+            POSTGREST_ENDPOINT,
+            token=POSTGREST_TOKEN,
+            headers={"Prefer": "return=representation"},
+        )
+        _local.postgrest = (os.getpid(), client)
+    return client
+
+
+def get_bulk_connection():
+    """The psycopg2 connection of this thread, for loading with COPY. It stays open
+    until close_bulk_connections.
+
+    Returns:
+        psycopg2 connection
+    """
+    pid, conn = getattr(_local, "bulk", (None, None))
+    if pid != os.getpid() or conn.closed:
+        conn = bulk_load.get_connection()
+        _local.bulk = (os.getpid(), conn)
+        with _bulk_lock:
+            _bulk_connections.append((os.getpid(), conn))
+    return conn
+
+
+def close_bulk_connections():
+    """Closes the bulk connections this process's threads made. A forked worker's list
+    starts with its parent's connections, which it leaves alone."""
+    pid = os.getpid()
+    with _bulk_lock:
+        connections = [conn for owner, conn in _bulk_connections if owner == pid]
+        _bulk_connections.clear()
+    for conn in connections:
+        conn.close()
+
+
+def init_worker():
+    """Runs in each worker process of a run, closing its bulk connections when the pool
+    shuts it down"""
+    multiprocessing.util.Finalize(None, close_bulk_connections, exitpriority=10)
+
+
+def get_months(year, month, lastmonth):
+    """The monthly folders to load, the current month's by default.
+
+    Args:
+        year (int): Argument provided value for year, defaults to the current year
+        month (int): Argument provided value for month, defaults to the current month
+        lastmonth (bool): With neither year nor month, also load the previous month
+
+    Returns:
+        list: (year, month) of each folder
+    """
+    # If args are missing, default to current month and/or year
+    f_year = year or datetime.now().year
+    f_month = month or datetime.now().month
+    months = [(f_year, f_month)]
+
+    if not month and not year:
+        if lastmonth == True:
+            prev_month = f_month - 1
+            prev_year = f_year
+            if prev_month == 0:
+                prev_year = prev_year - 1
+                prev_month = 12
+            logger.debug(
+                f"Getting data from folders: {prev_month}-{prev_year} and {f_month}-{f_year}"
+            )
+            months.append((prev_year, prev_month))
+        else:
+            logger.debug(f"Getting data from folders: {f_month}-{f_year}")
+
+    return months
+
+
+def list_files(loader, months, client):
+    """The loader's files in S3 for some months. The folder name ends with a slash so
+    month 1 doesn't take in months 10 to 12 as well.
+
+    Args:
+        loader (Loader): The loader
+        months (list): (year, month) of each folder, from get_months
+        client: boto3 s3 client
+
+    Returns:
+        list: S3 keys
+    """
+    files = []
+    paginator = client.get_paginator("list_objects_v2")
+    for year, month in months:
+        pages = paginator.paginate(
+            Bucket=BUCKET_NAME, Prefix=f"{loader.prefix}{year}/{month}/"
+        )
+        for page in pages:
+            files.extend(content["Key"] for content in page.get("Contents", []))
+    return [f for f in files if f.endswith(loader.suffix)]
+
+
+def load(loader, df, bulk=False):
+    """Upserts a transformed dataframe to the loader's table.
+
+    Args:
+        loader (Loader): The loader
+        df (pandas dataframe): Formatted dataframe that works with the table schema
+        bulk (bool): Load with COPY straight to postgres instead of through PostgREST
+    """
+    if bulk:
+        bulk_load.copy_upsert(
+            get_bulk_connection(), f"api.{loader.table}", df, loader.columns
+        )
+        return
+
+    client = get_postgrest_client()
+    try:
+        client.upsert(resource=loader.table, data=df.to_dict(orient="records"))
+    except Exception as e:
+        logger.error(client.res.text)
+        raise e
+
+
+def process_file(loader, key, bulk=False):
+    """Takes one file through the stages of the pipeline.
+
+    Args:
+        loader (Loader): The loader
+        key (str): The file's S3 key
+        bulk (bool): Passed on to load
+
+    Returns:
+        dict: Rows read and loaded, whether the file was skipped, and the seconds spent
+            in each stage
+    """
+    stats = {"files": 1, "skipped": 0, "rows_read": 0, "rows_loaded": 0}
+    stats.update({stage: 0.0 for stage in STAGES})
+    client = get_s3_client()
+
+    if loader.skip:
+        reason = loader.skip(key, client)
+        if reason:
+            logger.debug(f"Skipped {key}: {reason}")
+            stats["skipped"] = 1
+            return stats
+
+    start = time.perf_counter()
+    response = client.get_object(Bucket=BUCKET_NAME, Key=key)
+    body = response["Body"]
+    stats["fetch"] = time.perf_counter() - start
+
+    # Reading the body is timed as part of parsing, the reader streams it
+    start = time.perf_counter()
+    df = loader.read(body)
+    stats["parse"] = time.perf_counter() - start
+    stats["rows_read"] = len(df)
+    logger.debug(f"Loaded File: {key}")
+
+    # Some files only have column headers
+    if df.empty:
+        return stats
+
+    start = time.perf_counter()
+    df = loader.transform(df)
+    stats["transform"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    load(loader, df, bulk)
+    stats["load"] = time.perf_counter() - start
+    stats["rows_loaded"] = len(df)
+
+    return stats
+
+
+def add_stats(totals, stats):
+    """Adds a file's stats from process_file to the totals"""
+    for name, value in stats.items():
+        totals[name] += value
+
+
+def run(loader, months, executor="serial", workers=1, bulk=False):
+    """Loads the loader's files for some months.
+
+    With threads, S3 downloads and postgres upserts of different files overlap. With
+    processes, transforms run on several CPUs too, and a file's dataframe stays in the
+    process which loads it. Files aren't loaded in order with either, so a row in more
+    than one file is only certain to end up as it is in the last one when loading serially.
+
+    Worker processes are forked, so the loader's functions can come from the script being
+    run (__main__), which a spawned process couldn't import. Processes aren't available
+    where fork isn't, such as on Windows. Bulk connections are closed before returning.
+
+    Args:
+        loader (Loader): The loader
+        months (list): (year, month) of each folder, from get_months
+        executor (str): One of EXECUTORS
+        workers (int): Number of files processed at once by threads or processes
+        bulk (bool): Load with COPY straight to postgres instead of through PostgREST
+
+    Returns:
+        dict: Files, files skipped, rows read and loaded, and the seconds spent in each
+            stage, summed over the files
+    """
+    if bulk and loader.columns is None:
+        raise ValueError(f"{loader.table} can't be loaded in bulk")
+    if executor == "processes" and "fork" not in multiprocessing.get_all_start_methods():
+        raise ValueError("Processes need fork, which isn't available on this platform")
+
+    files = list_files(loader, months, get_s3_client())
+    totals = {"files": 0, "skipped": 0, "rows_read": 0, "rows_loaded": 0}
+    totals.update({stage: 0.0 for stage in STAGES})
+
+    if len(files) == 0:
+        logger.debug("No Files found for selected months, nothing happened.")
+        return totals
+
+    args = ([loader] * len(files), files, [bulk] * len(files))
+    try:
+        if executor == "serial":
+            for stats in map(process_file, *args):
+                add_stats(totals, stats)
+        else:
+            if executor == "threads":
+                files_pool = ThreadPoolExecutor(max_workers=workers)
+            else:
+                files_pool = ProcessPoolExecutor(
+                    max_workers=workers,
+                    mp_context=multiprocessing.get_context("fork"),
+                    initializer=init_worker,
+                )
+            with files_pool:
+                for stats in files_pool.map(process_file, *args):
+                    add_stats(totals, stats)
+    finally:
+        close_bulk_connections()
+
+    stages = ", ".join(f"{stage} {totals[stage]:.1f}s" for stage in STAGES)
+    logger.info(
+        f"Loaded {totals['rows_loaded']} of {totals['rows_read']} rows read from "
+        f"{totals['files']} files ({totals['skipped']} skipped) to {loader.table} ({stages})"
+    )
+    return totals
+
+
+def add_arguments(parser):
+    """Adds the CLI arguments every loader has to an argparse parser"""
+    parser.add_argument(
+        "--year", type=int, help=f"Year of folder to select, defaults to current year",
+    )
+
+    parser.add_argument(
+        "--month",
+        type=int,
+        help=f"Month of folder to select. defaults to current month",
+    )
+
+    parser.add_argument(
+        "--lastmonth",
+        type=bool,
+        help=f"Will download from current month folder as well as previous.",
+        default=False,
+    )
+
+    parser.add_argument(
+        "--executor",
+        default="serial",
+        choices=EXECUTORS,
+        help=f"Process files one at a time, or several at once in threads or processes. Defaults to serial",
+    )
+
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help=f"Number of files processed at once with --executor threads or processes. Defaults to 4",
+    )
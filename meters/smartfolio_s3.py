@@ -1,114 +1,29 @@
-import ntpath
-import os
 import argparse
-from datetime import datetime
 import logging
 
-from pypgrest import Postgrest
 import pandas as pd
-import boto3
 from dotenv import load_dotenv
 
+import pipeline
 import utils
 from config.location_names import METER_LOCATION_NAMES
 
-# Envrioment variables
+logger = utils.get_logger(__name__, level=logging.DEBUG)
 
-AWS_ACCESS_ID = os.getenv("AWS_ACCESS_ID")
-AWS_PASS = os.getenv("AWS_PASS")
-BUCKET_NAME = os.getenv("BUCKET_NAME")
-POSTGREST_TOKEN = os.getenv("POSTGREST_TOKEN")
-POSTGREST_ENDPOINT = os.getenv("POSTGREST_ENDPOINT")
-
-
-def handle_year_month_args(year, month, lastmonth, aws_s3_client):
-    """
-
-    Parameters
-    ----------
-    year : Int
-        Argument provided value for year.
-    month : Int
-        Argument provided value for month.
-    lastmonth : Bool
-        Argument that determines if the previous month should also be queried.
-    aws_s3_client : boto3 client object
-        For sending on to get_csv_list
-
-    Returns
-    -------
-    csv_file_list : List
-        A list of the csv files to be downloaded and upsert to Postgres.
-
-    """
-    # If args are missing, default to current month and/or year
-    if not year:
-        f_year = datetime.now().year
-    else:
-        f_year = year
-
-    if not month:
-        f_month = datetime.now().month
-    else:
-        f_month = month
-
-    csv_file_list = get_csv_list(f_year, f_month, aws_s3_client)
-
-    if not month and not year:
-        if lastmonth == True:
-            prev_month = f_month - 1
-            prev_year = f_year
-            if prev_month == 0:
-                prev_year = prev_year - 1
-                prev_month = 12
-            logger.debug(
-                f"Getting data from folders: {prev_month}-{prev_year} and {f_month}-{f_year}"
-            )
-            prev_list = get_csv_list(prev_year, prev_month, aws_s3_client)
-            csv_file_list.extend(prev_list)
-        else:
-            logger.debug(f"Getting data from folders: {f_month}-{f_year}")
-
-    csv_file_list = [f for f in csv_file_list if f.endswith(".csv")]
-
-    return csv_file_list
-
-
-def get_file_name(file_key):
-    """
-    Returns the name of an email file based on the full s3 file path
-    :param file_key: the file path
-    :return: string
-    """
-    return ntpath.basename(file_key)
-
-
-def get_csv_list(year, month, client):
-    """
-    Returns an array of files parsed into an actual array (as opposed to an object)
-    :return: array of strings
-    """
-    csv_file_list = []
-    pending_csv_list = aws_list_files(year, month, client)
-    for csv_file in pending_csv_list:
-        csv_file_list.append(csv_file)
-
-    # Finally return the final list
-    return csv_file_list
-
-
-def aws_list_files(year, month, client):
-    """
-    Returns a list of email files.
-    :return: object
-    """
-    response = client.list_objects(
-        Bucket=BUCKET_NAME,
-        Prefix="meters/prod/transaction_history/" + str(year) + "/" + str(month),
-    )
-
-    for content in response.get("Contents", []):
-        yield content.get("Key")
+# Columns sent to flowbird_transactions_raw
+FLOWBIRD_TRANSACTIONS_COLUMNS = [
+    "id",
+    "invoice_id",
+    "transaction_type",
+    "payment_method",
+    "meter_id",
+    "timestamp",
+    "duration_min",
+    "start_time",
+    "end_time",
+    "amount",
+    "location_name",
+]
 
 
 def get_invoice_id(banking_id, terminal_code):
@@ -148,9 +63,9 @@ def postgres_datetime(time_field):
         output (string): Formatted datetime field that is compatable with postgres
     """
 
-    output = pd.to_datetime(
-        time_field, format="%Y-%m-%d %H:%M:%S", infer_datetime_format=True
-    )
+    # pandas 1.x parsed an ISO 8601 format with infer_datetime_format like no format at
+    # all, which pandas 2 removed, so no format keeps the dates it accepts the same
+    output = pd.to_datetime(time_field)
     return str(output)
 
 def create_location_name(row):
@@ -174,6 +89,15 @@ def transform(smartfolio):
     # Drop dupes as there are some overlapping dates in the smartfolio CSVs, keep latest
     smartfolio = smartfolio.drop_duplicates(subset=["SYSTEM_ID"], keep="last")
 
+    # start_time is part of the primary key and the partition key, a row without one
+    # would fail its whole batch
+    missing_start = smartfolio["METER_DATE"].isna()
+    if missing_start.any():
+        logger.warning(
+            f"Dropped {missing_start.sum()} transactions without a METER_DATE"
+        )
+        smartfolio = smartfolio[~missing_start]
+
     ## Column wrangling
     smartfolio["id"] = smartfolio["SYSTEM_ID"]
     smartfolio["Banking Id"] = smartfolio["CARD_TRANS_ID"].astype("Int64")
@@ -226,116 +150,50 @@ def transform(smartfolio):
     smartfolio["location_name"] = smartfolio.apply(create_location_name, axis=1)
 
     # Only subset of columns needed for schema
-    smartfolio = smartfolio[
-        [
-            "id",
-            "invoice_id",
-            "transaction_type",
-            "payment_method",
-            "meter_id",
-            "timestamp",
-            "duration_min",
-            "start_time",
-            "end_time",
-            "amount",
-            "location_name",
-        ]
-    ]
+    smartfolio = smartfolio[FLOWBIRD_TRANSACTIONS_COLUMNS]
 
     return smartfolio
 
 
-def to_postgres(smartfolio):
-    """Uploads the formatted dataframe to two different postgres DBs.
-        flowbird_transactions_raw - just for smartfolio aka flowbird data
-        transactions - a combined parking DB which will also include data from passport
-    
-    Args:
-        smartfolio (pandas dataframe): Formatted dataframe that works with DB schema.
-    
-    Returns:
-        None
-    """
-    payload = smartfolio.to_dict(orient="records")
-
-    client = Postgrest(
-        POSTGREST_ENDPOINT,
-        token=POSTGREST_TOKEN,
-        headers={"Prefer": "return=representation"},
-    )
-
-    try:
-        res = client.upsert(resource="flowbird_transactions_raw", data=payload)
-    except Exception as e:
-        logger.error(client.res.text)
-        raise e
-
-    # Send data to the combined transactions dataset
-    smartfolio = smartfolio[
-        [
-            "id",
-            "payment_method",
-            "meter_id",
-            "duration_min",
-            "start_time",
-            "end_time",
-            "amount",
-            "location_name",
-        ]
-    ]
-
-    smartfolio["source"] = "Parking Meters"
-    payload = smartfolio.to_dict(orient="records")
-
-    try:
-        res = client.upsert(resource="transactions", data=payload)
-    except Exception as e:
-        logger.error(client.res.text)
-        raise e
+# Smartfolio transaction history CSVs, loaded to flowbird_transactions_raw. Postgres
+# copies the rows on to transactions, the combined parking DB which also includes
+# data from passport.
+LOADER = pipeline.Loader(
+    prefix="meters/prod/transaction_history/",
+    suffix=".csv",
+    read=pd.read_csv,
+    transform=transform,
+    table="flowbird_transactions_raw",
+    columns=FLOWBIRD_TRANSACTIONS_COLUMNS,
+)
 
 
 def main(args):
-    aws_s3_client = boto3.client(
-        "s3", aws_access_key_id=AWS_ACCESS_ID, aws_secret_access_key=AWS_PASS,
-    )
+    # Monthly partitions for the data we're about to load
+    client = pipeline.get_postgrest_client()
+    utils.ensure_transaction_partitions(client, args.year, args.month)
 
-    csv_file_list = handle_year_month_args(
-        args.year, args.month, args.lastmonth, aws_s3_client
+    months = pipeline.get_months(args.year, args.month, args.lastmonth)
+    pipeline.run(
+        LOADER, months, executor=args.executor, workers=args.workers, bulk=args.bulk
     )
 
-    # Go through all files and combine into a dataframe
-    for csv_f in csv_file_list:
-        # Parse the file
-        response = aws_s3_client.get_object(Bucket=BUCKET_NAME, Key=csv_f)
-        df = pd.read_csv(response.get("Body"))
-
-        logger.debug(f"Loaded CSV File: {csv_f}")
-
-        df = transform(df)
-
-        to_postgres(df)
-
+    changed = utils.refresh_transactions_daily(client)
+    logger.debug(f"Updated {changed} daily rollup rows")
 
-# CLI arguments definition
-parser = argparse.ArgumentParser()
 
-parser.add_argument(
-    "--year", type=int, help=f"Year of folder to select, defaults to current year",
-)
+if __name__ == "__main__":
+    # CLI arguments definition
+    parser = argparse.ArgumentParser()
 
-parser.add_argument(
-    "--month", type=int, help=f"Month of folder to select. defaults to current month",
-)
+    pipeline.add_arguments(parser)
 
-parser.add_argument(
-    "--lastmonth",
-    type=bool,
-    help=f"Will download from current month folder as well as previous.",
-    default=False,
-)
-
-args = parser.parse_args()
+    parser.add_argument(
+        "--bulk",
+        action="store_true",
+        help=f"Load with COPY straight to postgres (DATABASE_URL) instead of PostgREST, for backfills",
+    )
 
-logger = utils.get_logger(__file__, level=logging.DEBUG)
+    args = parser.parse_args()
 
-main(args)
+    main(args)
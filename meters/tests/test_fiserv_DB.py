@@ -0,0 +1,25 @@
+"""fiserv_DB.transform on reports as Fiserv sends them
+
+    $ pytest tests
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from benchmarks.synthetic import fiserv_report
+from config.fiserv import report_type
+import fiserv_DB
+
+
+def test_header_whitespace():
+    # A report classified as a transactions report is loaded as one, whatever the
+    # whitespace around its column names
+    report = fiserv_report(10)
+    padded = report.rename(columns=lambda c: f" {c} " if c == "Invoice Number" else c)
+    assert report_type(padded.columns) == "transactions"
+
+    output = fiserv_DB.transform(padded)
+    expected = fiserv_DB.transform(report)
+    assert list(output.columns) == list(expected.columns)
+    assert output["invoice_id"].tolist() == expected["invoice_id"].tolist()
@@ -0,0 +1,231 @@
+"""fiserv_email_pub.listen, processing emails from S3 notifications on an SQS queue,
+against S3 and SQS mocked by moto
+
+    $ pip install -r requirements-test.txt
+    $ pytest tests
+"""
+from argparse import Namespace
+from email.message import EmailMessage
+from io import BytesIO
+import json
+import os
+import sys
+
+import boto3
+from moto import mock_aws
+import pyzipper
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from config.fiserv import REQUIRED_FIELDS
+import fiserv_email_pub
+
+BUCKET_NAME = "test-fiserv-emails"
+FSRV_EMAIL = "reports@fiserv.test"
+ENCRYPTION_KEY = "test-key"
+
+# A transactions report, sent on 2022-03-02
+REPORT = ",".join(REQUIRED_FIELDS) + "\n" + ",".join(["1"] * len(REQUIRED_FIELDS)) + "\n"
+REPORT_KEY = "emails/current_processed/2022/3/report.csv"
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    monkeypatch.setenv("AWS_DEFAULT_REGION", "us-east-1")
+    monkeypatch.setattr(fiserv_email_pub, "BUCKET_NAME", BUCKET_NAME)
+    monkeypatch.setattr(fiserv_email_pub, "FSRV_EMAIL", FSRV_EMAIL)
+    monkeypatch.setattr(fiserv_email_pub, "ENCRYPTION_KEY", ENCRYPTION_KEY)
+    # An empty queue answers at once rather than after a long poll
+    monkeypatch.setattr(fiserv_email_pub, "POLL_SECONDS", 0)
+
+    with mock_aws():
+        client = boto3.client("s3")
+        client.create_bucket(Bucket=BUCKET_NAME)
+        sqs = boto3.client("sqs")
+        queue_url = sqs.create_queue(QueueName="fiserv-emails")["QueueUrl"]
+        yield Namespace(
+            client=client, s3=boto3.resource("s3"), sqs=sqs, queue_url=queue_url
+        )
+
+
+def make_email(files=None):
+    """An email from Fiserv with the files, the report by default, in an encrypted zip"""
+    zip_data = BytesIO()
+    with pyzipper.AESZipFile(
+        zip_data, "w", compression=pyzipper.ZIP_DEFLATED, encryption=pyzipper.WZ_AES
+    ) as zip_file:
+        zip_file.setpassword(ENCRYPTION_KEY.encode())
+        for fname, contents in (files or {"report.csv": REPORT}).items():
+            zip_file.writestr(fname, contents)
+
+    message = EmailMessage()
+    message["From"] = FSRV_EMAIL
+    message["Date"] = "Wed, 02 Mar 2022 06:00:00 -0600"
+    message["Subject"] = "Daily report"
+    message.set_content("Attached")
+    message.add_attachment(
+        zip_data.getvalue(),
+        maintype="application",
+        subtype="zip",
+        filename="report.zip",
+    )
+    return message.as_bytes()
+
+
+def put_email(aws, key, files=None):
+    aws.client.put_object(Bucket=BUCKET_NAME, Key=key, Body=make_email(files))
+
+
+def notify(aws, key):
+    """Sends the S3 object created notification for an email"""
+    record = {
+        "eventName": "ObjectCreated:Put",
+        "s3": {"bucket": {"name": BUCKET_NAME}, "object": {"key": key, "size": 1}},
+    }
+    aws.sqs.send_message(
+        QueueUrl=aws.queue_url, MessageBody=json.dumps({"Records": [record]})
+    )
+
+
+def run(aws, **kwargs):
+    """Runs listen with the CLI defaults, stopping at the first empty poll"""
+    args = {"workers": 1, "reformat": False, "reconcile_minutes": 60, "max_idle_polls": 1}
+    args.update(kwargs)
+    fiserv_email_pub.listen(aws.queue_url, aws.client, aws.s3, aws.sqs, Namespace(**args))
+
+
+def keys(aws, prefix):
+    response = aws.client.list_objects_v2(Bucket=BUCKET_NAME, Prefix=prefix)
+    return [item["Key"] for item in response.get("Contents", [])]
+
+
+def messages_left(aws):
+    attributes = aws.sqs.get_queue_attributes(
+        QueueUrl=aws.queue_url,
+        AttributeNames=[
+            "ApproximateNumberOfMessages",
+            "ApproximateNumberOfMessagesNotVisible",
+        ],
+    )["Attributes"]
+    return sum(int(count) for count in attributes.values())
+
+
+@pytest.fixture
+def processed(monkeypatch):
+    """The emails process_email was called with"""
+    emails = []
+    process_email = fiserv_email_pub.process_email
+
+    def counted(email_file, *args):
+        emails.append(email_file)
+        return process_email(email_file, *args)
+
+    monkeypatch.setattr(fiserv_email_pub, "process_email", counted)
+    return emails
+
+
+def test_notification(aws, monkeypatch, processed):
+    # The first scan finds nothing, the email is only found through its notification
+    get_email_list = fiserv_email_pub.get_email_list
+    scans = []
+
+    def later_scans(s3):
+        scans.append(s3)
+        return get_email_list(s3) if len(scans) > 1 else []
+
+    monkeypatch.setattr(fiserv_email_pub, "get_email_list", later_scans)
+    put_email(aws, "emails/new/a")
+    notify(aws, "emails/new/a")
+
+    run(aws)
+
+    assert len(scans) == 1
+    assert processed == ["emails/new/a"]
+    assert keys(aws, "emails/new/") == []
+    assert keys(aws, "emails/archive/") == ["emails/archive/a"]
+    assert keys(aws, "emails/current_processed/") == [REPORT_KEY]
+    assert messages_left(aws) == 0
+
+
+def test_reconcile_scan(aws, monkeypatch, processed):
+    # An email in the inbox from before the run, and one which arrives during it
+    # without a notification
+    put_email(aws, "emails/new/a")
+    receive_message = aws.sqs.receive_message
+    polls = []
+
+    def arrive_unnotified(**kwargs):
+        polls.append(kwargs)
+        if len(polls) == 1:
+            put_email(aws, "emails/new/b")
+        return receive_message(**kwargs)
+
+    monkeypatch.setattr(aws.sqs, "receive_message", arrive_unnotified)
+
+    run(aws, reconcile_minutes=0, max_idle_polls=2)
+
+    assert processed == ["emails/new/a", "emails/new/b"]
+    assert keys(aws, "emails/new/") == []
+    assert keys(aws, "emails/archive/") == ["emails/archive/a", "emails/archive/b"]
+
+
+def test_duplicate_and_deleted_emails(aws, monkeypatch, processed):
+    # Two notifications for one email, and one for an email another run already
+    # processed and removed from the inbox. The scan is left out so the notifications
+    # are what find them.
+    monkeypatch.setattr(fiserv_email_pub, "get_email_list", lambda s3: [])
+    put_email(aws, "emails/new/a")
+    notify(aws, "emails/new/a")
+    notify(aws, "emails/new/a")
+    notify(aws, "emails/new/gone")
+
+    run(aws)
+
+    assert processed == ["emails/new/a"]
+    assert keys(aws, "emails/new/") == []
+    assert messages_left(aws) == 0
+
+
+def test_max_idle_polls(aws, monkeypatch, processed):
+    receive_message = aws.sqs.receive_message
+    polls = []
+
+    def counted(**kwargs):
+        polls.append(kwargs)
+        return receive_message(**kwargs)
+
+    monkeypatch.setattr(aws.sqs, "receive_message", counted)
+
+    run(aws, max_idle_polls=3)
+
+    assert len(polls) == 3
+    assert processed == []
+
+
+@pytest.mark.parametrize("reformat", [False, True])
+def test_unreadable_csvs(aws, reformat):
+    # CSVs without a header the report type can be found from are uploaded unclassified
+    # rather than failing the email, which would be retried on every run
+    put_email(
+        aws,
+        "emails/new/a",
+        {
+            "report.csv": REPORT,
+            "empty.csv": "",
+            "latin1.csv": "caf\xe9,total\n1,2\n".encode("latin-1"),
+            "one column.csv": "total\n1\n",
+        },
+    )
+
+    run(aws, reformat=reformat)
+
+    assert keys(aws, "emails/current_processed/") == [REPORT_KEY]
+    assert sorted(keys(aws, "emails/unclassified/")) == [
+        "emails/unclassified/2022/3/empty.csv",
+        "emails/unclassified/2022/3/latin1.csv",
+        "emails/unclassified/2022/3/one-column.csv",
+    ]
+    assert keys(aws, "emails/archive/") == ["emails/archive/a"]
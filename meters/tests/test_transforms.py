@@ -0,0 +1,75 @@
+"""The loaders' and match_field_processing's parsing of dates and amounts, which gives
+the same results on the pinned pandas 1.3 as before infer_datetime_format was dropped,
+and works on pandas 2
+
+    $ pytest tests
+"""
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from benchmarks.synthetic import passport_report
+import match_field_processing
+import passport_DB
+import payments_s3
+import smartfolio_s3
+
+
+@pytest.mark.parametrize("loader", [payments_s3, smartfolio_s3])
+@pytest.mark.parametrize(
+    "time_field, expected",
+    [
+        ("2021-07-02 15:04:05", "2021-07-02 15:04:05"),
+        ("2021-07-02T15:04:05", "2021-07-02 15:04:05"),
+        ("2021-07-02", "2021-07-02 00:00:00"),
+        ("2021-07-02 15:04:05.250", "2021-07-02 15:04:05.250000"),
+        # Not the layout the reports use, but pandas 1.3 parsed it with the old
+        # format and infer_datetime_format
+        ("07/02/2021 15:04:05", "2021-07-02 15:04:05"),
+        (np.nan, "NaT"),
+    ],
+)
+def test_postgres_datetime(loader, time_field, expected):
+    assert loader.postgres_datetime(time_field) == expected
+
+
+def test_passport_amounts_and_times():
+    report = passport_report(10)
+    # Net Revenue without the "$", which a regex "$" would match the end of
+    report.loc[0, ["Parking Revenue", "Net Revenue"]] = ["$1.50", "0.89"]
+    report.loc[0, "Entry Time"] = "2021/07/02 03:04:05 PM"
+
+    transaction_id = report.loc[0, "Transaction #"]
+
+    output = passport_DB.transform(report)
+
+    assert output["amount"].dtype == float
+    [row] = output[output["id"] == transaction_id].to_dict(orient="records")
+    assert row["amount"] == 1.5
+    assert row["net_revenue"] == 0.89
+    assert row["start_time"] == "2021-07-02 15:04:05"
+
+
+@pytest.mark.parametrize(
+    "transaction_date",
+    [
+        # As PostgREST sends them
+        ["2021-07-02T15:04:05", "2021-07-01T08:00:00"],
+        # As the payments cache gives them back
+        pd.to_datetime(["2021-07-02 15:04:05", "2021-07-01 08:00:00"]),
+    ],
+)
+def test_match_datetime_handling(transaction_date):
+    df = pd.DataFrame({"transaction_date": transaction_date})
+
+    output = match_field_processing.datetime_handling(df)
+
+    assert output["transaction_date"].tolist() == [
+        pd.Timestamp("2021-07-01 08:00:00"),
+        pd.Timestamp("2021-07-02 15:04:05"),
+    ]
@@ -0,0 +1,82 @@
+"""Refresh or rebuild the daily transactions rollup (api.transactions_daily)"""
+import argparse
+from datetime import datetime, timedelta
+import logging
+import os
+
+from pypgrest import Postgrest
+
+import utils
+
+# Envrioment variables
+POSTGREST_TOKEN = os.getenv("POSTGREST_TOKEN")
+POSTGREST_ENDPOINT = os.getenv("POSTGREST_ENDPOINT")
+
+DATE_FORMAT_HUMANS = "%Y-%m-%d"
+
+
+def rebuild(client, start, end):
+    """Recompute the rollup for every day from start to end (inclusive).
+
+    Args:
+        client: Postgrest client object
+        start (date): First day to rebuild
+        end (date): Last day to rebuild
+
+    Returns:
+        int: The number of rollup rows which changed
+    """
+    return client.insert(
+        resource="rpc/rebuild_transactions_daily",
+        data={"start_date": start.isoformat(), "end_date": end.isoformat()},
+    )
+
+
+def main(args):
+    client = Postgrest(
+        POSTGREST_ENDPOINT,
+        token=POSTGREST_TOKEN,
+        headers={"Prefer": "return=representation"},
+    )
+
+    if not args.start:
+        changed = utils.refresh_transactions_daily(client)
+        logger.info(f"Refreshed daily rollup, {changed} rows changed")
+        return
+
+    start = datetime.strptime(args.start, DATE_FORMAT_HUMANS).date()
+    end = (
+        datetime.strptime(args.end, DATE_FORMAT_HUMANS).date()
+        if args.end
+        else datetime.now().date()
+    )
+
+    # One month per request so a long backfill doesn't hit the request timeout
+    while start <= end:
+        next_month = (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+        chunk_end = min(next_month - timedelta(days=1), end)
+        changed = rebuild(client, start, chunk_end)
+        logger.info(f"Rebuilt {start} to {chunk_end}, {changed} rows changed")
+        start = next_month
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "--start",
+        type=str,
+        help=f"First day to rebuild (YYYY-MM-DD). Without it only the days with new or updated transactions are refreshed",
+    )
+
+    parser.add_argument(
+        "--end",
+        type=str,
+        help=f"Last day to rebuild (YYYY-MM-DD). Defaults to today",
+    )
+
+    args = parser.parse_args()
+
+    logger = utils.get_logger(__file__, level=logging.DEBUG)
+
+    main(args)
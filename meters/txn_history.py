@@ -13,12 +13,21 @@ import requests
 import utils
 
 # env vars
-USER = os.getenv("USER")
-USER_PARD = os.getenv("USER_PARD")
-PASSWORD = os.getenv("PASSWORD")
-PASSWORD_PARD = os.getenv("PASSWORD_PARD")
+# The Dr-Direct logins were USER, PASSWORD, USER_PARD and PASSWORD_PARD, which are still
+# read when the FLOWBIRD_ ones aren't set. USER is also the shell's login name.
+FLOWBIRD_USER = os.getenv("FLOWBIRD_USER", os.getenv("USER"))
+FLOWBIRD_USER_PARD = os.getenv("FLOWBIRD_USER_PARD", os.getenv("USER_PARD"))
+FLOWBIRD_PASSWORD = os.getenv("FLOWBIRD_PASSWORD", os.getenv("PASSWORD"))
+FLOWBIRD_PASSWORD_PARD = os.getenv("FLOWBIRD_PASSWORD_PARD", os.getenv("PASSWORD_PARD"))
 ENDPOINT = os.getenv("ENDPOINT")
 BUCKET = os.getenv("BUCKET")
+# Optional like the other scripts' keys, boto3 finds its own credentials without them
+AWS_ACCESS_ID = os.getenv("AWS_ACCESS_ID")
+AWS_PASS = os.getenv("AWS_PASS")
+# Optional, for pointing the S3 client at a local stand-in
+AWS_ENDPOINT_URL = os.getenv("AWS_ENDPOINT_URL")
+# Seconds between requests, the endpoint allows one a minute
+REQUEST_INTERVAL = int(os.getenv("FLOWBIRD_REQUEST_INTERVAL", "61"))
 
 # settings
 ROOT_DIR = "meters"
@@ -182,13 +191,18 @@ def main(args):
     ## pard for Parks data which includes pool passes
     ## atd for parking meters
     if args.user == "pard":
-        login_user = USER_PARD
-        login_pass = PASSWORD_PARD
+        login_user = FLOWBIRD_USER_PARD
+        login_pass = FLOWBIRD_PASSWORD_PARD
     else:
-        login_user = USER
-        login_pass = PASSWORD
-
-    s3 = boto3.client("s3")
+        login_user = FLOWBIRD_USER
+        login_pass = FLOWBIRD_PASSWORD
+
+    s3 = boto3.client(
+        "s3",
+        aws_access_key_id=AWS_ACCESS_ID,
+        aws_secret_access_key=AWS_PASS,
+        endpoint_url=AWS_ENDPOINT_URL,
+    )
 
     for chunk_start in todos:
         chunk_end = format_chunk_end(chunk_start)
@@ -241,7 +255,7 @@ def main(args):
             logger.debug(f"No data found for {chunk_start} to {chunk_end}")
 
         logger.debug(f"Sleeping to comply with rate limit...")
-        time.sleep(61)
+        time.sleep(REQUEST_INTERVAL)
 
 
 if __name__ == "__main__":
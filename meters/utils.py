@@ -1,3 +1,4 @@
+from datetime import date, datetime, timedelta
 import logging
 import sys
 
@@ -10,3 +11,35 @@ def get_logger(name, level):
     logger.addHandler(handler)
     logger.setLevel(level)
     return logger
+
+
+def ensure_transaction_partitions(client, year=None, month=None, months=3):
+    """Create the monthly partitions of the transactions tables for the month before
+    the given year/month and the months after it, so rows loaded for that month don't
+    land in the default partition.
+
+    Args:
+        client: Postgrest client object
+        year (int): Defaults to the current year
+        month (int): Defaults to the current month
+        months (int): Number of monthly partitions to create
+    """
+    first = date(year or datetime.now().year, month or datetime.now().month, 1)
+    from_month = (first - timedelta(days=1)).replace(day=1)
+    client.insert(
+        resource="rpc/ensure_transaction_partitions",
+        data={"from_month": from_month.isoformat(), "months": months},
+    )
+
+
+def refresh_transactions_daily(client):
+    """Bring the daily transactions rollup up to date with the transactions loaded
+    since it was last refreshed.
+
+    Args:
+        client: Postgrest client object
+
+    Returns:
+        int: The number of rollup rows which changed
+    """
+    return client.insert(resource="rpc/refresh_transactions_daily", data={})